@@ -0,0 +1,797 @@
+"""Email processing core: knowledge base and RAG setup, categorization, the
+refund/question/other handlers and the Gmail monitor loop.
+
+Nothing here imports Streamlit. worker.py runs the monitor headless and app.py
+is a dashboard over the same DB.
+"""
+import os
+import json
+import importlib.util
+import re
+import time
+import logging
+import email.utils
+import threading
+import content_reducer
+import coordination
+import fast_classifier
+import gmail_batch
+import gmail_client
+import gmail_sync
+import kb_index
+import kb_search
+import llm_scheduler
+import metrics
+import mime_body
+import order_store
+import outbox
+import pipeline
+import storage
+from storage import (delete_pending_refund, get_pending_by_reply_to, insert_not_found_refund, insert_pending_refund,
+                     insert_unhandled_email, is_email_processed, mark_email_processed_full)
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from gmail_client import TOKEN_DIR
+
+# FAISS; kb_index imports it when the index is built
+FAISS_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ('faiss', 'langchain_community'))
+
+logger = logging.getLogger(__name__)
+
+# Config
+KB_FILE = "rag_knowledge_base.txt"
+os.makedirs(TOKEN_DIR, exist_ok=True)
+
+# KB and RAG
+def read_knowledge_base(path=KB_FILE):
+    from langchain.docstore.document import Document
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found")
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        documents = []
+        current_category = None
+        current_qa = []
+        for line in lines:
+            if line.startswith("# "):
+                if current_qa:
+                    doc_content = "\n".join(current_qa).strip()
+                    if doc_content:
+                        documents.append(Document(page_content=doc_content, metadata={"category": current_category}))
+                current_qa = []
+                current_category = line[2:].strip()
+            elif line.strip():
+                current_qa.append(line)
+        if current_qa:
+            doc_content = "\n".join(current_qa).strip()
+            if doc_content:
+                documents.append(Document(page_content=doc_content, metadata={"category": current_category}))
+        return documents
+    except Exception as e:
+        logger.error(f"KB load failed: {e}")
+        return []
+
+_kb_mtime = None
+
+def knowledge_base_changed():
+    try:
+        return os.path.getmtime(KB_FILE) != _kb_mtime
+    except OSError:
+        return False
+
+def refresh_knowledge_base(knowledge_base, qa_chain=None):
+    """Rebuild the search indexes and reset the answer cache when the KB file has changed since the last check."""
+    global _kb_mtime
+    if not knowledge_base:
+        return
+    try:
+        mtime = os.path.getmtime(KB_FILE)
+        if mtime == _kb_mtime:
+            return
+        documents = read_knowledge_base()
+        knowledge_base.update(documents)
+        from answer_cache import CachedQA
+        if documents and isinstance(qa_chain, CachedQA):
+            qa_chain.set_kb_version(kb_index.knowledge_base_version(documents))
+        _kb_mtime = mtime
+    except Exception as e:
+        logger.error(f"KB refresh failed: {e}")
+
+def init_rag_components(llm=None, base_embeddings=None, retrieval=kb_search.DEFAULT_MODE):
+    """Build (llm, embeddings, knowledge_base, qa_chain).
+
+    knowledge_base is a kb_search.KnowledgeBaseSearch in the given retrieval
+    mode; without FAISS it searches with BM25 only, so questions are still
+    answered. llm and base_embeddings replace the OpenAI clients (benchmark.py).
+    """
+    # Imported here, not at module level: langchain_openai alone takes seconds to load
+    from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+    from langchain.prompts import PromptTemplate
+    from langchain.chains import RetrievalQA
+    from answer_cache import CachedQA, SemanticAnswerCache
+    from embedding_cache import CachedEmbeddings
+    try:
+        if llm is None and ("OPENAI_API_KEY" not in os.environ or not os.environ["OPENAI_API_KEY"].strip()):
+            raise ValueError("No OpenAI API key")
+        llm = llm or ChatOpenAI(model="o4-mini")
+        embeddings = CachedEmbeddings(base_embeddings or OpenAIEmbeddings(model="text-embedding-3-small", request_timeout=60.0))
+        documents = read_knowledge_base()
+        if not documents:
+            raise ValueError("No documents")
+
+        # Custom QA prompt
+        qa_prompt = PromptTemplate(
+            input_variables=["context", "question"],
+            template="""
+            You are an email assistant of a logistic company. Answer the question based only on the provided context from the knowledge base.
+            If you don’t have enough information from the provided context to answer the question, respond only with 'I don’t have enough information' and nothing else.
+            Context: {context}
+            Question: {question}
+            Answer:
+            """
+        )
+
+        vectorstore = None
+        if FAISS_AVAILABLE and retrieval != 'bm25':
+            vectorstore = kb_index.load_or_build_index(kb_search.split_passages(documents), embeddings)
+        knowledge_base = kb_search.KnowledgeBaseSearch(documents, vectorstore, retrieval)
+        # Only 'Question' emails reach the QA chain, so it searches the Question section
+        qa_chain = RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=knowledge_base.as_retriever(k=3, category='Question'),
+            chain_type_kwargs={"prompt": qa_prompt}
+        )
+        answer_cache = SemanticAnswerCache(embeddings, kb_index.knowledge_base_version(documents))
+        return llm, embeddings, knowledge_base, CachedQA(qa_chain, answer_cache)
+    except Exception as e:
+        logger.error(f"RAG failed: {e}")
+        llm = llm or ChatOpenAI(model="o4-mini")
+        embeddings = CachedEmbeddings(base_embeddings or OpenAIEmbeddings(model="text-embedding-3-small", request_timeout=60.0))
+        return llm, embeddings, None, None
+
+# Gmail
+def get_gmail_service(credentials_file):
+    """Return (service, email) for a token file from the process-wide gmail_client cache.
+
+    Never starts an OAuth flow: accounts whose token can't be loaded or refreshed
+    have to be reconnected from the dashboard.
+    """
+    try:
+        service, email = gmail_client.get_service(credentials_file)
+        if not service:
+            logger.error(f"Gmail token {credentials_file} unusable, reconnect the account")
+        return service, email
+    except Exception as e:
+        logger.error(f"Gmail failed: {e}")
+        return None, None
+
+# Process functions
+def clean_content_for_regex(content):
+    if not content:
+        return ''
+    lines = content.split('\n')
+    cleaned_lines = []
+    for line in lines:
+        line_stripped = line.strip()
+        if line_stripped and not (
+            line_stripped.startswith('>') or 
+            line_stripped.startswith('--') or 
+            line_stripped.startswith('On ') or 
+            line_stripped.startswith('From:') or 
+            line_stripped.startswith('Sent:') or 
+            line_stripped.startswith('To:') or 
+            line_stripped.startswith('Subject:') or 
+            'Invalid Order ID' in line_stripped
+        ):
+            cleaned_lines.append(line)
+    return '\n'.join(cleaned_lines)
+
+CATEGORIZE_TEMPLATE = """
+    You are an email assistant of a logistic company. Please use the knowledge base examples to answer emails.
+    Read carefully all the contents of the email thread, including quotes and previous responses.
+    Categorize the following email into one of three categories: 'Refund', 'Question' or 'Other'.
+    - Categorize as 'Refund':
+        - if the email mentions 'refund' or 'return'
+        - if the email has 'Invalid Order ID' in replies, quotes a previous refund response, or continues a refund thread (e.g., provides ID after ask)
+    - If the email asks for information or clarification about the company or it's services, categorize as 'Question'.
+    - If you don’t have enough information to answer the question, say litterly 'I don’t have enough information'.
+    - Otherwise, categorize as 'Other'.
+    Provide a brief explanation and an importance level (low, medium, high).
+    Email content: {email_content}
+    Response format:
+    Category: <category>
+    Explanation: <explanation>
+    Importance: <importance>
+    """
+
+CATEGORIZE_BATCH_TEMPLATE = """
+    You are an email assistant of a logistic company.
+    Below are several independent emails, each starting with a line '### Email <number>'.
+    Read carefully all the contents of every email thread, including quotes and previous responses.
+    Categorize each email into one of three categories: 'Refund', 'Question' or 'Other'.
+    - Categorize as 'Refund':
+        - if the email mentions 'refund' or 'return'
+        - if the email has 'Invalid Order ID' in replies, quotes a previous refund response, or continues a refund thread (e.g., provides ID after ask)
+    - If the email asks for information or clarification about the company or it's services, categorize as 'Question'.
+    - Otherwise, categorize as 'Other'.
+    Provide an importance level (low, medium, high) for each email.
+    {emails}
+    Response format, one block per email in the same order:
+    Email: <number>
+    Category: <category>
+    Importance: <importance>
+    """
+
+CATEGORIZE_FAILED = ("Other", "Failed", "low")
+
+def parse_categorization(response):
+    category_match = re.search(r'Category:\s*(\w+)', response, re.IGNORECASE)
+    importance_match = re.search(r'Importance:\s*(\w+)', response, re.IGNORECASE)
+    if category_match and importance_match:
+        return category_match.group(1).strip(), "N/A", importance_match.group(1).strip().lower()
+    return None
+
+def categorize_email_raw(llm, content):
+    """Like categorize_email, but lets API errors through so callers can retry them."""
+    from langchain.prompts import PromptTemplate
+    prompt = PromptTemplate(input_variables=["email_content"], template=CATEGORIZE_TEMPLATE)
+    with metrics.llm_call('categorize'):
+        response = llm.invoke(prompt.format(email_content=content))
+    return parse_categorization(response.content)
+
+def categorize_email(llm, content):
+    try:
+        return categorize_email_raw(llm, content) or CATEGORIZE_FAILED
+    except:
+        return CATEGORIZE_FAILED
+
+def categorize_emails_batch(llm, contents):
+    """Categorize several emails with one prompt. Returns a list aligned with contents, None where parsing failed."""
+    from langchain.prompts import PromptTemplate
+    emails = "\n".join(f"### Email {i}\n{content}" for i, content in enumerate(contents, 1))
+    prompt = PromptTemplate(input_variables=["emails"], template=CATEGORIZE_BATCH_TEMPLATE)
+    with metrics.llm_call('categorize_batch'):
+        response = llm.invoke(prompt.format(emails=emails)).content
+    results = [None] * len(contents)
+    for block in re.split(r'(?=^\s*Email:\s*\d+)', response, flags=re.MULTILINE):
+        number_match = re.match(r'\s*Email:\s*(\d+)', block)
+        if not number_match:
+            continue
+        index = int(number_match.group(1)) - 1
+        if 0 <= index < len(contents):
+            results[index] = parse_categorization(block)
+    return results
+
+TRIAGE_SCHEMA = {
+    "title": "EmailTriage",
+    "description": "Category, importance and draft answer for a customer support email.",
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": ["Refund", "Question", "Other"]},
+        "importance": {"type": "string", "enum": ["low", "medium", "high"]},
+        "answer": {"type": "string", "description": "Answer for a 'Question' email, empty otherwise"},
+    },
+    "required": ["category", "importance", "answer"],
+}
+
+def categorize_and_answer(llm, knowledge_base, content, k=3):
+    """Classify an email and draft the KB answer in one LLM call.
+
+    Returns (category, importance, answer), or None so the caller can fall back
+    to categorize_email and the QA chain.
+    """
+    from langchain.prompts import PromptTemplate
+    try:
+        docs = knowledge_base.search(content, k=k)
+        context = "\n\n".join(doc.page_content for doc in docs)
+        prompt = PromptTemplate(
+            input_variables=["context", "email_content"],
+            template="""
+            You are an email assistant of a logistic company.
+            Read carefully all the contents of the email thread, including quotes and previous responses.
+            Categorize the email into one of three categories: 'Refund', 'Question' or 'Other'.
+            - Categorize as 'Refund':
+                - if the email mentions 'refund' or 'return'
+                - if the email has 'Invalid Order ID' in replies, quotes a previous refund response, or continues a refund thread (e.g., provides ID after ask)
+            - If the email asks for information or clarification about the company or it's services, categorize as 'Question'.
+            - Otherwise, categorize as 'Other'.
+            Assess an importance level (low, medium, high).
+            For a 'Question', answer it based only on the provided context from the knowledge base.
+            If you don’t have enough information from the provided context to answer the question, the answer must be only 'I don’t have enough information' and nothing else.
+            For other categories leave the answer empty.
+            Context: {context}
+            Email content: {email_content}
+            """
+        )
+        with metrics.llm_call('triage'):
+            result = llm.with_structured_output(TRIAGE_SCHEMA).invoke(prompt.format(context=context, email_content=content))
+        category = result.get("category")
+        if category not in ("Refund", "Question", "Other"):
+            return None
+        return category, (result.get("importance") or "low").lower(), result.get("answer") or ""
+    except Exception as e:
+        logger.error(f"Categorize and answer failed: {e}")
+        return None
+
+def process_question_email(qa_chain, email_id, subject, content, sender_email, sender, conn, category, importance, answer=None,
+                           query=None):
+    """Answer a question from the KB. query is the text given to the QA chain (default content); content is what gets stored."""
+    if is_email_processed(conn, email_id):
+        return
+    try:
+        if answer is None:
+            if not qa_chain:
+                process_other_email(email_id, subject, content, importance, sender_email, conn, category)
+                return
+            # CachedQA times the LLM call on an answer cache miss
+            result = qa_chain.invoke({"query": query or content})
+            answer = result["result"]
+        if "i don’t have enough information" in answer.lower():
+            insert_unhandled_email(conn, email_id, subject, content, importance)
+        else:
+            send_email(conn, sender, sender_email, email_id, f"Re: {subject}", answer)
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+    except Exception as e:
+        logger.error(f"Question process error {email_id}: {e}")
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+
+def refund_order(email_id, subject, sender_email, sender, conn, order_id, invalid_msg, invalid_label):
+    """Confirm the refund of an existing order, or ask again for a valid Order ID."""
+    if order_store.request_refund(conn, order_id):
+        send_email(conn, sender, sender_email, email_id, f"Re: {subject}", f"Your refund request for Order ID {order_id} will be processed within 3 days.")
+        return
+    system_reply_id = send_email(conn, sender, sender_email, email_id, f"Re: {subject}", invalid_msg)
+    if system_reply_id:
+        insert_pending_refund(conn, email_id, system_reply_id, order_id, 'asked')
+    elif sender:
+        logger.error(f"Failed to create pending for {invalid_label} {order_id}: send failed")
+
+def process_refund_email(email_id, subject, content, sender_email, sender, conn, category, reply_to, importance):
+    if is_email_processed(conn, email_id):
+        return
+    try:
+        cleaned_content = clean_content_for_regex(content)
+        order_id_match = re.search(r'(?:Order\s+ID|order\s+id)[:\s]+([A-Za-z0-9\-]+)', cleaned_content, re.IGNORECASE)
+        order_id = order_id_match.group(1) if order_id_match else None
+
+        pending = get_pending_by_reply_to(conn, reply_to)
+
+        if pending:
+            if order_id is None:
+                invalid_id = pending['order_id'] if pending['order_id'] else 'no_id_provided'
+                insert_not_found_refund(conn, email_id, subject, content, invalid_id)
+                delete_pending_refund(conn, pending['email_id'])
+                final_msg = "We couldn't process your refund request as no valid Order ID was provided. If you have a valid order, please start a new conversation."
+                send_email(conn, sender, sender_email, email_id, f"Re: {subject}", final_msg)
+            else:
+                if pending['order_id'] and order_id == pending['order_id']:
+                    insert_not_found_refund(conn, email_id, subject, content, order_id)
+                    delete_pending_refund(conn, pending['email_id'])
+                    final_msg = f"Invalid Order ID {order_id} provided again. Refund request closed."
+                    send_email(conn, sender, sender_email, email_id, f"Re: {subject}", final_msg)
+                else:
+                    delete_pending_refund(conn, pending['email_id'])
+                    invalid_msg = f"Invalid Order ID: {order_id}. Please verify and reply with a valid one."
+                    refund_order(email_id, subject, sender_email, sender, conn, order_id, invalid_msg, "different invalid ID")
+        else:
+            if order_id is None:
+                ask_msg = "Please provide the Order ID in the format 'Order ID: XXXXX' (e.g., Order ID: 12345-ABCDE)."
+                system_reply_id = send_email(conn, sender, sender_email, email_id, f"Re: {subject}", ask_msg)
+                if system_reply_id:
+                    insert_pending_refund(conn, email_id, system_reply_id, None, 'asked')
+                elif sender:
+                    logger.error("Failed to create pending for missing ID: send failed")
+            else:
+                invalid_msg = f"Invalid Order ID: {order_id}. Please verify and reply with a valid one using format like 'Order ID: XXXXX'. Please keep this conversation in your reply."
+                refund_order(email_id, subject, sender_email, sender, conn, order_id, invalid_msg, "invalid ID")
+
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+    except Exception as e:
+        logger.error(f"Refund process error {email_id}: {e}")
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+
+def process_other_email(email_id, subject, content, importance, sender_email, conn, category):
+    if is_email_processed(conn, email_id):
+        return
+    try:
+        insert_unhandled_email(conn, email_id, subject, content, importance)
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+    except Exception as e:
+        logger.error(f"Other process error {email_id}: {e}")
+        mark_email_processed_full(conn, email_id, subject, content, category, importance)
+
+def send_email(conn, sender, to_email, in_reply_to, subject, message_text):
+    """Queue a reply in the outbox. sender is (account, address).
+
+    Returns the reply's Message-ID, generated locally, or None. Without a
+    sender the reply is suppressed.
+    """
+    if sender is None:
+        logger.info(f"Reply to {in_reply_to} suppressed")
+        return None
+    account, address = sender
+    return outbox.enqueue(conn, account, address, in_reply_to, to_email, subject, message_text)
+
+# Monitor
+MONITOR_INTERVAL = 60  # seconds between polling cycles
+MAX_ACCOUNT_WORKERS = 4  # accounts polled concurrently
+MAX_EMAIL_WORKERS = 8  # classify and act threads each, shared by all accounts
+MAX_EMAILS_PER_ACCOUNT = 3  # emails in flight per account
+INCREMENTAL_SYNC = True  # list history deltas instead of re-scanning unread mail
+SINGLE_CALL_MODE = False  # classify and answer questions with one LLM call
+CATEGORIZE_MODE = 'concurrent'  # 'concurrent', 'batch' or None to categorize inline per email
+REPORT_INTERVAL = 10  # seconds between heartbeats with a metrics snapshot while waiting
+
+def wait_while_running(event, seconds):
+    # The monitor event is set while running, so event.wait() can't be used to sleep
+    deadline = time.monotonic() + seconds
+    while event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(1.0, remaining))
+
+def wait_and_report(event, seconds, report, every=REPORT_INTERVAL):
+    """wait_while_running that calls report() every `every` seconds."""
+    deadline = time.monotonic() + seconds
+    while event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        wait_while_running(event, min(every, remaining))
+        report()
+
+def message_headers(msg):
+    return {h['name']: h['value'] for h in msg['payload']['headers']}
+
+def parse_message(msg):
+    headers = message_headers(msg)
+    subject = headers.get('Subject', '')
+    from_header = headers.get('From', '')
+    sender_name, sender_email = email.utils.parseaddr(from_header)
+    if not sender_email:
+        sender_email = 'unknown@example.com'
+    reply_to = headers.get('In-Reply-To', '').strip()
+    # Messages from mime_body.fetch_messages carry their text; full-format ones are parsed here
+    content = msg['body_text'] if 'body_text' in msg else mime_body.extract_text(msg['payload'])
+    return subject, sender_email, reply_to, content
+
+def needs_body(conn, msg):
+    """False for auto-replies that are not answers to a pending refund: their snippet is enough."""
+    headers = message_headers(msg)
+    if fast_classifier.is_auto_reply(headers, headers.get('Subject', '')) < fast_classifier.FAST_PATH_THRESHOLD:
+        return True
+    return get_pending_by_reply_to(conn, headers.get('In-Reply-To', '').strip()) is not None
+
+def prepare_message(conn, msg):
+    """Parse a fetched email and run the fast-path classifier. Returns None for emails to skip."""
+    subject, sender_email, reply_to, content = parse_message(msg)
+    if not content or len(content.strip()) < 10:
+        return None
+    has_pending = get_pending_by_reply_to(conn, reply_to) is not None
+    fast = fast_classifier.precategorize(clean_content_for_regex(content), message_headers(msg), has_pending)
+    return {'subject': subject, 'sender_email': sender_email, 'reply_to': reply_to, 'content': content, 'fast': fast}
+
+def reduced_content(prepared):
+    """The text the LLM and retrieval see, reduced on first use so fast-path emails never pay for it."""
+    if prepared.get('llm_content') is None:
+        prepared['llm_content'] = content_reducer.reduce_content(prepared['content'])
+    return prepared['llm_content']
+
+def classify_prepared(llm, prepared, knowledge_base=None, single_call=SINGLE_CALL_MODE, categorization=None):
+    """Return (category, importance, answer) for a prepared email.
+
+    The fast path wins over a categorization made by the scheduler. With
+    single_call, emails missed by both are classified and answered by one LLM
+    call over the retrieved KB context; answer is None otherwise.
+    """
+    fast = prepared['fast'] or categorization
+    triage = categorize_and_answer(llm, knowledge_base, reduced_content(prepared)) if single_call and not fast and knowledge_base else None
+    if triage:
+        return triage
+    category, _, importance = fast or categorize_email(llm, reduced_content(prepared))
+    return category, importance, None
+
+def handle_prepared(qa_chain, token_path, email_id, prepared, category, importance, answer=None):
+    """Run the category's handler. Returns True once handled, None if the account is unavailable."""
+    conn = storage.get_connection()
+    _, address = get_gmail_service(token_path)
+    if not conn or not address:
+        return None
+    # Replies go through the outbox; the sender thread talks to Gmail
+    return dispatch_prepared(conn, qa_chain, (os.path.basename(token_path), address), email_id, prepared, category,
+                             importance, answer)
+
+def dispatch_prepared(conn, qa_chain, sender, email_id, prepared, category, importance, answer=None, dry_run=False):
+    """Call the process_* handler of the category. With sender None, replies are suppressed (backfill.py).
+
+    dry_run files refunds and questions as unhandled instead of acting on them, so replayed mail never changes
+    order state and makes no QA calls for answers that would not be sent.
+    """
+    subject, sender_email, reply_to, content = prepared['subject'], prepared['sender_email'], prepared['reply_to'], prepared['content']
+    # The reply, pending refund and history rows of the email commit in one transaction
+    with storage.grouped_writes(conn):
+        # Only the QA chain gets the reduced text; everything stored keeps the original
+        if category in ('Question', 'Refund') and dry_run:
+            process_other_email(email_id, subject, content, importance, sender_email, conn, category)
+        elif category == 'Question':
+            query = reduced_content(prepared) if qa_chain and not answer else None
+            process_question_email(qa_chain, email_id, subject, content, sender_email, sender, conn, category, importance,
+                                   answer=answer or None, query=query)
+        elif category == 'Refund':
+            process_refund_email(email_id, subject, content, sender_email, sender, conn, category, reply_to, importance)
+        else:
+            process_other_email(email_id, subject, content, importance, sender_email, conn, category)
+    logger.info(f"Processed email {email_id}: category {category}, reply_to '{reply_to}'")
+    return True
+
+def process_message(llm, qa_chain, token_path, email_id, msg, event, knowledge_base=None, single_call=SINGLE_CALL_MODE,
+                    prepared=None, categorization=None):
+    """Categorize and handle one fetched email outside the pipeline.
+
+    Returns True if it was processed, False if it was skipped and None if it
+    has to be retried. Marking the email as read is left to the caller.
+    """
+    if not event.is_set():
+        return None
+    try:
+        if prepared is None:
+            prepared = prepare_message(storage.get_connection(), msg)
+            if prepared is None:
+                return False
+        category, importance, answer = classify_prepared(llm, prepared, knowledge_base, single_call, categorization)
+        return handle_prepared(qa_chain, token_path, email_id, prepared, category, importance, answer)
+    except Exception as e:
+        logger.error(f"Email process error {email_id}: {e}")
+        return None
+
+def message_record(msg):
+    """The part of a fetched message the parse stage needs, small enough to keep in the pipeline table."""
+    body_text = msg['body_text'] if 'body_text' in msg else mime_body.extract_text(msg['payload'])
+    return {'payload': {'headers': msg['payload']['headers']}, 'body_text': body_text}
+
+def build_pipeline(llm, qa_chain, owner, email_workers=MAX_EMAIL_WORKERS, per_account_limit=MAX_EMAILS_PER_ACCOUNT,
+                   knowledge_base=None, single_call=SINGLE_CALL_MODE, scheduler=None):
+    """Wire the email handlers into the parse, classify, act and ack stages.
+
+    classify and act get email_workers threads each; act runs at most
+    per_account_limit emails of one account at a time. With a scheduler in
+    batch mode, classify takes up to a prompt's worth of emails per batch.
+    """
+    slots = {}
+    slots_lock = threading.Lock()
+
+    def account_slots(account):
+        with slots_lock:
+            return slots.setdefault(account, threading.BoundedSemaphore(per_account_limit))
+
+    def parse(items):
+        conn = storage.get_connection()
+        results = {}
+        for item in items:
+            try:
+                prepared = prepare_message(conn, item.data['msg'])
+            except Exception as e:
+                logger.error(f"Email parse error {item.email_id}: {e}")
+                continue
+            if prepared is not None:
+                item.data = prepared
+            results[item.email_id] = prepared is not None
+        return results
+
+    def classify(items):
+        results, pending = {}, {}
+        for item in items:
+            prepared = item.data
+            if prepared['fast']:
+                prepared['category'], _, prepared['importance'] = prepared['fast']
+                results[item.email_id] = True
+            elif single_call and knowledge_base:
+                category, importance, answer = classify_prepared(llm, prepared, knowledge_base, single_call)
+                prepared.update(category=category, importance=importance, answer=answer)
+                results[item.email_id] = True
+            else:
+                pending[item.email_id] = reduced_content(prepared)
+        if scheduler:
+            categorizations = scheduler.map(lambda content: categorize_email_raw(llm, content),
+                                            lambda contents: categorize_emails_batch(llm, contents),
+                                            pending, CATEGORIZE_FAILED)
+        else:
+            categorizations = {email_id: categorize_email(llm, content) for email_id, content in pending.items()}
+        for item in items:
+            if item.email_id in categorizations:
+                item.data['category'], _, item.data['importance'] = categorizations[item.email_id]
+                results[item.email_id] = True
+        return results
+
+    def act(items):
+        results = {}
+        for item in items:
+            with account_slots(item.account):
+                try:
+                    results[item.email_id] = handle_prepared(qa_chain, os.path.join(TOKEN_DIR, item.account), item.email_id,
+                                                             item.data, item.data['category'], item.data['importance'],
+                                                             item.data.get('answer'))
+                except Exception as e:
+                    logger.error(f"Email process error {item.email_id}: {e}")
+        return results
+
+    def ack(items):
+        # Commit the handlers' buffered writes before Gmail forgets the emails
+        storage.flush()
+        results = {}
+        by_account = {}
+        for item in items:
+            by_account.setdefault(item.account, []).append(item.email_id)
+        for account, email_ids in by_account.items():
+            service, _ = get_gmail_service(os.path.join(TOKEN_DIR, account))
+            if not service:
+                continue
+            with metrics.timer('gmail_request_seconds', op='modify'):
+                failed = set(gmail_batch.batch_remove_labels(service, email_ids, ['UNREAD']))
+            results.update({email_id: True for email_id in email_ids if email_id not in failed})
+        return results
+
+    batch = scheduler.batch_size if scheduler and scheduler.mode == 'batch' and not single_call else 1
+    return pipeline.Pipeline({'parse': parse, 'classify': classify, 'act': act, 'ack': ack}, owner,
+                             workers={'classify': email_workers, 'act': email_workers}, batch_sizes={'classify': batch})
+
+def ingest_account(pipe, token_path, q_filter, event, incremental=INCREMENTAL_SYNC, worker_id=None):
+    """List the new unread emails of one account and submit them to the pipeline.
+
+    Emails are fetched with batch requests (headers first, then only their text
+    part, see mime_body) and claimed in the pipeline table per chunk of
+    gmail_batch.BATCH_SIZE; emails another worker claimed first are skipped. The history checkpoint only moves once every listed
+    email is in the table, so it never skips an email that is not durable yet.
+    Ingestion stops early while the pipeline backlog is full, and, with a
+    worker_id, as soon as the account lease is lost.
+    """
+    service, _ = get_gmail_service(token_path)
+    if not service:
+        return 0
+    account = os.path.basename(token_path)
+    conn = storage.get_connection()
+    checkpoint = None
+    try:
+        with metrics.timer('gmail_request_seconds', op='list'):
+            if incremental:
+                message_ids, checkpoint = gmail_sync.fetch_new_message_ids(service, conn, account, q_filter)
+            else:
+                results = service.users().messages().list(userId='me', labelIds=['INBOX', 'UNREAD'], q=q_filter, maxResults=3).execute()
+                message_ids = [m['id'] for m in results.get('messages', [])]
+    except Exception as e:
+        logger.error(f"Gmail list error for {account}: {e}")
+        return 0
+
+    new_ids = pipe.filter_new(conn, storage.filter_unprocessed(conn, message_ids))
+    complete = True
+    ingested = 0
+    for start in range(0, len(new_ids), gmail_batch.BATCH_SIZE):
+        if not event.is_set():
+            complete = False
+            break
+        if pipe.backlog(conn) >= pipeline.MAX_BACKLOG:
+            logger.info(f"Pipeline backlog full, {account} ingests the rest next cycle")
+            complete = False
+            break
+        if worker_id and not coordination.claim_account(conn, account, worker_id):
+            logger.warning(f"Lease on {account} lost, leaving it to its new owner")
+            complete = False
+            break
+        chunk = new_ids[start:start + gmail_batch.BATCH_SIZE]
+        with metrics.timer('gmail_request_seconds', op='get'):
+            msgs, errors = mime_body.fetch_messages(service, chunk, lambda msg: needs_body(conn, msg))
+        for email_id, error in errors.items():
+            logger.error(f"Email fetch error {email_id}: {error}")
+            complete = False
+        emails = [(email_id, {'msg': message_record(msgs[email_id])}) for email_id in chunk if email_id in msgs]
+        ingested += len(pipe.claim(conn, account, emails))
+    if checkpoint and complete:
+        gmail_sync.save_history_checkpoint(conn, account, checkpoint)
+    return ingested
+
+def outbox_service(account):
+    """Gmail service for an outbox row's account, or None once the account is disconnected."""
+    token_path = os.path.join(TOKEN_DIR, account)
+    if not os.path.exists(token_path):
+        return None
+    return get_gmail_service(token_path)[0]
+
+def monitor_emails(llm, qa_chain, latest_only, event,
+                   account_workers=MAX_ACCOUNT_WORKERS, email_workers=MAX_EMAIL_WORKERS,
+                   per_account_limit=MAX_EMAILS_PER_ACCOUNT, interval=MONITOR_INTERVAL, incremental=INCREMENTAL_SYNC,
+                   knowledge_base=None, single_call=SINGLE_CALL_MODE, categorize_mode=CATEGORIZE_MODE, worker_id=None):
+    """Poll every connected account until the event is cleared.
+
+    Each cycle ingests the new emails of every account into the staged
+    pipeline (see pipeline.py), which processes them in the background. With a
+    worker_id, the worker registers in the DB, reports its heartbeat,
+    processed count and metrics snapshot every REPORT_INTERVAL and only polls
+    the accounts it holds a lease on, so several worker processes can share
+    one DB.
+    """
+    logger.info(f"Monitoring started (accounts: {account_workers}, emails: {email_workers}, per account: {per_account_limit}, "
+                f"sync: {'incremental' if incremental else 'full'}, worker: {worker_id or 'standalone'})")
+    conn = storage.get_connection()
+    if worker_id:
+        coordination.register_worker(conn, worker_id)
+    scheduler = llm_scheduler.LLMScheduler(mode=categorize_mode) if categorize_mode else None
+    sender = outbox.OutboxSender(outbox_service, event).start()
+    account_pool = ThreadPoolExecutor(max_workers=account_workers, thread_name_prefix='account')
+    pipe = build_pipeline(llm, qa_chain, worker_id or coordination.worker_identity(), email_workers, per_account_limit,
+                          knowledge_base, single_call, scheduler)
+    started = time.monotonic()
+    last_completed = 0
+
+    def report():
+        try:
+            pipe.report(conn)
+            if worker_id:
+                coordination.heartbeat(conn, worker_id, pipe.completed, json.dumps(metrics.snapshot()))
+        except Exception as e:
+            logger.error(f"Metrics report failed: {e}")
+
+    try:
+        # Stage writes are buffered and committed with the stage moves that follow them
+        with storage.batched_writes():
+            pipe.start()
+            try:
+                while event.is_set():
+                    try:
+                        q_filter = "is:unread newer_than:1d" if latest_only else "is:unread"
+                        token_files = sorted(f for f in os.listdir(TOKEN_DIR) if f.endswith('.pickle'))
+                        report()
+                        if worker_id:
+                            token_files = coordination.balance_accounts(conn, worker_id, token_files)
+                        pipe.set_accounts(token_files)
+                        if not token_files:
+                            wait_and_report(event, interval, report)
+                            continue
+                        if knowledge_base and knowledge_base_changed():
+                            # The index is updated in place, so no stage may search it meanwhile
+                            with pipe.paused():
+                                refresh_knowledge_base(knowledge_base, qa_chain)
+                        cycle_start = time.monotonic()
+                        ingested = 0
+                        futures = {
+                            account_pool.submit(ingest_account, pipe, os.path.join(TOKEN_DIR, token_file),
+                                                q_filter, event, incremental, worker_id): token_file
+                            for token_file in token_files
+                        }
+                        for future in as_completed(futures):
+                            try:
+                                ingested += future.result()
+                            except Exception as e:
+                                logger.error(f"Account ingest error for {futures[future]}: {e}")
+                        report()
+                        cycle_elapsed = time.monotonic() - cycle_start
+                        total_elapsed = time.monotonic() - started
+                        completed = pipe.completed
+                        total_rate = completed * 60 / total_elapsed if total_elapsed > 0 else 0.0
+                        logger.info(f"Cycle ingested: {ingested} across {len(token_files)} accounts in {cycle_elapsed:.1f}s, "
+                                    f"processed since last cycle: {completed - last_completed} ({total_rate:.1f} emails/min overall), "
+                                    f"backlog {pipe.backlog(conn)}, queues {pipe.depths()}")
+                        last_completed = completed
+                        fast_stats = fast_classifier.get_stats()
+                        logger.info(f"Fast-path classifier: {fast_stats['hits']} hits, {fast_stats['misses']} LLM calls, rules {fast_stats['rules']}")
+                        reducer_stats = content_reducer.get_stats()
+                        logger.info(f"Content reduction: {reducer_stats['tokens_in']} -> {reducer_stats['tokens_out']} tokens "
+                                    f"over {reducer_stats['emails']} emails")
+                        wait_and_report(event, interval, report)
+                    except Exception as e:
+                        logger.error(f"Monitor error: {e}")
+                        wait_and_report(event, interval, report)
+            finally:
+                account_pool.shutdown(wait=True)
+                pipe.stop()
+    finally:
+        sender.join()
+        if worker_id:
+            try:
+                coordination.heartbeat(conn, worker_id, pipe.completed, json.dumps(metrics.snapshot()))
+                coordination.unregister_worker(conn, worker_id)
+            except Exception as e:
+                logger.error(f"Worker unregister failed: {e}")
+        storage.close_connections()
+    logger.info("Monitoring stopped")
@@ -0,0 +1,167 @@
+"""Semantic cache for answers to recurring customer questions.
+
+Answered questions are stored with their embedding. A new question reuses a
+stored answer when their cosine similarity is at or above the threshold.
+Every entry is tagged with the knowledge-base version it was answered from.
+Entries from another version are dropped, as are entries older than the TTL.
+The vectors are kept in an in-memory matrix that is loaded when the KB version
+is set and then updated in place: a new answer takes a free row or, once
+max_entries are cached, the row of the least recently used entry.
+"""
+import logging
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "answer_cache.db"
+SIMILARITY_THRESHOLD = 0.95
+TTL = 7 * 24 * 3600  # seconds
+MAX_ENTRIES = 5000
+INITIAL_ROWS = 64  # matrix rows allocated before the first resize
+NO_ANSWER = "i don’t have enough information"
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    def __init__(self, embeddings, kb_version, cache_file=CACHE_FILE, threshold=SIMILARITY_THRESHOLD,
+                 ttl=TTL, max_entries=MAX_ENTRIES):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    question TEXT,
+                    answer TEXT,
+                    vector BLOB,
+                    kb_version TEXT,
+                    created_at REAL,
+                    last_used REAL
+                )
+            """)
+        self.set_kb_version(kb_version)
+
+    def set_kb_version(self, kb_version):
+        """Switch to a new KB version, dropping entries answered from any other one."""
+        with self._lock:
+            self.kb_version = kb_version
+            with self._conn:
+                deleted = self._conn.execute("DELETE FROM answers WHERE kb_version != ? OR created_at < ?",
+                                             (kb_version, time.time() - self.ttl)).rowcount
+                deleted += self._conn.execute("""
+                    DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT ?)
+                """, (self.max_entries,)).rowcount
+            if deleted:
+                logger.info(f"Answer cache invalidated {deleted} entries")
+            self._load()
+
+    def _load(self):
+        rows = self._conn.execute("SELECT id, answer, vector, created_at, last_used FROM answers ORDER BY id").fetchall()
+        self._ids = [row[0] for row in rows]
+        self._answers = [row[1] for row in rows]
+        self._created = [row[3] for row in rows]
+        self._last_used = [row[4] for row in rows]
+        self._size = len(rows)
+        if rows:
+            self._matrix = np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+        else:
+            self._matrix = None
+
+    def _append(self, vector):
+        """Row index for a new entry, growing the matrix by doubling (up to max_entries rows)."""
+        if self._matrix is None:
+            self._matrix = np.empty((min(INITIAL_ROWS, self.max_entries), len(vector)), dtype=np.float32)
+        elif self._size == len(self._matrix):
+            grown = np.empty((min(2 * len(self._matrix), self.max_entries), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        self._size += 1
+        for column in (self._ids, self._answers, self._created, self._last_used):
+            column.append(None)
+        return self._size - 1
+
+    def lookup(self, question):
+        """Return a cached answer for a similar question, or None."""
+        vector = _normalize(self.embeddings.embed_query(question))
+        with self._lock:
+            if not self._size:
+                self.misses += 1
+                return None
+            scores = self._matrix[:self._size] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold or self._created[best] < time.time() - self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._last_used[best] = time.time()
+            with self._conn:
+                self._conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (self._last_used[best], self._ids[best]))
+            return self._answers[best]
+
+    def store(self, question, answer):
+        if not answer or NO_ANSWER in answer.lower():
+            return
+        vector = _normalize(self.embeddings.embed_query(question))
+        now = time.time()
+        with self._lock:
+            # Full: the least recently used entry gives up its row
+            row = min(range(self._size), key=self._last_used.__getitem__) if self._size >= self.max_entries else None
+            with self._conn:
+                if row is not None:
+                    self._conn.execute("DELETE FROM answers WHERE id = ?", (self._ids[row],))
+                entry_id = self._conn.execute("""
+                    INSERT INTO answers (question, answer, vector, kb_version, created_at, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (question, answer, vector.tobytes(), self.kb_version, now, now)).lastrowid
+            if row is None:
+                row = self._append(vector)
+            self._matrix[row] = vector
+            self._ids[row], self._answers[row], self._created[row], self._last_used[row] = entry_id, answer, now, now
+
+
+class CachedQA:
+    """Wraps a RetrievalQA chain so similar questions are answered from the cache."""
+
+    def __init__(self, qa_chain, cache):
+        self.qa_chain = qa_chain
+        self.cache = cache
+
+    def set_kb_version(self, kb_version):
+        self.cache.set_kb_version(kb_version)
+
+    def invoke(self, inputs):
+        question = inputs["query"]
+        try:
+            answer = self.cache.lookup(question)
+        except Exception as e:
+            logger.error(f"Answer cache lookup failed: {e}")
+            answer = None
+        metrics.inc('answer_cache_total', result='miss' if answer is None else 'hit')
+        if answer is not None:
+            return {"query": question, "result": answer, "cached": True}
+        # Only a miss is an LLM call
+        with metrics.llm_call('qa'):
+            result = self.qa_chain.invoke(inputs)
+        try:
+            self.cache.store(question, result["result"])
+        except Exception as e:
+            logger.error(f"Answer cache store failed: {e}")
+        return result
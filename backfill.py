@@ -0,0 +1,305 @@
+"""Bulk backfill of historical mail from an mbox file or a directory of .eml files.
+
+Messages are streamed from the archive in chunks and go through the same
+parsing, fast path, categorize_email and process_* handlers as live mail,
+with replies suppressed: nothing is queued in the outbox. Refund requests and
+questions are filed as unhandled for review instead of being acted on, so old
+mail never changes the state of live orders, opens pending refunds or spends
+QA calls on answers nobody receives. Within a chunk, categorization runs
+through the LLMScheduler (concurrent single calls or batch prompts, within the
+rate limits) and the handlers on a thread pool. Each
+chunk's results and the archive position after it commit in one
+transaction, so an interrupted run resumes after the last committed chunk.
+Messages already in processed_emails_full are skipped.
+
+Memory stays flat: one chunk of parsed messages is held at a time and a raw
+message is read up to MAX_MESSAGE_BYTES. A directory only keeps the sorted
+list of its .eml file names.
+
+Usage: python backfill.py archive.mbox|eml_dir [--chunk-size 200] [--llm-concurrency 16] [--restart]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email import policy
+from email.parser import BytesParser
+from itertools import islice
+
+import agent
+import kb_search
+import llm_scheduler
+import metrics
+import mime_body
+import storage
+import worker
+
+logger = logging.getLogger("backfill")
+
+CHUNK_SIZE = 200  # messages parsed, classified and committed together
+EMAIL_WORKERS = 16  # handler threads; with --single-call they make the LLM calls
+LLM_CONCURRENCY = 16  # concurrent categorization calls
+MAX_MESSAGE_BYTES = 10 * 1024 * 1024  # raw bytes read per message; the rest is dropped
+
+SQL_SAVE_POSITION = """
+    INSERT INTO backfill_state (source, position, processed, updated_at) VALUES (?, ?, ?, ?)
+    ON CONFLICT(source) DO UPDATE SET
+        position = excluded.position, processed = processed + excluded.processed, updated_at = excluded.updated_at
+"""
+
+
+# Archives
+def iter_mbox(path, start=0, max_bytes=MAX_MESSAGE_BYTES):
+    """Yield (offset after the message, raw bytes) for each message of an mbox file from byte offset start."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        lines, size, seen = [], 0, False
+        previous_blank = True
+        for line in f:
+            if previous_blank and line.startswith(b'From '):
+                if seen:
+                    yield offset, b''.join(lines)
+                lines, size, seen = [], 0, True
+            else:
+                seen = True
+                # mboxrd quoting: '>From ' in a body is stored with one more '>'
+                if line.startswith(b'>') and line.lstrip(b'>').startswith(b'From '):
+                    line_data = line[1:]
+                else:
+                    line_data = line
+                if size < max_bytes:
+                    lines.append(line_data)
+                    size += len(line_data)
+            offset += len(line)
+            previous_blank = not line.strip()
+        if seen and lines:
+            yield offset, b''.join(lines)
+
+
+def iter_eml_dir(path, after=None, max_bytes=MAX_MESSAGE_BYTES):
+    """Yield (relative path, raw bytes) for the .eml files under path in sorted order, after the given one."""
+    names = []
+    for root, _, files in os.walk(path):
+        names.extend(os.path.relpath(os.path.join(root, name), path) for name in files if name.lower().endswith('.eml'))
+    names.sort()
+    for name in names:
+        if after is not None and name <= after:
+            continue
+        with open(os.path.join(path, name), 'rb') as f:
+            yield name, f.read(max_bytes)
+
+
+def iter_archive(path, position=None):
+    if os.path.isdir(path):
+        return iter_eml_dir(path, position)
+    return iter_mbox(path, int(position or 0))
+
+
+def message_text(message):
+    """Text of a parsed email: the first text/plain part, else text/html converted like mime_body does."""
+    plain = html = None
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_disposition() == 'attachment' or part.get_filename():
+            continue
+        content_type = part.get_content_type()
+        if content_type == 'text/plain' and plain is None:
+            plain = part
+        elif content_type == 'text/html' and html is None:
+            html = part
+    part = plain or html
+    if part is None:
+        return ''
+    data = (part.get_payload(decode=True) or b'')[:mime_body.MAX_BODY_BYTES]
+    try:
+        text = data.decode(part.get_content_charset() or 'utf-8', errors='ignore')
+    except LookupError:
+        text = data.decode('utf-8', errors='ignore')
+    if part is html:
+        return mime_body.html_to_text(text)
+    return text[:mime_body.MAX_BODY_CHARS]
+
+
+def archive_message(raw):
+    """(email_id, msg) for a raw message, msg shaped like agent.message_record. email_id is the Message-ID."""
+    message = BytesParser(policy=policy.default).parsebytes(raw)
+    headers = []
+    for name in mime_body.METADATA_HEADERS:
+        try:
+            value = message.get(name)
+        except Exception:
+            value = None
+        if value is not None:
+            headers.append({'name': name, 'value': str(value)})
+    message_id = next((h['value'] for h in headers if h['name'] == 'Message-Id'), '').strip().strip('<>')
+    email_id = message_id or f"sha1-{hashlib.sha1(raw).hexdigest()}"
+    return email_id, {'payload': {'headers': headers}, 'body_text': message_text(message)}
+
+
+# Processing
+def get_position(conn, source):
+    row = conn.execute("SELECT position, processed FROM backfill_state WHERE source = ?", (source,)).fetchone()
+    return (row['position'], row['processed']) if row else (None, 0)
+
+
+def clear_position(conn, source):
+    with conn:
+        conn.execute("DELETE FROM backfill_state WHERE source = ?", (source,))
+
+
+def process_chunk(llm, qa_chain, records, pool, scheduler=None, knowledge_base=None, single_call=False):
+    """Parse, classify and file one chunk of (email_id, msg). Returns {'processed'|'skipped'|'failed': count}."""
+    conn = storage.get_connection()
+    stats = {'processed': 0, 'skipped': 0, 'failed': 0}
+    unique = dict(records)
+    new_ids = set(storage.filter_unprocessed(conn, list(unique)))
+    stats['skipped'] += len(records) - len(new_ids)
+    prepared = {}
+    for email_id in [email_id for email_id in unique if email_id in new_ids]:
+        try:
+            result = agent.prepare_message(conn, unique[email_id])
+        except Exception as e:
+            logger.error(f"Email parse error {email_id}: {e}")
+            stats['failed'] += 1
+            continue
+        if result is None:
+            stats['skipped'] += 1
+        else:
+            prepared[email_id] = result
+
+    classified, pending = {}, {}
+    for email_id, item in prepared.items():
+        if item['fast']:
+            classified[email_id] = (item['fast'][0], item['fast'][2], None)
+        elif not (single_call and knowledge_base):
+            pending[email_id] = agent.reduced_content(item)
+    if single_call and knowledge_base:
+        remaining = [email_id for email_id in prepared if email_id not in classified]
+        for email_id, result in zip(remaining, pool.map(
+                lambda email_id: agent.classify_prepared(llm, prepared[email_id], knowledge_base, single_call), remaining)):
+            classified[email_id] = result
+    if scheduler:
+        categorizations = scheduler.map(lambda content: agent.categorize_email_raw(llm, content),
+                                        lambda contents: agent.categorize_emails_batch(llm, contents),
+                                        pending, agent.CATEGORIZE_FAILED)
+    else:
+        categorizations = dict(zip(pending, pool.map(lambda content: agent.categorize_email(llm, content),
+                                                     pending.values())))
+    for email_id, (category, _, importance) in categorizations.items():
+        classified[email_id] = (category, importance, None)
+
+    def handle(email_id):
+        category, importance, answer = classified[email_id]
+        with metrics.tracing(email_id):
+            try:
+                return agent.dispatch_prepared(storage.get_connection(), qa_chain, None, email_id, prepared[email_id],
+                                               category, importance, answer, dry_run=True)
+            except Exception as e:
+                logger.error(f"Email process error {email_id}: {e}")
+                return False
+
+    for handled in pool.map(handle, list(classified)):
+        stats['processed' if handled else 'failed'] += 1
+    return stats
+
+
+def backfill(llm, qa_chain, path, event, chunk_size=CHUNK_SIZE, email_workers=EMAIL_WORKERS,
+             categorize_mode=agent.CATEGORIZE_MODE, llm_concurrency=LLM_CONCURRENCY, knowledge_base=None,
+             single_call=False, restart=False, limit=None):
+    """File every message of the archive at path, resuming from its saved position. Returns the totals of this run."""
+    source = os.path.abspath(path)
+    conn = storage.get_connection()
+    if restart:
+        clear_position(conn, source)
+    position, done_before = get_position(conn, source)
+    if position is not None:
+        logger.info(f"Resuming {source} at {position} ({done_before} emails filed before)")
+    scheduler = llm_scheduler.LLMScheduler(mode=categorize_mode, max_concurrency=llm_concurrency) if categorize_mode else None
+    totals = {'processed': 0, 'skipped': 0, 'failed': 0}
+    started = time.monotonic()
+    messages = iter_archive(path, position)
+    if limit:
+        messages = islice(messages, limit)
+    with storage.batched_writes(), ThreadPoolExecutor(max_workers=email_workers, thread_name_prefix='backfill') as pool:
+        while event.is_set():
+            records, chunk_position = [], None
+            for chunk_position, raw in islice(messages, chunk_size):
+                try:
+                    records.append(archive_message(raw))
+                except Exception as e:
+                    logger.error(f"Unreadable message before {chunk_position}: {e}")
+                    totals['failed'] += 1
+            if chunk_position is None:
+                break
+            stats = process_chunk(llm, qa_chain, records, pool, scheduler, knowledge_base, single_call)
+            for key, count in stats.items():
+                totals[key] += count
+            # The position commits with the chunk's results
+            storage.write(conn, SQL_SAVE_POSITION, (source, str(chunk_position), stats['processed'], datetime.now().isoformat()))
+            storage.flush()
+            elapsed = time.monotonic() - started
+            logger.info(f"Backfill at {chunk_position}: {totals['processed']} filed, {totals['skipped']} skipped, "
+                        f"{totals['failed']} failed ({totals['processed'] / elapsed if elapsed else 0.0:.1f} emails/s)")
+    if not event.is_set():
+        logger.info(f"Backfill of {source} interrupted; run it again to resume")
+    return totals
+
+
+def run_backfill(options):
+    worker.configure_logging(options['log_file'])
+    if not os.environ.get("OPENAI_API_KEY", "").strip():
+        logger.error("OPENAI_API_KEY is not set")
+        return 1
+    if not os.path.exists(options['path']):
+        logger.error(f"{options['path']} not found")
+        return 1
+    event = threading.Event()
+    event.set()
+    worker.install_signal_handlers(event)
+    conn = storage.connect()
+    if not conn:
+        return 1
+    storage.init_db(conn)
+    conn.close()
+    llm, _, knowledge_base, qa_chain = agent.init_rag_components(retrieval=options['retrieval'])
+    try:
+        totals = backfill(llm, qa_chain, options['path'], event, chunk_size=options['chunk_size'],
+                          email_workers=options['email_workers'], categorize_mode=options['categorize_mode'],
+                          llm_concurrency=options['llm_concurrency'], knowledge_base=knowledge_base,
+                          single_call=options['single_call'] and knowledge_base is not None, restart=options['restart'],
+                          limit=options['limit'])
+    finally:
+        storage.close_connections()
+    logger.info(f"Backfill done: {totals['processed']} filed, {totals['skipped']} skipped, {totals['failed']} failed")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="File historical mail from an mbox file or a directory of .eml files")
+    parser.add_argument("path", help="mbox file or directory of .eml files")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="messages committed together")
+    parser.add_argument("--email-workers", type=int, default=EMAIL_WORKERS, help="handler threads")
+    parser.add_argument("--llm-concurrency", type=int, default=LLM_CONCURRENCY, help="concurrent categorization calls")
+    parser.add_argument("--categorize-mode", choices=["concurrent", "batch", "inline"], default=agent.CATEGORIZE_MODE or "inline")
+    parser.add_argument("--single-call", action="store_true", help="classify and answer questions with one LLM call")
+    parser.add_argument("--retrieval", choices=kb_search.MODES, default=kb_search.DEFAULT_MODE, help="knowledge base search")
+    parser.add_argument("--limit", type=int, help="stop after this many messages")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved position and start from the beginning")
+    parser.add_argument("--log-file", default="backfill.log")
+    options = vars(parser.parse_args(argv))
+    if options['categorize_mode'] == 'inline':
+        options['categorize_mode'] = None
+    return options
+
+
+def main(argv=None):
+    return run_backfill(parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
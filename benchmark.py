@@ -0,0 +1,609 @@
+"""Offline throughput benchmark.
+
+Replays synthetic mailboxes built from test_emails.txt through the agent
+without Gmail or OpenAI. The fakes are an in-process Gmail service
+(list/get/send/modify/history and batch requests), a chat model with
+configurable latency, and deterministic bag-of-words embeddings. Two runs are
+available:
+
+- pipeline: agent.monitor_emails end to end. That covers ingestion with
+  history sync, the pipeline stages, the outbox sender and the customer
+  follow-ups of refund threads.
+- handlers: agent.process_message, which runs the process_* handlers, on a
+  thread pool.
+
+Each run happens in its own process and scratch directory, so support.db and
+the caches of the real setup are never touched. The report has emails/sec,
+p50/p99 latency per stage and call type (from the metrics histograms' raw
+samples), LLM usage and peak memory. It is saved as JSON; --compare prints
+the change against an earlier result.
+
+Usage: python benchmark.py [--accounts 4] [--emails 50] [--llm-latency 0.2] [--runs pipeline handlers]
+                           [--output benchmark.json] [--compare old.json]
+"""
+import argparse
+import base64
+import email
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+
+logger = logging.getLogger("benchmark")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEST_EMAILS_FILE = os.path.join(ROOT, "test_emails.txt")
+KB_FILE = os.path.join(ROOT, "rag_knowledge_base.txt")
+RUNS = ('pipeline', 'handlers')
+RUN_TIMEOUT = 600  # seconds before a run is reported as incomplete
+EMBEDDING_DIM = 256
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+# Mailboxes
+def load_scenarios(path=TEST_EMAILS_FILE):
+    """[(subject, body, follow_ups)] from the CUSTOMER blocks of test_emails.txt.
+
+    follow_ups are the later 'CUSTOMER: ...' lines, sent as replies to the agent's answers.
+    """
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    scenarios = []
+    for block in re.split(r'^\d+\.[^\n]*$', text, flags=re.MULTILINE)[1:]:
+        subject = re.search(r'^Subject:\s*(.*)$', block, re.MULTILINE)
+        body = re.search(r'^Body:\s*(.*)$', block, re.MULTILINE)
+        if subject and body and body.group(1).strip():
+            follow_ups = [line.strip() for line in re.findall(r'^CUSTOMER:\s*(.+)$', block, re.MULTILINE)]
+            scenarios.append((subject.group(1).strip(), body.group(1).strip(), follow_ups))
+    return scenarios
+
+
+class _Request:
+    def __init__(self, service, fn):
+        self.service = service
+        self.fn = fn
+
+    def execute(self, http=None, num_retries=0):
+        self.service.wait()
+        return self.fn()
+
+
+class _Batch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # One round trip for the whole batch
+        self.service.wait()
+        for request_id, request in self.requests:
+            try:
+                response = request.fn()
+            except Exception as e:
+                self.callback(request_id, None, e)
+            else:
+                self.callback(request_id, response, None)
+
+
+class _Messages:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, labelIds=None, q=None, maxResults=100, pageToken=None, **kwargs):
+        return _Request(self.service, lambda: self.service.list_messages(labelIds, q, maxResults, pageToken))
+
+    def get(self, userId, id, format='full', **kwargs):
+        return _Request(self.service, lambda: self.service.get_message(id, format))
+
+    def send(self, userId, body):
+        return _Request(self.service, lambda: self.service.send_message(body['raw']))
+
+    def modify(self, userId, id, body):
+        return _Request(self.service, lambda: self.service.remove_labels([id], body.get('removeLabelIds', [])))
+
+    def batchModify(self, userId, body):
+        return _Request(self.service, lambda: self.service.remove_labels(body['ids'], body.get('removeLabelIds', [])))
+
+    def attachments(self):
+        return _Attachments(self.service)
+
+
+class _Attachments:
+    # Fake message bodies are always inline, so every attachment is empty
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, messageId, id, **kwargs):
+        return _Request(self.service, lambda: {'attachmentId': id, 'size': 0, 'data': ''})
+
+
+class _History:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, pageToken=None, **kwargs):
+        return _Request(self.service, lambda: self.service.list_history(int(startHistoryId)))
+
+
+class FakeGmail:
+    """Thread-safe in-memory mailbox exposing the part of the Gmail API the agent calls.
+
+    Every request, and every batch as a whole, costs `latency` seconds. A reply
+    to an email with queued follow-ups delivers the next follow-up, with
+    In-Reply-To set to the reply's Message-ID like a real customer reply.
+    """
+
+    def __init__(self, address, latency=0.0):
+        self.address = address
+        self.latency = latency
+        self.calls = Counter()
+        self.sent = []
+        self._messages = {}
+        self._history = []
+        self._history_id = 1
+        self._follow_ups = {}
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Call chain
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId):
+        return _Request(self, lambda: {'emailAddress': self.address, 'historyId': str(self._history_id)})
+
+    def new_batch_http_request(self, callback=None):
+        self.calls['batch'] += 1
+        return _Batch(self, callback)
+
+    # Mailbox
+    def deliver(self, message_id, subject, body, sender, in_reply_to=None, follow_ups=()):
+        headers = [{'name': 'Subject', 'value': subject}, {'name': 'From', 'value': sender},
+                   {'name': 'To', 'value': self.address}, {'name': 'Message-ID', 'value': f"<{message_id}@example.com>"}]
+        if in_reply_to:
+            headers.append({'name': 'In-Reply-To', 'value': in_reply_to})
+        with self._lock:
+            self._history_id += 1
+            self._messages[message_id] = {
+                'id': message_id, 'threadId': message_id, 'labelIds': ['INBOX', 'UNREAD'], 'snippet': body[:100],
+                'payload': {'mimeType': 'text/plain', 'headers': headers,
+                            'body': {'size': len(body), 'data': base64.urlsafe_b64encode(body.encode()).decode()}},
+            }
+            self._history.append((self._history_id, message_id))
+            if follow_ups:
+                self._follow_ups[message_id] = (subject, sender, list(follow_ups))
+
+    def unread(self):
+        with self._lock:
+            return sum(1 for m in self._messages.values() if 'UNREAD' in m['labelIds'] and 'INBOX' in m['labelIds'])
+
+    def list_messages(self, label_ids, q, max_results, page_token):
+        self.calls['list'] += 1
+        with self._lock:
+            if q and q.startswith('rfc822msgid:'):
+                wanted = f"<{q.split(':', 1)[1]}>"
+                ids = [message_id for message_id, raw in self.sent if raw['Message-ID'] == wanted]
+            else:
+                ids = [m['id'] for m in self._messages.values() if all(l in m['labelIds'] for l in label_ids or [])]
+        start = int(page_token or 0)
+        result = {'messages': [{'id': message_id} for message_id in ids[start:start + max_results]]}
+        if start + max_results < len(ids):
+            result['nextPageToken'] = str(start + max_results)
+        return result
+
+    def get_message(self, message_id, format):
+        self.calls['get'] += 1
+        with self._lock:
+            msg = json.loads(json.dumps(self._messages[message_id]))
+        if format == 'metadata':
+            del msg['payload']['body']
+        return msg
+
+    def list_history(self, start_history_id):
+        self.calls['history'] += 1
+        with self._lock:
+            records = [{'id': str(history_id), 'messagesAdded': [{'message': {
+                'id': message_id, 'labelIds': list(self._messages[message_id]['labelIds'])}}]}
+                for history_id, message_id in self._history if history_id > start_history_id]
+            return {'history': records, 'historyId': str(self._history_id)}
+
+    def remove_labels(self, message_ids, label_ids):
+        self.calls['modify'] += 1
+        with self._lock:
+            for message_id in message_ids:
+                labels = self._messages[message_id]['labelIds']
+                labels[:] = [l for l in labels if l not in label_ids]
+        return {}
+
+    def send_message(self, raw):
+        self.calls['send'] += 1
+        reply = email.message_from_bytes(base64.urlsafe_b64decode(raw))
+        with self._lock:
+            sent_id = f"sent-{len(self.sent)}"
+            self.sent.append((sent_id, reply))
+            thread = self._follow_ups.get(reply['In-Reply-To'])
+        if thread and thread[2]:
+            subject, sender, follow_ups = thread
+            follow_up_id = f"{reply['In-Reply-To']}-f{len(follow_ups)}"
+            self.deliver(follow_up_id, f"Re: {subject}", follow_ups[0], sender,
+                         in_reply_to=reply['Message-ID'], follow_ups=follow_ups[1:])
+        return {'id': sent_id}
+
+
+def build_mailboxes(scenarios, accounts, emails, latency, prefix):
+    """{token file: FakeGmail} with `emails` messages each, cycling through the scenarios."""
+    services = {}
+    for a in range(accounts):
+        service = FakeGmail(f"support{a}@example.com", latency)
+        for i in range(emails):
+            subject, body, follow_ups = scenarios[i % len(scenarios)]
+            service.deliver(f"{prefix}{a}-{i}", f"{subject} #{i}", body, f"Customer {i} <customer{i}@example.net>",
+                            follow_ups=follow_ups)
+        services[f"account{a}.pickle"] = service
+    return services
+
+
+# LLM and embeddings
+def _words(text):
+    return WORD_RE.findall(text.lower())
+
+
+def classify_text(text):
+    """Keyword rules standing in for the model, following the categorization prompt."""
+    low = text.lower()
+    if re.search(r'refund|return|order id', low):
+        return 'Refund', 'high'
+    if '?' in text or re.search(r'\b(how|what|can you|could you|is there)\b', low):
+        return 'Question', 'medium'
+    return 'Other', 'low'
+
+
+def _between(text, start, end=None):
+    head = text.split(start, 1)[-1]
+    return head.split(end, 1)[0] if end and end in head else head
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model that answers the agent's prompts after `latency` seconds.
+
+    It reports token usage like ChatOpenAI, so get_openai_callback and the
+    metrics count tokens and cost as for o4-mini.
+    """
+    latency: float = 0.2
+    model_name: str = "o4-mini"
+
+    @property
+    def _llm_type(self):
+        return "benchmark-fake"
+
+    def respond(self, prompt):
+        if "For a 'Question', answer it" in prompt:
+            content = _between(prompt, "Email content:")
+            category, importance = classify_text(content)
+            answer = self.answer(_between(prompt, "Context:", "Email content:"), content) if category == 'Question' else ""
+            return json.dumps({'category': category, 'importance': importance, 'answer': answer})
+        if "### Email " in prompt:
+            blocks = re.split(r'^\s*### Email (\d+)\s*$', _between(prompt, "Provide an importance level", "Response format"),
+                              flags=re.MULTILINE)
+            replies = []
+            for number, content in zip(blocks[1::2], blocks[2::2]):
+                category, importance = classify_text(content)
+                replies.append(f"Email: {number}\nCategory: {category}\nImportance: {importance}")
+            return "\n\n".join(replies)
+        if "Email content:" in prompt:
+            category, importance = classify_text(_between(prompt, "Email content:", "Response format:"))
+            return f"Category: {category}\nExplanation: keyword match\nImportance: {importance}"
+        if "Question:" in prompt and "Context:" in prompt:
+            return self.answer(_between(prompt, "Context:", "Question:"), _between(prompt, "Question:", "Answer:"))
+        return "I don’t have enough information"
+
+    def answer(self, context, question):
+        shared = {w for w in _words(question) if len(w) > 3} & set(_words(context))
+        if len(shared) < 2:
+            return "I don’t have enough information"
+        return " ".join(context.split()[:60])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        if self.latency:
+            time.sleep(self.latency)
+        text = self.respond(prompt)
+        usage = {'prompt_tokens': len(prompt) // 4 + 1, 'completion_tokens': len(text) // 4 + 1}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))],
+                          llm_output={'token_usage': usage, 'model_name': self.model_name})
+
+    def with_structured_output(self, schema, **kwargs):
+        return RunnableLambda(lambda prompt: json.loads(self.invoke(prompt).content))
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors: equal texts embed equally, texts sharing words are close."""
+
+    def __init__(self, latency=0.05, dim=EMBEDDING_DIM):
+        self.latency = latency
+        self.dim = dim
+        self.model = "benchmark-fake"
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for word in _words(text):
+            vector[int(hashlib.md5(word.encode()).hexdigest()[:8], 16) % self.dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+# Runs
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def summarize_samples(samples):
+    """{'name{label=value,...}': count, mean, p50 and p99 in ms} from {(name, sorted label pairs): [seconds]}."""
+    summary = {}
+    for (name, labels), values in sorted(samples.items()):
+        key = name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        summary[key] = {'count': len(values), 'mean_ms': round(sum(values) / len(values) * 1000, 2),
+                        'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                        'p99_ms': round(percentile(values, 0.99) * 1000, 2)}
+    return summary
+
+
+def _prepare_workdir(workdir, services):
+    os.chdir(workdir)
+    shutil.copy(KB_FILE, "rag_knowledge_base.txt")
+    os.makedirs("tokens", exist_ok=True)
+    for token_file in services:
+        open(os.path.join("tokens", token_file), 'w').close()
+
+
+def _outcomes(storage):
+    conn = storage.connect()
+    try:
+        counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                  for table in ('processed_emails_full', 'unhandled_emails', 'not_found_refunds', 'outbox')}
+        counts['pipeline_left'] = conn.execute("SELECT COUNT(*) FROM pipeline").fetchone()[0]
+        counts['outbox_unsent'] = conn.execute("SELECT COUNT(*) FROM outbox WHERE status != 'sent'").fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+
+
+def run_pipeline(agent, storage, coordination, options, services):
+    """monitor_emails over the fake accounts until every email, follow-up and reply is through."""
+    llm, _, knowledge_base, qa_chain = agent.init_rag_components(FakeChatModel(latency=options['llm_latency']),
+                                                              FakeEmbeddings(options['embedding_latency']),
+                                                              options['retrieval'])
+    event = threading.Event()
+    event.set()
+    monitor = threading.Thread(target=agent.monitor_emails, args=(llm, qa_chain, False, event), kwargs=dict(
+        account_workers=options['account_workers'], email_workers=options['email_workers'],
+        per_account_limit=options['per_account'], interval=options['interval'], incremental=True,
+        knowledge_base=knowledge_base, single_call=options['single_call'] and knowledge_base is not None,
+        categorize_mode=options['categorize_mode'], worker_id=coordination.worker_identity()))
+    conn = storage.connect()
+    start = time.perf_counter()
+    monitor.start()
+    complete = False
+    while time.perf_counter() - start < RUN_TIMEOUT:
+        time.sleep(0.1)
+        if any(service.unread() for service in services.values()):
+            continue
+        outstanding = conn.execute("SELECT (SELECT COUNT(*) FROM pipeline) + "
+                                   "(SELECT COUNT(*) FROM outbox WHERE status != 'sent')").fetchone()[0]
+        if not outstanding and not any(service.unread() for service in services.values()):
+            complete = True
+            break
+    elapsed = time.perf_counter() - start
+    event.clear()
+    monitor.join()
+    conn.close()
+    return elapsed, complete
+
+
+def run_handlers(agent, storage, coordination, options, services):
+    """agent.process_message for every fetched email on a thread pool, without the pipeline."""
+    llm, _, knowledge_base, qa_chain = agent.init_rag_components(FakeChatModel(latency=options['llm_latency']),
+                                                              FakeEmbeddings(options['embedding_latency']),
+                                                              options['retrieval'])
+    import metrics
+    event = threading.Event()
+    event.set()
+    jobs = []
+    for token_file, service in services.items():
+        ids = [m['id'] for m in service.list_messages(['INBOX', 'UNREAD'], None, 10 ** 9, None)['messages']]
+        jobs.extend((token_file, message_id, service.get_message(message_id, 'full')) for message_id in ids)
+
+    def handle(job):
+        token_file, message_id, msg = job
+        with metrics.tracing(message_id), metrics.timer('pipeline_stage_seconds', stage='handler'):
+            return agent.process_message(llm, qa_chain, os.path.join("tokens", token_file), message_id, msg, event,
+                                         knowledge_base, options['single_call'] and knowledge_base is not None)
+
+    start = time.perf_counter()
+    with storage.batched_writes():
+        with ThreadPoolExecutor(max_workers=options['email_workers']) as pool:
+            results = list(pool.map(handle, jobs))
+    elapsed = time.perf_counter() - start
+    storage.close_connections()
+    return elapsed, all(results)
+
+
+def run(name, options, scenarios):
+    """One benchmark run in a fresh process and scratch directory. Returns its report."""
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(name)s - %(message)s')
+    workdir = tempfile.mkdtemp(prefix=f"benchmark-{name}-")
+    if options['trace_memory']:
+        tracemalloc.start()
+    services = build_mailboxes(scenarios, options['accounts'], options['emails'], options['gmail_latency'], f"{name}-")
+    # The caches and support.db use relative paths, so move before the agent modules are imported
+    _prepare_workdir(workdir, services)
+    sys.path.insert(0, ROOT)
+    import agent
+    import coordination
+    import metrics
+    import storage
+    samples = defaultdict(list)
+    metrics.add_observer(lambda metric, labels, value: samples[(metric, tuple(sorted(labels.items())))].append(value))
+    agent.get_gmail_service = lambda token_path: (services[os.path.basename(token_path)],
+                                                  services[os.path.basename(token_path)].address)
+    try:
+        conn = storage.connect()
+        storage.init_db(conn)
+        conn.close()
+        runner = run_pipeline if name == 'pipeline' else run_handlers
+        elapsed, complete = runner(agent, storage, coordination, options, services)
+        outcomes = _outcomes(storage)
+    finally:
+        os.chdir(ROOT)
+        if not options['keep']:
+            shutil.rmtree(workdir, ignore_errors=True)
+    processed = outcomes['processed_emails_full']
+    snapshot = metrics.merge([metrics.snapshot()])
+    llm = {'prompt_tokens': 0, 'completion_tokens': 0, 'cost_usd': 0.0}
+    for (metric, labels), value in snapshot['counters'].items():
+        if metric == 'llm_tokens_total':
+            llm[f"{dict(labels)['kind']}_tokens"] += value
+        elif metric == 'llm_cost_usd_total':
+            llm['cost_usd'] = round(llm['cost_usd'] + value, 6)
+    llm['calls'] = sum(len(v) for (metric, _), v in samples.items() if metric == 'llm_request_seconds')
+    memory = {'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    if options['trace_memory']:
+        memory['python_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+    gmail_calls = Counter()
+    for service in services.values():
+        gmail_calls.update(service.calls)
+    return {
+        'complete': complete,
+        'emails': processed,
+        'elapsed_s': round(elapsed, 3),
+        'emails_per_sec': round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+        'latency': summarize_samples(samples),
+        'llm': llm,
+        'gmail_calls': dict(gmail_calls),
+        'memory': memory,
+        'outcomes': outcomes,
+    }
+
+
+def _run_in_process(args):
+    name, options, scenarios = args
+    return run(name, options, scenarios)
+
+
+def compare(previous, current, threshold=0.05):
+    """Lines describing changes of more than threshold between two results."""
+    lines = []
+    for name, report in current['runs'].items():
+        old = previous.get('runs', {}).get(name)
+        if not old:
+            continue
+        lines.append(f"{name}: {old['emails_per_sec']} -> {report['emails_per_sec']} emails/sec "
+                     f"({_change(old['emails_per_sec'], report['emails_per_sec'])})")
+        for key, stats in report['latency'].items():
+            before = old['latency'].get(key)
+            if before and before['p99_ms'] and abs(stats['p99_ms'] - before['p99_ms']) / before['p99_ms'] > threshold:
+                lines.append(f"  {key} p99: {before['p99_ms']} -> {stats['p99_ms']} ms "
+                             f"({_change(before['p99_ms'], stats['p99_ms'])})")
+        lines.append(f"  max RSS: {old['memory']['max_rss_mb']} -> {report['memory']['max_rss_mb']} MB")
+    return lines
+
+
+def _change(before, after):
+    return f"{(after - before) / before:+.1%}" if before else "n/a"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark with fake Gmail, LLM and embeddings")
+    parser.add_argument("--runs", nargs="+", choices=RUNS, default=list(RUNS))
+    parser.add_argument("--accounts", type=int, default=4, help="synthetic mailboxes")
+    parser.add_argument("--emails", type=int, default=50, help="emails per mailbox")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per LLM call")
+    parser.add_argument("--embedding-latency", type=float, default=0.05, help="seconds per embedding call")
+    parser.add_argument("--gmail-latency", type=float, default=0.02, help="seconds per Gmail request or batch")
+    parser.add_argument("--categorize-mode", choices=["concurrent", "batch", "inline"], default="concurrent")
+    parser.add_argument("--single-call", action="store_true")
+    parser.add_argument("--retrieval", choices=["bm25", "hybrid", "vector"], default="hybrid")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between monitor cycles")
+    parser.add_argument("--account-workers", type=int, default=4)
+    parser.add_argument("--email-workers", type=int, default=8)
+    parser.add_argument("--per-account", type=int, default=3)
+    parser.add_argument("--trace-memory", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directories")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="earlier result to compare against")
+    options = vars(parser.parse_args(argv))
+    if options['categorize_mode'] == 'inline':
+        options['categorize_mode'] = None
+    return options
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    options = parse_args(argv)
+    scenarios = load_scenarios()
+    result = {'options': options, 'scenarios': len(scenarios), 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': sys.version.split()[0], 'runs': {}}
+    context = multiprocessing.get_context('spawn')
+    for name in options['runs']:
+        logger.info(f"Running {name}: {options['accounts']} accounts x {options['emails']} emails")
+        with context.Pool(1) as pool:
+            report = pool.apply(_run_in_process, ((name, options, scenarios),))
+        result['runs'][name] = report
+        logger.info(f"  {report['emails']} emails in {report['elapsed_s']}s = {report['emails_per_sec']} emails/sec"
+                    f"{'' if report['complete'] else ' (INCOMPLETE)'}, max RSS {report['memory']['max_rss_mb']} MB")
+        for key, stats in report['latency'].items():
+            logger.info(f"  {key:<55} n={stats['count']:<6} p50={stats['p50_ms']:>9.2f}ms p99={stats['p99_ms']:>9.2f}ms")
+    with open(options['output'], 'w') as f:
+        json.dump(result, f, indent=2)
+    logger.info(f"Saved {options['output']}")
+    if options['compare']:
+        with open(options['compare']) as f:
+            previous = json.load(f)
+        for line in compare(previous, result):
+            logger.info(line)
+    return 0 if all(report['complete'] for report in result['runs'].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""Content reduction ahead of LLM and retrieval calls.
+
+Long threads are mostly quoted history, signatures and legal boilerplate. These
+are stripped first. The remaining body is then cut to a token budget counted
+with tiktoken, so prompts stay short whatever the thread length. The most recent
+quoted message is kept in a small separate budget, because the categorizer uses
+it to recognise follow-ups of refund threads. Callers keep the original text
+for anything that needs it verbatim, such as Order ID extraction.
+
+tiktoken fetches its encoding files over the network on first use, so workers
+only load the encoding when its file is already in the cache directory
+(TIKTOKEN_CACHE_DIR, tiktoken_cache/ next to this file by default). Otherwise,
+or when tiktoken is not installed, tokens are estimated at ~4 characters each.
+Fetch the file once on a machine with network access:
+
+Usage: python content_reducer.py --download
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BUDGET = 1000  # tokens kept from the new part of the email
+QUOTE_TOKEN_BUDGET = 150  # tokens kept from the latest quoted message, 0 drops quotes
+ENCODING = "o200k_base"  # o4-mini / gpt-4o tokenizer
+ENCODING_URL = f"https://openaipublic.blob.core.windows.net/encodings/{ENCODING}.tiktoken"
+TIKTOKEN_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+TRUNCATION_MARK = "\n[...]"
+MAX_SIGNATURE_LINES = 8  # lines after a sign-off that still count as a signature
+
+QUOTE_HEADER_RE = re.compile(
+    r'^\s*(On\s.{0,200}?wrote:|-{2,}\s*Original Message\s*-{2,}|-{2,}\s*Forwarded message\s*-{2,}|_{10,}|'
+    r'From:\s.+|Sent from my \w+.*|Get Outlook for .+)\s*$',
+    re.IGNORECASE | re.MULTILINE)
+SIGNATURE_DELIMITER_RE = re.compile(r'^--\s*$')
+SIGN_OFF_RE = re.compile(r'^\s*(best( regards)?|kind regards|regards|cheers|thanks?( you)?( in advance)?|many thanks|'
+                         r'sincerely|yours( truly| sincerely)?|with regards|всего доброго|с уважением|спасибо)[,.!]?\s*$',
+                         re.IGNORECASE)
+QUOTED_FIELD_RE = re.compile(r'^(Sent|Date|To|Cc|Subject):\s', re.IGNORECASE)
+BOILERPLATE_RE = re.compile(r'(intended (solely )?(for the )?(use of the )?(named )?recipient|this (e-?mail|message) '
+                            r'(and any attachments )?(is|are|may be) confidential|unsubscribe|'
+                            r'consider the environment before printing|virus[- ]free)', re.IGNORECASE)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_stats = {'emails': 0, 'tokens_in': 0, 'tokens_out': 0}
+_stats_lock = threading.Lock()
+
+
+def cache_dir():
+    return os.environ.get('TIKTOKEN_CACHE_DIR') or TIKTOKEN_CACHE_DIR
+
+
+def encoding_file():
+    """Path of the cached encoding; tiktoken names its cache files by the SHA-1 of the source URL."""
+    return os.path.join(cache_dir(), hashlib.sha1(ENCODING_URL.encode()).hexdigest())
+
+
+def _get_encoding():
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            if not os.path.exists(encoding_file()):
+                logger.info(f"No cached {ENCODING} encoding in {cache_dir()}, estimating tokens from length")
+                _encoding = False
+                return _encoding
+            try:
+                # tiktoken reads the cache directory from the environment on every load
+                os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir()
+                import tiktoken
+                _encoding = tiktoken.get_encoding(ENCODING)
+            except Exception as e:
+                logger.warning(f"tiktoken unavailable, estimating tokens from length: {e}")
+                _encoding = False
+        return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text or '', disallowed_special=()))
+    return len(text or '') // 4 + 1
+
+
+def truncate_tokens(text, budget):
+    """Cut text to at most budget tokens, marking the cut."""
+    if budget <= 0 or not text:
+        return ''
+    encoding = _get_encoding()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= budget:
+            return text
+        return encoding.decode(tokens[:budget]).rstrip() + TRUNCATION_MARK
+    if len(text) <= budget * 4:
+        return text
+    return text[:budget * 4].rstrip() + TRUNCATION_MARK
+
+
+def _is_quote_header(lines, i):
+    if QUOTE_HEADER_RE.match(lines[i]):
+        return True
+    # Gmail wraps long "On <date> <name> <address> wrote:" lines
+    return (lines[i].lstrip().startswith('On ') and i + 1 < len(lines)
+            and lines[i + 1].rstrip().endswith('wrote:'))
+
+
+def split_quoted(text):
+    """Split an email into (new text, latest quoted message)."""
+    lines = text.split('\n')
+    cut = next((i for i, line in enumerate(lines) if line.lstrip().startswith('>') or _is_quote_header(lines, i)),
+               len(lines))
+    latest = []
+    for i in range(cut, len(lines)):
+        line = lines[i].strip()
+        if _is_quote_header(lines, i) or (line.endswith('wrote:') and not latest):
+            if any(latest):
+                break
+            continue
+        if QUOTED_FIELD_RE.match(line) and not any(latest):
+            continue
+        if line.startswith('>'):
+            line = line[1:].strip()
+            if line.startswith('>'):
+                # Older history quoted inside the latest message
+                continue
+            if any(latest) and (QUOTE_HEADER_RE.match(line) or line.endswith('wrote:')):
+                break
+        latest.append(line)
+    return '\n'.join(lines[:cut]), '\n'.join(latest)
+
+
+def strip_signature(text):
+    lines = text.rstrip().split('\n')
+    for i, line in enumerate(lines):
+        if SIGNATURE_DELIMITER_RE.match(line):
+            return '\n'.join(lines[:i])
+    for i in range(len(lines) - 1, max(-1, len(lines) - MAX_SIGNATURE_LINES - 2), -1):
+        if SIGN_OFF_RE.match(lines[i]):
+            return '\n'.join(lines[:i])
+    return '\n'.join(lines)
+
+
+def strip_boilerplate(text):
+    paragraphs = re.split(r'\n\s*\n', text)
+    return '\n\n'.join(p for p in paragraphs if not BOILERPLATE_RE.search(p))
+
+
+def normalize_whitespace(text):
+    text = re.sub(r'[ \t\xa0]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+
+def reduce_content(content, budget=TOKEN_BUDGET, quote_budget=QUOTE_TOKEN_BUDGET):
+    """Return the email text worth sending to the LLM, within budget + quote_budget tokens."""
+    if not content:
+        return ''
+    text = content.replace('\r\n', '\n')
+    new, quoted = split_quoted(text)
+    new = normalize_whitespace(strip_boilerplate(strip_signature(new)))
+    if not new:
+        # Everything looked quoted or boilerplate; fall back to the plain text
+        new, quoted = normalize_whitespace(text), ''
+    reduced = truncate_tokens(new, budget)
+    quoted = normalize_whitespace(strip_boilerplate(strip_signature(quoted))) if quote_budget else ''
+    if quoted:
+        reduced += "\n\n[Quoted]\n" + truncate_tokens(quoted, quote_budget)
+    with _stats_lock:
+        _stats['emails'] += 1
+        _stats['tokens_in'] += count_tokens(content)
+        _stats['tokens_out'] += count_tokens(reduced)
+    return reduced
+
+
+def get_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def download_encoding():
+    """Fetch the encoding into the cache directory. Returns the file path."""
+    os.makedirs(cache_dir(), exist_ok=True)
+    os.environ['TIKTOKEN_CACHE_DIR'] = cache_dir()
+    import tiktoken
+    tiktoken.get_encoding(ENCODING)
+    return encoding_file()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the tiktoken encoding used for token budgets")
+    parser.add_argument("--download", action="store_true", help=f"fetch the {ENCODING} encoding into the cache directory")
+    options = parser.parse_args(argv)
+    if not options.download:
+        print(f"{encoding_file()}: {'present' if os.path.exists(encoding_file()) else 'missing'}")
+        return 0
+    print(f"Encoding saved to {download_encoding()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
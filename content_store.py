@@ -0,0 +1,99 @@
+"""Deduplicated, compressed storage of email bodies.
+
+processed_emails_full, unhandled_emails and not_found_refunds keep a short
+preview of each body in their content column and its SHA-256 in
+content_hash. The full text is stored once per distinct body in
+email_contents, so an email filed in two tables costs one copy. Bodies are
+compressed with zstd when the zstandard package is installed and zlib
+otherwise; the codec is stored per row, so a DB written with either reads
+back as long as the codec is available. Bodies up to INLINE_CHARS stay whole
+in the content column and get no hash.
+
+Connections from storage.connect() have the email_text(codec, data) SQL
+function, which the history LIKE search and FTS rebuilds use to read the full
+text back. On SQLite 3.43+ no write depends on it, so any SQLite client can
+modify the tables; older versions need it in the FTS triggers (see storage.py).
+"""
+import hashlib
+import threading
+import zlib
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INLINE_CHARS = 200  # bodies up to this long are not moved to email_contents; also the preview length
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 6
+CODEC = 'zstd' if zstandard else 'zlib'
+
+CONTENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS {schema}email_contents (
+        hash TEXT PRIMARY KEY,
+        codec TEXT,
+        data BLOB,
+        size INTEGER,
+        created_at TEXT
+    )
+"""
+CONTENT_COLUMNS = "hash, codec, data, size, created_at"
+SQL_INSERT_CONTENT = f"INSERT OR IGNORE INTO email_contents ({CONTENT_COLUMNS}) VALUES (?, ?, ?, ?, ?)"
+# Rows written before the content store, with their full body still in content
+UNCOMPACTED = f"content_hash IS NULL AND length(content) > {INLINE_CHARS}"
+
+_local = threading.local()
+
+
+def _zstd():
+    # zstandard (de)compressors are not thread-safe, so each thread keeps its own
+    codecs = getattr(_local, 'zstd', None)
+    if codecs is None:
+        codecs = _local.zstd = (zstandard.ZstdCompressor(level=ZSTD_LEVEL), zstandard.ZstdDecompressor())
+    return codecs
+
+
+def compress(text, codec=CODEC):
+    data = text.encode('utf-8')
+    if codec == 'zstd':
+        return _zstd()[0].compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("Email body is zstd-compressed but zstandard is not installed")
+        return _zstd()[1].decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+
+def email_text(codec, data):
+    """SQL function: the text of an email_contents row, or NULL without one."""
+    if data is None:
+        return None
+    return decompress(codec, data)
+
+
+def register(conn):
+    conn.create_function('email_text', 2, email_text, deterministic=True)
+
+
+def preview(text):
+    if len(text) <= INLINE_CHARS:
+        return text
+    return text[:INLINE_CHARS] + '...'
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def split_content(text):
+    """(content column value, content_hash, email_contents row or None) for a body."""
+    if not text or len(text) <= INLINE_CHARS:
+        return text, None, None
+    digest = content_hash(text)
+    row = (digest, CODEC, compress(text), len(text), datetime.now().isoformat())
+    return preview(text), digest, row
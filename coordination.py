@@ -0,0 +1,163 @@
+"""Coordination of worker processes through the shared SQLite DB.
+
+Each worker registers in the workers table and refreshes its heartbeat every
+cycle. A worker only polls an account while it holds an unexpired lease on it.
+Leases are taken and renewed with one conditional upsert, so two processes can
+never own the same account. A worker keeps at most its fair share of accounts
+(accounts / live workers, rounded up) and releases the rest, so accounts
+spread out as workers join. The accounts of a stopped or crashed worker are
+picked up once its leases expire. Within an account, each email is claimed
+once in the pipeline table (see pipeline.Pipeline.claim), which also covers
+the overlap while a lease changes hands. Background jobs that must run on one
+worker at a time (see retention.py) take leases in job_leases the same way.
+"""
+import logging
+import math
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+LEASE_TTL = 180  # seconds; renewed every cycle and every chunk
+WORKER_TIMEOUT = 180  # heartbeat age after which a worker no longer counts as live
+
+WORKERS_DDL = """
+    CREATE TABLE IF NOT EXISTS workers (
+        worker_id TEXT PRIMARY KEY,
+        host TEXT,
+        pid INTEGER,
+        status TEXT,
+        processed INTEGER DEFAULT 0,
+        started_at REAL,
+        heartbeat_at REAL,
+        metrics TEXT
+    )
+"""
+LEASES_DDL = """
+    CREATE TABLE IF NOT EXISTS account_leases (
+        account TEXT PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL
+    )
+"""
+
+JOB_LEASES_DDL = """
+    CREATE TABLE IF NOT EXISTS job_leases (
+        job TEXT PRIMARY KEY,
+        owner TEXT,
+        expires_at REAL
+    )
+"""
+
+SQL_CLAIM = """
+    INSERT INTO account_leases (account, owner, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT(account) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE account_leases.owner = excluded.owner OR account_leases.expires_at < ?
+"""
+
+
+SQL_CLAIM_JOB = """
+    INSERT INTO job_leases (job, owner, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT(job) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE job_leases.owner = excluded.owner OR job_leases.expires_at < ?
+"""
+
+
+def worker_identity():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def register_worker(conn, worker_id):
+    now = time.time()
+    host, _, pid = worker_id.rpartition(':')
+    with conn:
+        conn.execute("""
+            INSERT INTO workers (worker_id, host, pid, status, processed, started_at, heartbeat_at)
+            VALUES (?, ?, ?, 'running', 0, ?, ?)
+            ON CONFLICT(worker_id) DO UPDATE SET status = 'running', processed = 0,
+                started_at = excluded.started_at, heartbeat_at = excluded.heartbeat_at
+        """, (worker_id, host, int(pid) if pid.isdigit() else None, now, now))
+
+
+def heartbeat(conn, worker_id, processed=None, metrics=None):
+    """Refresh the worker's heartbeat, and its processed count and metrics snapshot (JSON) when given."""
+    with conn:
+        conn.execute("UPDATE workers SET heartbeat_at = ?, processed = coalesce(?, processed), "
+                     "metrics = coalesce(?, metrics) WHERE worker_id = ?",
+                     (time.time(), processed, metrics, worker_id))
+
+
+def unregister_worker(conn, worker_id):
+    """Mark the worker stopped and hand its accounts back right away."""
+    with conn:
+        conn.execute("UPDATE workers SET status = 'stopped', heartbeat_at = ? WHERE worker_id = ?", (time.time(), worker_id))
+        conn.execute("DELETE FROM account_leases WHERE owner = ?", (worker_id,))
+        conn.execute("DELETE FROM job_leases WHERE owner = ?", (worker_id,))
+
+
+def live_workers(conn, timeout=WORKER_TIMEOUT):
+    row = conn.execute("SELECT COUNT(*) FROM workers WHERE status = 'running' AND heartbeat_at >= ?",
+                       (time.time() - timeout,)).fetchone()
+    return row[0]
+
+
+def claim_account(conn, account, worker_id, ttl=LEASE_TTL):
+    """Take or renew the lease on an account. Returns False if another worker holds it."""
+    now = time.time()
+    with conn:
+        return conn.execute(SQL_CLAIM, (account, worker_id, now + ttl, now)).rowcount > 0
+
+
+def release_account(conn, account, worker_id):
+    with conn:
+        conn.execute("DELETE FROM account_leases WHERE account = ? AND owner = ?", (account, worker_id))
+
+
+def claim_job(conn, job, worker_id, ttl=LEASE_TTL):
+    """Take or renew the lease on a background job. Returns False if another worker runs it."""
+    now = time.time()
+    with conn:
+        return conn.execute(SQL_CLAIM_JOB, (job, worker_id, now + ttl, now)).rowcount > 0
+
+
+def release_job(conn, job, worker_id):
+    with conn:
+        conn.execute("DELETE FROM job_leases WHERE job = ? AND owner = ?", (job, worker_id))
+
+
+def balance_accounts(conn, worker_id, accounts, ttl=LEASE_TTL):
+    """Renew, release and claim leases so the worker holds its fair share of accounts. Returns the accounts it owns."""
+    share = math.ceil(len(accounts) / max(1, live_workers(conn)))
+    rows = conn.execute("SELECT account FROM account_leases WHERE owner = ? AND expires_at >= ?",
+                        (worker_id, time.time())).fetchall()
+    held = {row[0] for row in rows}
+    owned = []
+    for account in accounts:
+        if account in held:
+            if len(owned) < share and claim_account(conn, account, worker_id, ttl):
+                owned.append(account)
+            else:
+                release_account(conn, account, worker_id)
+    for account in accounts:
+        if len(owned) >= share:
+            break
+        if account not in held and claim_account(conn, account, worker_id, ttl):
+            owned.append(account)
+    return owned
+
+
+def worker_metrics(conn, timeout=WORKER_TIMEOUT):
+    """{worker_id: metrics JSON} of the live workers that published a snapshot."""
+    rows = conn.execute("SELECT worker_id, metrics FROM workers WHERE status = 'running' AND heartbeat_at >= ? "
+                        "AND metrics IS NOT NULL", (time.time() - timeout,)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def list_workers(conn):
+    rows = conn.execute("""
+        SELECT w.worker_id, w.status, w.processed, w.started_at, w.heartbeat_at,
+               (SELECT COUNT(*) FROM account_leases l WHERE l.owner = w.worker_id AND l.expires_at >= ?) AS accounts
+        FROM workers w ORDER BY w.heartbeat_at DESC
+    """, (time.time(),)).fetchall()
+    return [dict(row) for row in rows]
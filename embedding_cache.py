@@ -0,0 +1,158 @@
+"""Persistent cache in front of an embeddings model.
+
+Vectors are stored in a separate SQLite file. Each is keyed by a sha256 of the
+model name and the whitespace-normalized text, and stored as a float32 blob.
+A small in-memory LRU serves hot queries. The SQLite table is trimmed to
+max_entries by last use, so repeated or templated emails never reach the
+embeddings API twice.
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = "embedding_cache.db"
+MAX_ENTRIES = 50000
+MEMORY_ENTRIES = 1024
+EVICT_EVERY = 500  # inserts between eviction passes
+
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, cache_file=CACHE_FILE, max_entries=MAX_ENTRIES, memory_entries=MEMORY_ENTRIES):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, 'model', None) or type(embeddings).__name__
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._conn = sqlite3.connect(cache_file, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    vector BLOB,
+                    last_used REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    missing.append(key)
+            for start in range(0, len(missing), 500):
+                chunk = missing[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk).fetchall()
+                for key, blob in rows:
+                    vector = array('f', blob).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+            if found:
+                with self._conn:
+                    self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+        return found
+
+    def _store(self, items):
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)",
+                    [(key, self.model, array('f', vector).tobytes(), now) for key, vector in items])
+            for key, vector in items:
+                self._remember(key, vector)
+            self._inserts += len(items)
+            if self._inserts >= EVICT_EVERY:
+                self._inserts = 0
+                self._evict()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            with self._conn:
+                self._conn.execute("""
+                    DELETE FROM embeddings WHERE key IN (
+                        SELECT key FROM embeddings ORDER BY last_used LIMIT ?
+                    )
+                """, (excess,))
+            logger.info(f"Embedding cache evicted {excess} entries")
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        try:
+            found = self._lookup(keys)
+        except sqlite3.Error as e:
+            logger.error(f"Embedding cache lookup failed: {e}")
+            found = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            with metrics.timer('embedding_request_seconds', kind='documents'):
+                vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            found.update(computed)
+            try:
+                self._store(computed)
+            except sqlite3.Error as e:
+                logger.error(f"Embedding cache store failed: {e}")
+        return [found[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self._key(text)
+        try:
+            found = self._lookup([key])
+        except sqlite3.Error as e:
+            logger.error(f"Embedding cache lookup failed: {e}")
+            found = {}
+        if key in found:
+            self.hits += 1
+            return found[key]
+        self.misses += 1
+        with metrics.timer('embedding_request_seconds', kind='query'):
+            vector = self.embeddings.embed_query(text)
+        try:
+            self._store([(key, vector)])
+        except sqlite3.Error as e:
+            logger.error(f"Embedding cache store failed: {e}")
+        return vector
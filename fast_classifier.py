@@ -0,0 +1,99 @@
+"""Deterministic pre-classifier run ahead of the LLM categorizer.
+
+Rules catch the obvious cases:
+- replies to one of our pending refund questions
+- refund/return wording together with an "Order ID:" pattern
+- auto-replies, detected by their headers or subject
+A keyword scorer covers the rest. Its confidence grows with the winning score
+and its lead over the other category, so only a strong one-sided match clears
+the threshold. Only a result at or above the threshold is used; anything else
+goes to the LLM. Hit and miss counters show how many LLM calls the stage saves.
+"""
+import re
+import threading
+from collections import Counter
+
+FAST_PATH_THRESHOLD = 0.9
+SCORER_PRIOR = 1  # added to the winning score, so a few matched words stay below the threshold
+SCORER_MAX_CONFIDENCE = 0.93  # keyword scores stay below the explicit rules
+
+ORDER_ID_RE = re.compile(r'(?:Order\s+ID|order\s+id)[:\s]+([A-Za-z0-9\-]+)', re.IGNORECASE)
+REFUND_RE = re.compile(r'\b(refunds?|refunded|returns?|returned|money back|chargeback|reimburse\w*)\b', re.IGNORECASE)
+AUTO_REPLY_SUBJECT_RE = re.compile(r'^\s*(auto(matic)?[\s-]?reply|autoreply|out of (the )?office|undeliverable|delivery status notification)', re.IGNORECASE)
+AUTO_REPLY_HEADERS = ('X-Autoreply', 'X-Autorespond', 'X-Auto-Reply')
+BULK_PRECEDENCE = ('bulk', 'auto_reply', 'junk', 'list')
+
+KEYWORD_WEIGHTS = {
+    'Refund': {'refund': 3, 'return': 2, 'money back': 3, 'chargeback': 3, 'reimburse': 3, 'order id': 1},
+    'Question': {'?': 1, 'how ': 1, 'what ': 1, 'pricing': 2, 'price': 2, 'plan': 1, 'integrat': 2, 'tms': 2, 'demo': 1},
+}
+
+_stats = {'hits': 0, 'misses': 0, 'rules': Counter()}
+_stats_lock = threading.Lock()
+
+
+def _header(headers, name):
+    for key, value in (headers or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def is_auto_reply(headers, subject=''):
+    auto_submitted = _header(headers, 'Auto-Submitted')
+    if auto_submitted and auto_submitted.strip().lower() != 'no':
+        return 0.99
+    if any(_header(headers, name) for name in AUTO_REPLY_HEADERS):
+        return 0.99
+    precedence = (_header(headers, 'Precedence') or '').strip().lower()
+    if precedence in BULK_PRECEDENCE:
+        return 0.95
+    if AUTO_REPLY_SUBJECT_RE.search(subject or ''):
+        return 0.9
+    return 0.0
+
+
+def score_keywords(content):
+    """Return (category, confidence) from keyword weights, or (None, 0.0)."""
+    text = (content or '').lower()
+    scores = {category: sum(weight * text.count(word) for word, weight in words.items())
+              for category, words in KEYWORD_WEIGHTS.items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (category, top), (_, runner_up) = ranked[0], ranked[1]
+    if top == runner_up:
+        return None, 0.0
+    return category, min(SCORER_MAX_CONFIDENCE, (top - runner_up) / (top + SCORER_PRIOR))
+
+
+def classify(content, headers=None, has_pending=False):
+    """Return (category, importance, confidence, rule) for the best matching rule, or None."""
+    if has_pending:
+        return 'Refund', 'medium', 1.0, 'pending_reply'
+    auto_confidence = is_auto_reply(headers, _header(headers, 'Subject') or '')
+    if auto_confidence:
+        return 'Other', 'low', auto_confidence, 'auto_reply'
+    if REFUND_RE.search(content or '') and ORDER_ID_RE.search(content or ''):
+        return 'Refund', 'medium', 0.95, 'refund_order_id'
+    category, confidence = score_keywords(content)
+    if category:
+        return category, 'medium', confidence, 'keywords'
+    return None
+
+
+def precategorize(content, headers=None, has_pending=False, threshold=FAST_PATH_THRESHOLD):
+    """Return a categorize_email-style (category, explanation, importance) tuple, or None to ask the LLM."""
+    result = classify(content, headers, has_pending)
+    with _stats_lock:
+        if result and result[2] >= threshold:
+            _stats['hits'] += 1
+            _stats['rules'][result[3]] += 1
+        else:
+            _stats['misses'] += 1
+            return None
+    category, importance, confidence, rule = result
+    return category, f"Rule: {rule} ({confidence:.2f})", importance
+
+
+def get_stats():
+    with _stats_lock:
+        return {'hits': _stats['hits'], 'misses': _stats['misses'], 'rules': dict(_stats['rules'])}
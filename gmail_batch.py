@@ -0,0 +1,110 @@
+"""Batched Gmail API calls.
+
+Message gets are grouped into batch HTTP requests (``BatchHttpRequest`` from
+``service.new_batch_http_request``) and label changes go through
+``messages().batchModify``, so a cycle costs a few requests instead of one or two
+per email. Items failing with a transient error (429, 5xx, rate-limit 403) are
+retried with exponential backoff; other per-item errors are returned to the caller.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50  # Gmail rejects or throttles larger batches
+MODIFY_BATCH_SIZE = 1000  # batchModify id limit
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0  # seconds, doubled on every retry
+
+
+def error_status(error):
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None) or getattr(error, 'status_code', None)
+
+
+def is_retryable(error):
+    status = error_status(error)
+    if status in (429, 500, 502, 503, 504):
+        return True
+    if status == 403:
+        content = getattr(error, 'content', b'') or b''
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', errors='ignore')
+        return 'rateLimitExceeded' in content
+    return False
+
+
+def execute_batch(service, requests, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    """Run requests in batch HTTP calls.
+
+    ``requests`` maps a key to a zero-argument callable building the request, so
+    retried items can be rebuilt. Returns ``(responses, errors)`` keyed the same way.
+    """
+    responses, errors = {}, {}
+    pending = list(requests)
+    for attempt in range(max_retries + 1):
+        retry = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                key = chunk[int(request_id)]
+                if exception is None:
+                    responses[key] = response
+                    errors.pop(key, None)
+                else:
+                    errors[key] = exception
+                    if attempt < max_retries and is_retryable(exception):
+                        retry.append(key)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for i, key in enumerate(chunk):
+                batch.add(requests[key](), request_id=str(i))
+            try:
+                batch.execute()
+            except Exception as e:
+                # The whole batch call failed, so none of its callbacks ran
+                logger.warning(f"Gmail batch of {len(chunk)} failed: {e}")
+                for key in chunk:
+                    if key not in responses:
+                        errors[key] = e
+                        if attempt < max_retries and is_retryable(e):
+                            retry.append(key)
+        if not retry:
+            break
+        pending = retry
+        delay = backoff * (2 ** attempt)
+        logger.info(f"Retrying {len(pending)} Gmail batch items in {delay:.1f}s")
+        time.sleep(delay)
+    return responses, errors
+
+
+def batch_get_messages(service, message_ids, format='full', **kwargs):
+    """Fetch messages in batches. Returns ``({id: message}, {id: error})``."""
+    messages = service.users().messages()
+    requests = {
+        message_id: (lambda message_id=message_id: messages.get(userId='me', id=message_id, format=format, **kwargs))
+        for message_id in message_ids
+    }
+    return execute_batch(service, requests)
+
+
+def batch_remove_labels(service, message_ids, label_ids=('UNREAD',), max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    """Remove labels from messages with batchModify. Returns the ids that could not be updated."""
+    failed = []
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), MODIFY_BATCH_SIZE):
+        chunk = message_ids[start:start + MODIFY_BATCH_SIZE]
+        body = {'ids': chunk, 'removeLabelIds': list(label_ids)}
+        for attempt in range(max_retries + 1):
+            try:
+                service.users().messages().batchModify(userId='me', body=body).execute()
+                break
+            except Exception as e:
+                if attempt < max_retries and is_retryable(e):
+                    time.sleep(backoff * (2 ** attempt))
+                    continue
+                logger.error(f"Gmail batchModify failed for {len(chunk)} messages: {e}")
+                failed.extend(chunk)
+                break
+    return failed
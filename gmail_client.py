@@ -0,0 +1,224 @@
+"""Process-wide Gmail credential and service cache.
+
+Credentials are unpickled and the profile email is read once per token file.
+Services are built from a locally cached discovery document, so building one
+makes no request. A service object is not thread safe, so each thread gets its
+own, all sharing the cached credentials. A background thread refreshes
+credentials before they expire, so request paths never block on a refresh.
+
+The account address is saved next to each token, so account_info() can list
+accounts without a network call. The Google client libraries are imported
+on first use.
+"""
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    'https://www.googleapis.com/auth/gmail.readonly',
+    'https://www.googleapis.com/auth/gmail.send',
+    'https://www.googleapis.com/auth/gmail.modify'
+]
+CREDENTIALS_FILE = 'credentials.json'
+TOKEN_DIR = 'tokens'
+ACCOUNT_INFO_SUFFIX = '.json'  # {'email': ...} saved next to each token file
+DISCOVERY_DOC_FILE = "gmail_discovery.json"
+DISCOVERY_URL = "https://gmail.googleapis.com/$discovery/rest?version=v1"
+REFRESH_INTERVAL = 60  # seconds between background expiry checks
+REFRESH_MARGIN = timedelta(minutes=5)  # refresh tokens this long before expiry
+
+_accounts = {}  # token path -> {'creds', 'email', 'mtime', 'lock'}
+_accounts_lock = threading.Lock()
+_load_lock = threading.Lock()
+_doc_lock = threading.Lock()
+_local = threading.local()
+_discovery_doc = None
+_refresher = None
+
+
+def get_discovery_doc():
+    """Return the Gmail v1 discovery document, fetching it over the network at most once."""
+    global _discovery_doc
+    if _discovery_doc is not None:
+        return _discovery_doc
+    with _doc_lock:
+        if _discovery_doc is not None:
+            return _discovery_doc
+        doc = None
+        if os.path.exists(DISCOVERY_DOC_FILE):
+            with open(DISCOVERY_DOC_FILE, "r", encoding="utf-8") as f:
+                doc = f.read()
+        if not doc:
+            try:
+                from googleapiclient.discovery_cache import get_static_doc
+                doc = get_static_doc('gmail', 'v1')
+            except ImportError:
+                doc = None
+        if not doc:
+            import httplib2
+            resp, content = httplib2.Http(timeout=30).request(DISCOVERY_URL)
+            if resp.status != 200:
+                raise RuntimeError(f"Discovery document fetch failed: HTTP {resp.status}")
+            doc = content.decode("utf-8")
+            json.loads(doc)
+            with open(DISCOVERY_DOC_FILE, "w", encoding="utf-8") as f:
+                f.write(doc)
+        _discovery_doc = doc
+        return doc
+
+
+def save_credentials(token_path, creds):
+    with open(token_path, 'wb') as token:
+        pickle.dump(creds, token)
+
+
+def _info_path(token_path):
+    return os.path.splitext(token_path)[0] + ACCOUNT_INFO_SUFFIX
+
+
+def save_account_email(token_path, email):
+    with open(_info_path(token_path), 'w', encoding='utf-8') as f:
+        json.dump({'email': email}, f)
+
+
+def saved_account_email(token_path):
+    try:
+        with open(_info_path(token_path), 'r', encoding='utf-8') as f:
+            return json.load(f).get('email')
+    except (OSError, ValueError):
+        return None
+
+
+def account_info(token_path):
+    """(email, usable) for a token file from local state only: no refresh, no profile request.
+
+    usable is False when the credentials are expired without a refresh token.
+    email is None until a worker or the OAuth flow has read the profile once.
+    """
+    try:
+        with open(token_path, 'rb') as token:
+            creds = pickle.load(token)
+    except Exception as e:
+        logger.error(f"Gmail token {token_path} unreadable: {e}")
+        return None, False
+    usable = bool(creds) and (creds.valid or bool(creds.expired and creds.refresh_token))
+    return saved_account_email(token_path), usable
+
+
+def _refresh(token_path, entry):
+    import google.auth.transport.requests
+    with entry['lock']:
+        creds = entry['creds']
+        creds.refresh(google.auth.transport.requests.Request())
+        save_credentials(token_path, creds)
+        entry['mtime'] = os.path.getmtime(token_path)
+
+
+def _needs_refresh(creds, margin=REFRESH_MARGIN):
+    if not creds.refresh_token:
+        return False
+    if not creds.valid:
+        return True
+    # google-auth keeps expiry as naive UTC
+    return creds.expiry is not None and creds.expiry - datetime.utcnow() < margin
+
+
+def get_account(token_path):
+    """Return the cached {'creds', 'email'} entry for a token file, or None if it has no usable credentials."""
+    try:
+        mtime = os.path.getmtime(token_path)
+    except OSError:
+        forget_account(token_path)
+        return None
+    entry = _accounts.get(token_path)
+    if entry and entry['mtime'] == mtime:
+        return entry
+    with _load_lock:
+        entry = _accounts.get(token_path)
+        if entry and entry['mtime'] == mtime:
+            return entry
+        return _load_account(token_path, mtime, entry)
+
+
+def _load_account(token_path, mtime, previous):
+    with open(token_path, 'rb') as token:
+        creds = pickle.load(token)
+    if not creds:
+        return None
+    entry = {'creds': creds, 'email': previous['email'] if previous else saved_account_email(token_path), 'mtime': mtime,
+             'lock': threading.Lock()}
+    if not creds.valid:
+        if not (creds.expired and creds.refresh_token):
+            return None
+        _refresh(token_path, entry)
+    if not entry['email']:
+        profile = _build(creds).users().getProfile(userId='me').execute()
+        entry['email'] = profile['emailAddress']
+        save_account_email(token_path, entry['email'])
+    with _accounts_lock:
+        _accounts[token_path] = entry
+    start_refresher()
+    return entry
+
+
+def forget_account(token_path):
+    with _accounts_lock:
+        _accounts.pop(token_path, None)
+    try:
+        os.remove(_info_path(token_path))
+    except OSError:
+        pass
+
+
+def _build(creds):
+    import googleapiclient.discovery
+    return googleapiclient.discovery.build_from_document(get_discovery_doc(), credentials=creds)
+
+
+def get_service(token_path):
+    """Return (service, email) for the calling thread, building the service only once per thread."""
+    entry = get_account(token_path)
+    if not entry:
+        return None, None
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = {}
+    cached = services.get(token_path)
+    if cached is None or cached[0] is not entry['creds']:
+        cached = services[token_path] = (entry['creds'], _build(entry['creds']))
+    return cached[1], entry['email']
+
+
+def refresh_expiring(margin=REFRESH_MARGIN):
+    with _accounts_lock:
+        accounts = list(_accounts.items())
+    for token_path, entry in accounts:
+        if not _needs_refresh(entry['creds'], margin):
+            continue
+        try:
+            _refresh(token_path, entry)
+            logger.info(f"Refreshed Gmail token for {entry['email']}")
+        except Exception as e:
+            logger.error(f"Gmail token refresh failed for {entry['email']}: {e}")
+
+
+def _refresh_loop(interval):
+    while True:
+        time.sleep(interval)
+        refresh_expiring()
+
+
+def start_refresher(interval=REFRESH_INTERVAL):
+    global _refresher
+    if _refresher is not None:
+        return
+    with _accounts_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_loop, args=(interval,), name='gmail-token-refresh', daemon=True)
+            _refresher.start()
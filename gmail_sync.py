@@ -0,0 +1,147 @@
+"""Incremental Gmail sync based on history IDs.
+
+Each account keeps a ``historyId`` checkpoint in the ``gmail_sync_state`` table.
+A sync with a checkpoint only reads ``history().list`` deltas since then; without
+one (or when Gmail reports it as expired) the whole unread backlog is listed again.
+``history().list`` takes no search query, so a filter narrower than unread mail
+(e.g. ``newer_than:1d``) is applied to a delta by listing the messages it matches.
+All functions take the Gmail ``service`` as a parameter, so any object exposing the
+same ``users().messages()/history()`` call chain can stand in for the real client.
+"""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+SYNC_STATE_DDL = """
+    CREATE TABLE IF NOT EXISTS gmail_sync_state (
+        account TEXT PRIMARY KEY,
+        history_id TEXT,
+        updated_at TEXT
+    )
+"""
+LIST_PAGE_SIZE = 500
+HISTORY_PAGE_SIZE = 500
+UNREAD_QUERY = 'is:unread'  # what the history delta matches already
+
+
+def get_history_checkpoint(conn, account):
+    if not conn:
+        return None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT history_id FROM gmail_sync_state WHERE account = ?", (account,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Get history checkpoint failed for {account}: {e}")
+        return None
+
+
+def save_history_checkpoint(conn, account, history_id):
+    if not conn or not history_id:
+        return
+    try:
+        with conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO gmail_sync_state (account, history_id, updated_at)
+                VALUES (?, ?, ?)
+            """, (account, str(history_id), datetime.now().isoformat()))
+    except Exception as e:
+        logger.error(f"Save history checkpoint failed for {account}: {e}")
+
+
+def clear_history_checkpoint(conn, account):
+    if not conn:
+        return
+    try:
+        with conn:
+            conn.execute("DELETE FROM gmail_sync_state WHERE account = ?", (account,))
+    except Exception as e:
+        logger.error(f"Clear history checkpoint failed for {account}: {e}")
+
+
+def is_history_expired(error):
+    # Gmail answers 404 when startHistoryId is older than the retained history
+    resp = getattr(error, 'resp', None)
+    return getattr(resp, 'status', None) == 404 or getattr(error, 'status_code', None) == 404
+
+
+def list_unread_ids(service, q_filter, max_messages=None):
+    """Page through every unread INBOX message matching q_filter."""
+    ids = []
+    page_token = None
+    while True:
+        kwargs = {'userId': 'me', 'labelIds': ['INBOX', 'UNREAD'], 'q': q_filter, 'maxResults': LIST_PAGE_SIZE}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        results = service.users().messages().list(**kwargs).execute()
+        ids.extend(m['id'] for m in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token or (max_messages and len(ids) >= max_messages):
+            break
+    return ids[:max_messages] if max_messages else ids
+
+
+def list_history_ids(service, start_history_id):
+    """Return (message_ids, latest_history_id) of unread INBOX messages added since start_history_id."""
+    ids = {}
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        kwargs = {'userId': 'me', 'startHistoryId': start_history_id, 'historyTypes': ['messageAdded'],
+                  'labelId': 'INBOX', 'maxResults': HISTORY_PAGE_SIZE}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        results = service.users().history().list(**kwargs).execute()
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added.get('message', {})
+                labels = message.get('labelIds')
+                if labels is not None and ('INBOX' not in labels or 'UNREAD' not in labels):
+                    continue
+                ids[message['id']] = None
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return list(ids), latest_history_id
+
+
+def narrows_unread(q_filter):
+    """True if q_filter matches fewer messages than every unread INBOX message."""
+    return bool(set((q_filter or '').split()) - {UNREAD_QUERY})
+
+
+def filter_ids(service, message_ids, q_filter):
+    """The message_ids matching q_filter, in order."""
+    if not message_ids or not narrows_unread(q_filter):
+        return message_ids
+    matching = set(list_unread_ids(service, q_filter))
+    return [message_id for message_id in message_ids if message_id in matching]
+
+
+def full_resync(service, q_filter, max_messages=None):
+    """Return (message_ids, history_id) from a complete unread listing."""
+    # Read the history ID before listing so nothing added in between is missed
+    history_id = service.users().getProfile(userId='me').execute().get('historyId')
+    return list_unread_ids(service, q_filter, max_messages), history_id
+
+
+def fetch_new_message_ids(service, conn, account, q_filter, max_messages=None):
+    """Return (message_ids, new_checkpoint) for an account.
+
+    The checkpoint is not saved here; callers store it with save_history_checkpoint
+    once the returned messages are handled, so a crash only replays them.
+    """
+    start_history_id = get_history_checkpoint(conn, account)
+    if start_history_id:
+        try:
+            message_ids, history_id = list_history_ids(service, start_history_id)
+        except Exception as e:
+            if not is_history_expired(e):
+                raise
+            logger.warning(f"History checkpoint {start_history_id} expired for {account}, running full resync")
+        else:
+            return filter_ids(service, message_ids, q_filter), history_id
+    return full_resync(service, q_filter, max_messages)
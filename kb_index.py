@@ -0,0 +1,108 @@
+"""Persistent FAISS index for the knowledge base.
+
+The vector store is saved to INDEX_DIR next to a manifest of per-document
+content hashes. Each document's hash doubles as its docstore id. On load, only
+documents whose hash is not in the manifest are embedded and added. Documents
+whose hash is no longer in the knowledge base are deleted.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = "faiss_index"
+MANIFEST_FILE = "manifest.json"
+
+
+def document_hash(doc):
+    h = hashlib.sha256()
+    h.update((doc.metadata.get('category') or '').encode('utf-8'))
+    h.update(b'\0')
+    h.update(doc.page_content.encode('utf-8'))
+    return h.hexdigest()
+
+
+def knowledge_base_version(documents):
+    """Hash of the whole KB, changing whenever any document is added, edited or removed."""
+    return hashlib.sha256("".join(sorted(document_hash(doc) for doc in documents)).encode('utf-8')).hexdigest()
+
+
+def _embedding_model(embeddings):
+    return getattr(embeddings, 'model', None) or type(embeddings).__name__
+
+
+def _documents_by_hash(documents):
+    return {document_hash(doc): doc for doc in documents}
+
+
+def read_manifest(index_dir=INDEX_DIR):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"FAISS manifest unreadable, rebuilding: {e}")
+        return None
+
+
+def save_index(vectorstore, embeddings, hashes, index_dir=INDEX_DIR):
+    vectorstore.save_local(index_dir)
+    manifest = {'embedding_model': _embedding_model(embeddings), 'documents': sorted(hashes)}
+    tmp_path = os.path.join(index_dir, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(index_dir, MANIFEST_FILE))
+
+
+def build_index(documents, embeddings, index_dir=INDEX_DIR):
+    from langchain_community.vectorstores import FAISS
+    docs = _documents_by_hash(documents)
+    hashes = list(docs)
+    vectorstore = FAISS.from_texts([docs[h].page_content for h in hashes], embeddings,
+                                   [docs[h].metadata for h in hashes], ids=hashes)
+    save_index(vectorstore, embeddings, hashes, index_dir)
+    logger.info(f"Built FAISS index with {len(hashes)} documents")
+    return vectorstore
+
+
+def sync_index(vectorstore, documents, embeddings, index_dir=INDEX_DIR, manifest=None):
+    """Embed new documents and drop removed ones. Returns (added, removed) counts."""
+    if not documents:
+        # An empty or unreadable KB must not wipe the index
+        return 0, 0
+    manifest = manifest or read_manifest(index_dir) or {}
+    known = set(manifest.get('documents', []))
+    docs = _documents_by_hash(documents)
+    added = [h for h in docs if h not in known]
+    removed = [h for h in known if h not in docs]
+    if not added and not removed:
+        return 0, 0
+    if added:
+        vectorstore.add_texts([docs[h].page_content for h in added], [docs[h].metadata for h in added], ids=added)
+    if removed:
+        vectorstore.delete(removed)
+    save_index(vectorstore, embeddings, list(docs), index_dir)
+    logger.info(f"FAISS index synced: {len(added)} added, {len(removed)} removed")
+    return len(added), len(removed)
+
+
+def load_or_build_index(documents, embeddings, index_dir=INDEX_DIR):
+    """Load the saved index, re-embedding only changed documents, or build it from scratch."""
+    from langchain_community.vectorstores import FAISS
+    started = time.monotonic()
+    manifest = read_manifest(index_dir)
+    if not manifest or manifest.get('embedding_model') != _embedding_model(embeddings):
+        return build_index(documents, embeddings, index_dir)
+    try:
+        vectorstore = FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        logger.warning(f"FAISS index load failed, rebuilding: {e}")
+        return build_index(documents, embeddings, index_dir)
+    sync_index(vectorstore, documents, embeddings, index_dir, manifest)
+    logger.info(f"Loaded FAISS index in {(time.monotonic() - started) * 1000:.0f} ms")
+    return vectorstore
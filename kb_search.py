@@ -0,0 +1,203 @@
+"""In-process retrieval over the knowledge base.
+
+Each KB section is split into passages, one per Q/A pair, that keep the
+section's `# Category` header as metadata. A BM25 index over the passages
+answers most queries in microseconds without a network call. Search modes:
+
+- bm25: lexical only, works without FAISS or embeddings.
+- vector: the FAISS store only (one embedding call per query).
+- hybrid: BM25 first. When its best passage does not clearly win
+  (below MIN_CONFIDENT_SCORE or CONFIDENT_RATIO times the runner-up), the
+  vector results are fused in by reciprocal rank.
+
+A category restricts the search to passages whose header starts with it,
+e.g. 'Question' matches '# Question Category'.
+"""
+import logging
+import math
+import re
+import threading
+from collections import Counter
+from typing import Any, List, Optional
+
+import kb_index
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ('bm25', 'hybrid', 'vector')
+DEFAULT_MODE = 'hybrid'
+K1 = 1.5
+B = 0.75
+MIN_CONFIDENT_SCORE = 2.0  # BM25 score the best passage needs to skip the vector search
+CONFIDENT_RATIO = 1.3  # ... and how far it must lead the runner-up
+RRF_K = 60  # reciprocal rank fusion constant
+VECTOR_FETCH_FACTOR = 4  # extra vector hits fetched to survive category filtering
+STOPWORDS = frozenset("""
+a an and are as at be but by can could do does for from have hello hi how i if in is it its me my of on or our
+please so that the their them there this to us was we what when where which who will with would you your
+""".split())
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    tokens = []
+    for word in WORD_RE.findall(text.lower()):
+        if word in STOPWORDS:
+            continue
+        # Fold plurals so 'plans' finds 'plan'
+        if len(word) > 4 and word.endswith('ies'):
+            word = word[:-3] + 'y'
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+def split_passages(documents):
+    """One Document per Q/A pair (a new passage starts at each 'Q:' line), keeping the section metadata."""
+    from langchain.docstore.document import Document
+    passages = []
+    for doc in documents:
+        current = []
+        for line in doc.page_content.splitlines():
+            if line.strip() == '***':
+                continue
+            if line.startswith('Q:') and current:
+                passages.append(Document(page_content="\n".join(current), metadata=dict(doc.metadata)))
+                current = []
+            current.append(line)
+        if current:
+            passages.append(Document(page_content="\n".join(current), metadata=dict(doc.metadata)))
+    return passages
+
+
+def matches_category(doc, category):
+    return (doc.metadata.get('category') or '').lower().startswith(category.lower())
+
+
+class BM25Index:
+    def __init__(self, passages, k1=K1, b=B):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # term -> [(passage index, term frequency)]
+        self._categories = {}
+        self.lengths = []
+        for i, doc in enumerate(passages):
+            counts = Counter(tokenize(doc.page_content))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, []).append((i, tf))
+        n = len(passages)
+        self.avg_length = sum(self.lengths) / n if n else 0.0
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in self.postings.items()}
+
+    def in_category(self, category):
+        """Indexes of the passages of a category, or None (no filter) if it has none."""
+        allowed = self._categories.get(category)
+        if allowed is None:
+            allowed = self._categories[category] = {i for i, doc in enumerate(self.passages)
+                                                    if matches_category(doc, category)}
+        return allowed or None
+
+    def scores(self, query, allowed=None):
+        """{passage index: score} for the passages sharing a term with the query."""
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, tf in self.postings[term]:
+                if allowed is not None and i not in allowed:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+
+class KnowledgeBaseSearch:
+    """BM25, vector or hybrid search over the KB passages. vectorstore is optional (None without FAISS)."""
+
+    def __init__(self, documents, vectorstore=None, mode=DEFAULT_MODE):
+        if mode not in MODES:
+            raise ValueError(f"Unknown retrieval mode {mode}")
+        if mode != 'bm25' and vectorstore is None:
+            logger.info(f"No vector store, {mode} retrieval falls back to BM25")
+            mode = 'bm25'
+        self.vectorstore = vectorstore
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._index = BM25Index(split_passages(documents))
+
+    @property
+    def passages(self):
+        return self._index.passages
+
+    def update(self, documents):
+        """Rebuild the BM25 index and sync the vector store after a KB change."""
+        passages = split_passages(documents)
+        if not passages:
+            # An empty or unreadable KB must not wipe the index
+            return
+        index = BM25Index(passages)
+        if self.vectorstore is not None:
+            kb_index.sync_index(self.vectorstore, passages, self.vectorstore.embeddings)
+        with self._lock:
+            self._index = index
+
+    def _vector_search(self, query, k, category):
+        with metrics.timer('retrieval_seconds', method='vector'):
+            docs = self.vectorstore.similarity_search(query, k=k * VECTOR_FETCH_FACTOR if category else k)
+        if category:
+            docs = [doc for doc in docs if matches_category(doc, category)] or docs
+        return docs[:k]
+
+    def search(self, query, k=3, category=None):
+        """The k best passages for the query, optionally restricted to a KB category."""
+        if self.mode == 'vector':
+            return self._vector_search(query, k, category)
+        with self._lock:
+            index = self._index
+        with metrics.timer('retrieval_seconds', method='bm25'):
+            scores = index.scores(query, index.in_category(category) if category else None)
+            ranked = sorted(scores, key=scores.get, reverse=True)
+        lexical = [index.passages[i] for i in ranked[:k]]
+        if self.mode == 'bm25':
+            return lexical
+        best = scores[ranked[0]] if ranked else 0.0
+        runner_up = scores[ranked[1]] if len(ranked) > 1 else 0.0
+        if best >= MIN_CONFIDENT_SCORE and best >= CONFIDENT_RATIO * runner_up:
+            return lexical
+        fused = {}
+        for results in (lexical, self._vector_search(query, k, category)):
+            for rank, doc in enumerate(results):
+                entry = fused.setdefault(doc.page_content, [doc, 0.0])
+                entry[1] += 1.0 / (RRF_K + rank + 1)
+        return [doc for doc, _ in sorted(fused.values(), key=lambda entry: entry[1], reverse=True)[:k]]
+
+    def as_retriever(self, k=3, category=None):
+        return _retriever_class()(kb=self, k=k, category=category)
+
+
+_retriever = None
+
+
+def _retriever_class():
+    # Defined on first use; langchain_core.retrievers takes most of a second to import
+    global _retriever
+    if _retriever is None:
+        from langchain_core.documents import Document
+        from langchain_core.retrievers import BaseRetriever
+
+        class KnowledgeBaseRetriever(BaseRetriever):
+            """LangChain retriever over KnowledgeBaseSearch, for RetrievalQA."""
+            kb: Any
+            k: int = 3
+            category: Optional[str] = None
+
+            def _get_relevant_documents(self, query, *, run_manager=None) -> List[Document]:
+                return self.kb.search(query, self.k, self.category)
+
+        _retriever = KnowledgeBaseRetriever
+    return _retriever
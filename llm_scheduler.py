@@ -0,0 +1,171 @@
+"""Rate-limited scheduler for LLM calls.
+
+Calls are governed by two token buckets: requests per minute and tokens per
+minute. A 429 from the API pauses every worker for an exponentially growing
+backoff and halves the effective rates. The rates then recover step by step on
+success. ``map`` sends a set of items either as multi-item batch prompts or as
+bounded concurrent single calls, and maps results back by key.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+RPM_LIMIT = 500
+TPM_LIMIT = 200000
+MAX_CONCURRENCY = 8
+BATCH_SIZE = 10  # emails per prompt in batch mode
+MAX_RETRIES = 5
+BACKOFF = 2.0  # seconds, doubled on every consecutive 429
+MIN_RATE_FACTOR = 0.1
+COMPLETION_TOKENS = 500  # expected completion (incl. reasoning) tokens per item
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text
+    return len(text or '') // 4 + 1
+
+
+def is_rate_limited(error):
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.factor = 1.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.per_minute * self.factor / 60.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return rate
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                rate = self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / rate
+            time.sleep(min(wait, 5.0))
+
+    def set_factor(self, factor):
+        with self._lock:
+            self._refill()
+            self.factor = max(MIN_RATE_FACTOR, min(1.0, factor))
+
+
+class LLMScheduler:
+    def __init__(self, rpm=RPM_LIMIT, tpm=TPM_LIMIT, max_concurrency=MAX_CONCURRENCY, batch_size=BATCH_SIZE,
+                 mode='concurrent', max_retries=MAX_RETRIES, backoff=BACKOFF):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.mode = mode
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limited = 0
+        self._pause_until = 0.0
+        self._consecutive_429 = 0
+        self._lock = threading.Lock()
+
+    def _wait_for_pause(self):
+        while True:
+            with self._lock:
+                wait = self._pause_until - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _on_rate_limit(self, error):
+        with self._lock:
+            self.rate_limited += 1
+            self._consecutive_429 += 1
+            delay = _retry_after(error) or self.backoff * (2 ** (self._consecutive_429 - 1))
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+            factor = self.requests.factor / 2
+        self.requests.set_factor(factor)
+        self.tokens.set_factor(factor)
+        logger.warning(f"LLM rate limited, pausing {delay:.1f}s at {factor:.0%} of the configured rate")
+
+    def _on_success(self):
+        with self._lock:
+            self._consecutive_429 = 0
+            factor = self.requests.factor
+        if factor < 1.0:
+            self.requests.set_factor(factor * 1.1)
+            self.tokens.set_factor(factor * 1.1)
+
+    def call(self, fn, *args, tokens=COMPLETION_TOKENS):
+        """Run fn(*args) within the rate limits, retrying on 429."""
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_pause()
+            self.requests.acquire(1)
+            self.tokens.acquire(tokens)
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if is_rate_limited(e) and attempt < self.max_retries:
+                    self._on_rate_limit(e)
+                    continue
+                raise
+            self._on_success()
+            return result
+
+    def map(self, single_fn, batch_fn, items, default):
+        """Run items ({key: text}) through the LLM and return {key: result}.
+
+        single_fn(text) returns one result; batch_fn(texts) returns a list aligned
+        with texts. Failed calls and None results map to default.
+        """
+        keys = list(items)
+        if not keys:
+            return {}
+        results = {}
+        if self.mode == 'batch' and batch_fn and len(keys) > 1:
+            groups = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+
+            def run_group(group):
+                texts = [items[key] for key in group]
+                tokens = sum(estimate_tokens(text) for text in texts) + COMPLETION_TOKENS * len(texts)
+                try:
+                    outputs = self.call(batch_fn, texts, tokens=tokens)
+                except Exception as e:
+                    logger.error(f"LLM batch of {len(group)} failed: {e}")
+                    outputs = []
+                return {key: (outputs[i] if i < len(outputs) else None) for i, key in enumerate(group)}
+
+            tasks, run = groups, run_group
+        else:
+            def run_single(key):
+                try:
+                    return {key: self.call(single_fn, items[key], tokens=estimate_tokens(items[key]) + COMPLETION_TOKENS)}
+                except Exception as e:
+                    logger.error(f"LLM call failed for {key}: {e}")
+                    return {key: None}
+
+            tasks, run = keys, run_single
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(tasks)), thread_name_prefix='llm') as pool:
+            for output in pool.map(run, tasks):
+                results.update(output)
+        return {key: (results.get(key) if results.get(key) is not None else default) for key in keys}
@@ -0,0 +1,268 @@
+"""In-process metrics and per-email tracing.
+
+Hot paths record latencies into fixed-bucket histograms and add to counters
+(LLM tokens and cost, emails processed). Gauges hold queue depths and backlogs.
+Everything lives in one process-wide registry. render() returns it in the
+Prometheus text format, which serve() exposes on a local HTTP port, and
+snapshot() returns a JSON-friendly copy that workers store with their
+heartbeat for the dashboard. Trace IDs are kept in a context variable, so the
+log filter can stamp them on every line written while an email is handled.
+"""
+import bisect
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+EMAIL_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+# name: (type, help, buckets)
+METRICS = {
+    'gmail_request_seconds': ('histogram', 'Gmail API call latency by operation', LATENCY_BUCKETS),
+    'embedding_request_seconds': ('histogram', 'Embedding API call latency (cache misses only)', LATENCY_BUCKETS),
+    'llm_request_seconds': ('histogram', 'LLM call latency by call type (QA: answer cache misses only)', LATENCY_BUCKETS),
+    'sqlite_write_seconds': ('histogram', 'SQLite write transaction latency', LATENCY_BUCKETS),
+    'retrieval_seconds': ('histogram', 'Knowledge base search latency by method', LATENCY_BUCKETS),
+    'pipeline_stage_seconds': ('histogram', 'Pipeline stage handler latency per batch', LATENCY_BUCKETS),
+    'email_processing_seconds': ('histogram', 'Time from ingestion to ack per email', EMAIL_BUCKETS),
+    'llm_tokens_total': ('counter', 'LLM tokens by call type and kind', None),
+    'llm_cost_usd_total': ('counter', 'Estimated LLM cost in USD by call type', None),
+    'emails_total': ('counter', 'Emails leaving a pipeline stage by result', None),
+    'answer_cache_total': ('counter', 'QA lookups in the answer cache by result', None),
+    'pipeline_queue_depth': ('gauge', 'Emails waiting in a stage queue', None),
+    'pipeline_backlog': ('gauge', 'Unfinished emails in the pipeline table per account', None),
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_counters = {}
+_gauges = {}
+_trace = contextvars.ContextVar('trace_id', default=None)
+_openai_callback = None
+_observers = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        values = _histograms.get(key)
+        if values is None:
+            values = _histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        values[bisect.bisect_left(buckets, value)] += 1
+        values[-1] += value
+    for observer in _observers:
+        observer(name, labels, value)
+
+
+def add_observer(fn):
+    """Also pass every histogram sample to fn(name, labels, value), e.g. to keep raw samples for exact percentiles."""
+    _observers.append(fn)
+
+
+def remove_observer(fn):
+    _observers.remove(fn)
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def clear_gauge(name):
+    with _lock:
+        for key in [key for key in _gauges if key[0] == name]:
+            del _gauges[key]
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _get_openai_callback():
+    # Imported on first use; langchain_community is heavy and optional here
+    global _openai_callback
+    if _openai_callback is None:
+        try:
+            from langchain_community.callbacks import get_openai_callback
+            _openai_callback = get_openai_callback
+        except Exception as e:
+            logger.warning(f"Token accounting unavailable: {e}")
+            _openai_callback = False
+    return _openai_callback
+
+
+@contextmanager
+def llm_call(call):
+    """Time the LLM calls made inside the block and count their tokens and cost."""
+    callback = _get_openai_callback()
+    start = time.perf_counter()
+    with (callback() if callback else nullcontext()) as usage:
+        try:
+            yield
+        finally:
+            observe('llm_request_seconds', time.perf_counter() - start, call=call)
+            if usage is not None:
+                inc('llm_tokens_total', usage.prompt_tokens, call=call, kind='prompt')
+                inc('llm_tokens_total', usage.completion_tokens, call=call, kind='completion')
+                inc('llm_cost_usd_total', usage.total_cost, call=call)
+
+
+# Tracing
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace():
+    return _trace.get()
+
+
+@contextmanager
+def tracing(trace_id):
+    token = _trace.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+
+
+class TraceFilter(logging.Filter):
+    """Adds %(trace_id)s to log records ('-' outside of an email)."""
+
+    def filter(self, record):
+        record.trace_id = _trace.get() or '-'
+        return True
+
+
+# Export
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render():
+    """The registry in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], values[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        else:
+            series = counters if kind == 'counter' else gauges
+            for (metric, labels), value in sorted(series.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """A JSON-friendly copy of the registry: {'histograms': [...], 'counters': [...], 'gauges': [...]}."""
+    with _lock:
+        return {
+            'histograms': [[name, dict(labels), list(values)] for (name, labels), values in _histograms.items()],
+            'counters': [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, dict(labels), value] for (name, labels), value in _gauges.items()],
+        }
+
+
+def merge(snapshots):
+    """Add up the snapshots of several processes into {'histograms'|'counters'|'gauges': {(name, labels): value}}."""
+    merged = {'histograms': {}, 'counters': {}, 'gauges': {}}
+    for snap in snapshots:
+        for kind, series in merged.items():
+            for name, labels, value in snap.get(kind, []):
+                if name not in METRICS:
+                    continue
+                key = _key(name, labels)
+                if kind == 'histograms':
+                    current = series.setdefault(key, [0] * len(value))
+                    series[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    series[key] = series.get(key, 0) + value
+    return merged
+
+
+def quantile(name, values, q):
+    """Estimate a quantile from histogram bucket counts by linear interpolation within the bucket."""
+    buckets = METRICS[name][2]
+    counts = values[:-1]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = buckets[i - 1] if i else 0.0
+            if i >= len(buckets):
+                return lower
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=METRICS_PORT, host='127.0.0.1'):
+    """Expose /metrics on a daemon thread. Returns the server, or None if the port is taken."""
+    try:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    except OSError as e:
+        logger.error(f"Metrics endpoint on {host}:{port} failed: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,212 @@
+"""Lean message fetch and body extraction.
+
+Messages are fetched in two batched passes. The first pass gets the headers with
+``format='metadata'``. The second runs only for emails that need a body. It
+requests ``format='full'`` restricted by a ``fields`` mask to the MIME tree and
+inline body data; Gmail leaves attachment data out of ``full`` responses. The
+text part is chosen by walking nested multipart trees: text/plain is preferred
+over text/html and attachments are ignored. Large text parts that Gmail stores
+as attachments are fetched separately, up to MAX_PART_BYTES. Decoding stops at
+the byte cap and HTML is converted to text, so memory per email stays bounded.
+"""
+import base64
+import logging
+from html.parser import HTMLParser
+
+import gmail_batch
+
+logger = logging.getLogger(__name__)
+
+METADATA_HEADERS = ['Subject', 'From', 'In-Reply-To', 'References', 'Message-Id', 'Auto-Submitted', 'Precedence',
+                    'X-Autoreply', 'X-Autorespond', 'X-Auto-Reply', 'Content-Type']
+MAX_BODY_BYTES = 256 * 1024  # decoded bytes kept per text part
+MAX_BODY_CHARS = 50000  # characters kept after HTML conversion
+MAX_PART_BYTES = 1024 * 1024  # larger attachment-stored text parts are not downloaded
+MAX_DEPTH = 8  # nesting levels covered by the fields mask
+HTML_SKIP_TAGS = ('script', 'style', 'head', 'title')
+HTML_BLOCK_TAGS = ('br', 'p', 'div', 'tr', 'li', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'hr')
+
+
+def body_fields(depth=MAX_DEPTH):
+    """fields mask for messages.get covering MIME trees up to depth levels deep."""
+    part = "partId,mimeType,filename,headers(name,value),body(size,data,attachmentId)"
+    mask = part
+    for _ in range(depth):
+        mask = f"{part},parts({mask})"
+    return f"id,payload({mask})"
+
+
+BODY_FIELDS = body_fields()
+
+
+class HTMLTextExtractor(HTMLParser):
+    def __init__(self, max_chars=MAX_BODY_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.chunks = []
+        self.length = 0
+        self._skip = 0
+
+    @property
+    def full(self):
+        return self.length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIP_TAGS:
+            self._skip += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_data(self, data):
+        if self._skip or not data:
+            return
+        # Keep one space at the edges, so 'Hello <b>there</b>' doesn't become 'Hellothere'
+        words = ' '.join(data.split())
+        lead = ' ' if data[0].isspace() else ''
+        trail = ' ' if data[-1].isspace() and words else ''
+        self._append(lead + words + trail)
+
+    def _append(self, text):
+        if text and not self.full:
+            self.chunks.append(text)
+            self.length += len(text)
+
+    def text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.chunks).split('\n'))
+        text, blank = [], False
+        for line in lines:
+            if line or not blank:
+                text.append(line)
+            blank = not line
+        return '\n'.join(text).strip()[:self.max_chars]
+
+
+def html_to_text(html, max_chars=MAX_BODY_CHARS, chunk_size=8192):
+    parser = HTMLTextExtractor(max_chars)
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start:start + chunk_size])
+        if parser.full:
+            break
+    parser.close()
+    return parser.text()
+
+
+def _header(part, name):
+    for header in part.get('headers') or []:
+        if header['name'].lower() == name.lower():
+            return header['value']
+    return None
+
+
+def part_charset(part):
+    content_type = _header(part, 'Content-Type') or ''
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or 'utf-8'
+    return 'utf-8'
+
+
+def decode_data(data, max_bytes=MAX_BODY_BYTES):
+    """Decode base64url body data, stopping after max_bytes decoded bytes."""
+    data = data[:(max_bytes // 3 + 1) * 4]
+    data += '=' * (-len(data) % 4)
+    return base64.urlsafe_b64decode(data)[:max_bytes]
+
+
+def _is_attachment(part):
+    disposition = (_header(part, 'Content-Disposition') or '').lower()
+    return bool(part.get('filename')) or disposition.startswith('attachment')
+
+
+def select_text_part(payload, depth=0):
+    """Return the best text part of a MIME tree: text/plain first, then text/html, else None."""
+    mime = (payload.get('mimeType') or '').lower()
+    if mime in ('text/plain', 'text/html'):
+        return None if _is_attachment(payload) else payload
+    if not mime.startswith('multipart/') or depth > MAX_DEPTH:
+        return None
+    candidates = [select_text_part(part, depth + 1) for part in payload.get('parts') or []]
+    candidates = [part for part in candidates if part]
+    for part in candidates:
+        if part['mimeType'].lower() == 'text/plain':
+            return part
+    return candidates[0] if candidates else None
+
+
+def part_text(part, data, max_chars=MAX_BODY_CHARS):
+    """Text of a selected part from its base64url data."""
+    charset = part_charset(part)
+    raw = decode_data(data)
+    try:
+        text = raw.decode(charset, errors='ignore')
+    except LookupError:
+        text = raw.decode('utf-8', errors='ignore')
+    if part['mimeType'].lower() == 'text/html':
+        return html_to_text(text, max_chars)
+    return text[:max_chars]
+
+
+def extract_text(payload, max_chars=MAX_BODY_CHARS):
+    """Text of a full-format payload, or '' when the text part is missing or stored as an attachment."""
+    part = select_text_part(payload)
+    if not part or 'data' not in (part.get('body') or {}):
+        return ''
+    return part_text(part, part['body']['data'], max_chars)
+
+
+def fetch_messages(service, message_ids, needs_body=None):
+    """Fetch headers and text bodies. Returns ({id: message}, {id: error}).
+
+    Messages are metadata-format dicts with the decoded text under 'body_text'.
+    needs_body(message) may return False to skip the body fetch; those
+    messages get their snippet as body_text.
+    """
+    msgs, errors = gmail_batch.batch_get_messages(service, message_ids, format='metadata',
+                                                  metadataHeaders=METADATA_HEADERS)
+    body_ids = []
+    for message_id, msg in msgs.items():
+        if needs_body is None or needs_body(msg):
+            body_ids.append(message_id)
+        else:
+            msg['body_text'] = msg.get('snippet', '')
+    if not body_ids:
+        return msgs, errors
+    bodies, body_errors = gmail_batch.batch_get_messages(service, body_ids, format='full', fields=BODY_FIELDS)
+    attached = {}
+    for message_id in body_ids:
+        if message_id in body_errors:
+            errors[message_id] = body_errors[message_id]
+            del msgs[message_id]
+            continue
+        part = select_text_part(bodies[message_id]['payload'])
+        body = (part or {}).get('body') or {}
+        if 'data' in body:
+            msgs[message_id]['body_text'] = part_text(part, body['data'])
+        elif body.get('attachmentId') and body.get('size', 0) <= MAX_PART_BYTES:
+            attached[message_id] = part
+        else:
+            if part:
+                logger.warning(f"Text part of {message_id} skipped ({body.get('size', 0)} bytes)")
+            msgs[message_id]['body_text'] = ''
+    if attached:
+        attachments = service.users().messages().attachments()
+        requests = {
+            message_id: (lambda message_id=message_id: attachments.get(
+                userId='me', messageId=message_id, id=attached[message_id]['body']['attachmentId']))
+            for message_id in attached
+        }
+        responses, attachment_errors = gmail_batch.execute_batch(service, requests)
+        for message_id, part in attached.items():
+            if message_id in responses:
+                msgs[message_id]['body_text'] = part_text(part, responses[message_id].get('data', ''))
+            else:
+                errors[message_id] = attachment_errors[message_id]
+                del msgs[message_id]
+    return msgs, errors
@@ -0,0 +1,113 @@
+"""Order store for refund processing.
+
+Orders come from an external export. import_orders streams a CSV or JSONL file
+into the orders table in batched transactions, so memory stays flat whatever
+the file size. request_refund checks and flags an order with one conditional
+UPDATE. A bounded LRU remembers unknown order IDs for a few minutes, so
+repeated invalid IDs skip the database. Imports from other processes show up
+once those entries expire.
+
+Usage: python order_store.py orders.csv [--update-existing]
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = 10000
+MISSING_CACHE_SIZE = 10000  # 0 disables the cache
+MISSING_CACHE_TTL = 300  # seconds
+
+SQL_INSERT_ORDER = "INSERT OR IGNORE INTO orders (order_id, status) VALUES (?, ?)"
+SQL_UPSERT_ORDER = """
+    INSERT INTO orders (order_id, status) VALUES (?, ?)
+    ON CONFLICT(order_id) DO UPDATE SET status = excluded.status
+"""
+SQL_REQUEST_REFUND = "UPDATE orders SET status = 'refund_requested' WHERE order_id = ?"
+
+_missing = OrderedDict()
+_missing_lock = threading.Lock()
+
+
+def _read_rows(path, fmt):
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fmt == "jsonl":
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield str(record["order_id"]).strip(), record.get("status") or "active"
+        else:
+            for record in csv.DictReader(f):
+                yield record["order_id"].strip(), (record.get("status") or "active").strip()
+
+
+def import_orders(conn, path, fmt=None, batch_size=IMPORT_BATCH_SIZE, update_existing=False):
+    """Stream orders from a CSV (order_id,status) or JSONL file. Returns the number of rows read."""
+    fmt = fmt or ("jsonl" if path.endswith((".jsonl", ".json")) else "csv")
+    sql = SQL_UPSERT_ORDER if update_existing else SQL_INSERT_ORDER
+    total = 0
+    batch = []
+    for order_id, status in _read_rows(path, fmt):
+        if not order_id:
+            continue
+        batch.append((order_id, status))
+        if len(batch) >= batch_size:
+            with conn:
+                conn.executemany(sql, batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        with conn:
+            conn.executemany(sql, batch)
+        total += len(batch)
+    clear_cache()
+    logger.info(f"Imported {total} orders from {path}")
+    return total
+
+
+def clear_cache():
+    with _missing_lock:
+        _missing.clear()
+
+
+def request_refund(conn, order_id):
+    """Flag an order as refund_requested. Returns False if the order does not exist."""
+    with _missing_lock:
+        cached_at = _missing.get(order_id)
+        if cached_at is not None:
+            if time.monotonic() - cached_at < MISSING_CACHE_TTL:
+                _missing.move_to_end(order_id)
+                return False
+            del _missing[order_id]
+    with conn:
+        found = conn.execute(SQL_REQUEST_REFUND, (order_id,)).rowcount > 0
+    if not found and MISSING_CACHE_SIZE:
+        with _missing_lock:
+            _missing[order_id] = time.monotonic()
+            while len(_missing) > MISSING_CACHE_SIZE:
+                _missing.popitem(last=False)
+    return found
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Bulk import orders into the support DB")
+    parser.add_argument("path", help="CSV with order_id,status columns or JSONL with order_id/status keys")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default=None)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--update-existing", action="store_true", help="overwrite the status of known orders")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        parser.error(f"{args.path} not found")
+    conn = storage.connect()
+    storage.init_db(conn)
+    import_orders(conn, args.path, args.format, args.batch_size, args.update_existing)
+    conn.close()
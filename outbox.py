@@ -0,0 +1,171 @@
+"""Durable outbox for replies.
+
+Processing never talks to Gmail to send. enqueue() generates the reply's
+Message-ID locally with email.utils.make_msgid and stores the reply through
+storage's writes. The handlers run inside storage.grouped_writes() (see
+agent.dispatch_prepared), so the reply commits in one transaction with the
+rest of the email's state, such as the pending refund that references the
+Message-ID. A sender thread delivers due rows and retries transient failures
+with exponential backoff. Each incoming email gets at most one outbox row; an
+email handled again gets the Message-ID of its stored reply back. Before a
+retry, the reply is looked up in Gmail by its Message-ID, so a send that went
+through before a failure or crash is not delivered twice.
+"""
+import base64
+import email.utils
+import logging
+import threading
+import time
+from datetime import datetime
+from email.mime.text import MIMEText
+
+import gmail_batch
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+BACKOFF = 5.0  # seconds, doubled on every failed attempt
+MAX_BACKOFF = 3600.0
+POLL_INTERVAL = 2.0  # seconds between outbox scans when idle
+SEND_BATCH = 20  # rows claimed per scan
+SENDING_TIMEOUT = 300.0  # seconds before a row stuck in 'sending' is picked up again
+NO_SERVICE_DELAY = 60.0  # seconds to defer replies of accounts without a Gmail service
+
+SQL_DUE = """
+    SELECT * FROM outbox WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+    ORDER BY next_attempt_at, id LIMIT ?
+"""
+SQL_CLAIM = "UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ? AND status = ? AND attempts = ?"
+SQL_SENT = "UPDATE outbox SET status = 'sent', gmail_id = ?, sent_at = ?, last_error = NULL WHERE id = ?"
+SQL_RETRY = "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?"
+SQL_DEFER = "UPDATE outbox SET next_attempt_at = ? WHERE id = ?"
+
+
+def make_message_id(from_address=None):
+    domain = from_address.rpartition('@')[2] if from_address and '@' in from_address else 'localhost'
+    return email.utils.make_msgid(domain=domain)
+
+
+def enqueue(conn, account, from_address, email_id, to_email, subject, body):
+    """Queue a reply to email_id. Returns the reply's Message-ID, or None if it could not be stored.
+
+    If email_id already has a reply (e.g. its act stage ran again), that reply is kept and its Message-ID returned.
+    """
+    stored = storage.get_outbox_message_id(conn, email_id)
+    if stored:
+        logger.info(f"Reply to {email_id} already queued as {stored}")
+        return stored
+    message_id = make_message_id(from_address)
+    if storage.insert_outbox_reply(conn, message_id, account, email_id, to_email, subject, body):
+        return message_id
+    return None
+
+
+def build_raw(row):
+    message = MIMEText(row['body'])
+    message['To'] = row['to_email']
+    message['Subject'] = row['subject']
+    message['Message-ID'] = row['message_id']
+    if row['email_id']:
+        message['In-Reply-To'] = row['email_id']
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+def find_sent(service, message_id):
+    """Gmail id of an already sent message with this Message-ID, or None."""
+    query = f"rfc822msgid:{message_id.strip('<>')}"
+    result = service.users().messages().list(userId='me', q=query, labelIds=['SENT'], maxResults=1).execute()
+    messages = result.get('messages') or []
+    return messages[0]['id'] if messages else None
+
+
+def retry_delay(attempts, backoff=BACKOFF):
+    return min(MAX_BACKOFF, backoff * (2 ** max(0, attempts - 1)))
+
+
+def deliver(conn, service, row, sending_timeout=SENDING_TIMEOUT):
+    """Claim and send one due row. Returns True once the row is sent."""
+    now = time.time()
+    with conn:
+        # The claim doubles as the stale 'sending' timeout for the next scan
+        claimed = conn.execute(SQL_CLAIM, (now + sending_timeout, row['id'], row['status'], row['attempts'])).rowcount
+    if not claimed:
+        return False
+    attempts = row['attempts'] + 1
+    try:
+        gmail_id = None
+        if row['attempts']:
+            with metrics.timer('gmail_request_seconds', op='search'):
+                gmail_id = find_sent(service, row['message_id'])
+        if gmail_id is None:
+            with metrics.timer('gmail_request_seconds', op='send'):
+                gmail_id = service.users().messages().send(userId='me', body={'raw': build_raw(row)}).execute()['id']
+        with conn:
+            conn.execute(SQL_SENT, (gmail_id, datetime.now().isoformat(), row['id']))
+        logger.info(f"Sent reply {row['message_id']} for {row['email_id']} (Gmail ID: {gmail_id})")
+        return True
+    except Exception as e:
+        failed = attempts >= MAX_ATTEMPTS or (gmail_batch.error_status(e) and not gmail_batch.is_retryable(e))
+        with conn:
+            conn.execute(SQL_RETRY, ('failed' if failed else 'pending', now + retry_delay(attempts), str(e)[:500], row['id']))
+        if failed:
+            logger.error(f"Reply {row['message_id']} for {row['email_id']} failed after {attempts} attempts: {e}")
+        else:
+            logger.warning(f"Reply {row['message_id']} for {row['email_id']} failed (attempt {attempts}), retrying: {e}")
+        return False
+
+
+def send_due(conn, service_for, batch=SEND_BATCH, sending_timeout=SENDING_TIMEOUT):
+    """Send the due replies. service_for(account) returns a Gmail service. Returns the number sent."""
+    rows = conn.execute(SQL_DUE, (time.time(), batch)).fetchall()
+    sent = 0
+    for row in rows:
+        service = service_for(row['account'])
+        if service is None:
+            logger.warning(f"No Gmail service for {row['account']}, reply {row['message_id']} stays queued")
+            with conn:
+                conn.execute(SQL_DEFER, (time.time() + NO_SERVICE_DELAY, row['id']))
+            continue
+        sent += deliver(conn, service, row, sending_timeout)
+    return sent
+
+
+def get_counts(conn):
+    rows = conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+class OutboxSender:
+    """Background thread draining the outbox while the event is set."""
+
+    def __init__(self, service_for, event, poll_interval=POLL_INTERVAL):
+        self.service_for = service_for
+        self.event = event
+        self.poll_interval = poll_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = storage.get_connection()
+        while self.event.is_set():
+            try:
+                sent = send_due(conn, self.service_for)
+            except Exception as e:
+                logger.error(f"Outbox error: {e}")
+                sent = 0
+            if not sent:
+                # The event is set while running, so sleep in short steps
+                deadline = time.monotonic() + self.poll_interval
+                while self.event.is_set() and time.monotonic() < deadline:
+                    time.sleep(min(0.5, self.poll_interval))
+        logger.info("Outbox sender stopped")
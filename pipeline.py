@@ -0,0 +1,320 @@
+"""Staged email pipeline: ingest -> parse -> classify -> act -> ack.
+
+Stages are connected by bounded queues and each runs its own threads, so a
+slow LLM call no longer stalls Gmail ingestion. Every email is a row in the
+pipeline table holding its stage, the data produced so far and its owner
+(worker id). A stage moves an email on by updating that row through
+storage.write, in the same buffered transaction as the stage's own writes. An
+email never runs the same stage twice once its results are committed.
+
+Queues only hold what fits in memory. An email whose next queue is full, or
+whose stage asked for a retry, stays in the table, and load() puts it back once
+there is room or its retry time has come. load() also resumes the rows of a
+previous run and takes over rows of workers that are gone, for the accounts
+this worker owns. Ingestion stops fetching while the table holds MAX_BACKLOG
+unfinished emails, so backpressure reaches Gmail.
+
+Ingestion claims each email with one conditional insert: the row is only
+created if no other worker has the email in its pipeline and it is not in
+processed_emails_full yet. Only claimed emails are queued, so two workers
+that both list an email (e.g. while an account lease changes hands) never
+both process it.
+
+Each email gets a trace ID at ingestion. It is stored with the row and set
+as the current trace (see metrics.tracing) while a stage handles the email.
+"""
+import json
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+import coordination
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('parse', 'classify', 'act', 'ack')  # ingest feeds 'parse'
+NEXT_STAGE = {'parse': 'classify', 'classify': 'act', 'act': 'ack', 'ack': None}
+QUEUE_SIZE = 100  # emails held in memory per stage
+MAX_BACKLOG = 2000  # unfinished emails in the table before ingestion pauses
+MAX_ATTEMPTS = 5  # per stage, then the email is parked in stage 'failed'
+RETRY_DELAY = 30.0  # seconds, doubled on every attempt
+LOAD_INTERVAL = 2.0  # seconds between scans of the table for rows to queue
+STAGE_WORKERS = {'parse': 2, 'classify': 8, 'act': 4, 'ack': 1}
+BATCH_SIZES = {'parse': 1, 'classify': 1, 'act': 1, 'ack': 100}
+
+SQL_CLAIM = """
+    INSERT OR IGNORE INTO pipeline (email_id, account, stage, data, owner, attempts, next_attempt_at, created_at, updated_at, trace_id)
+    SELECT ?, ?, 'parse', ?, ?, 0, 0, ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM processed_emails_full WHERE email_id = ?)
+"""
+SQL_ADVANCE = "UPDATE pipeline SET stage = ?, data = ?, attempts = 0, next_attempt_at = 0, updated_at = ? WHERE email_id = ?"
+SQL_RETRY = "UPDATE pipeline SET stage = ?, attempts = ?, next_attempt_at = ?, updated_at = ? WHERE email_id = ?"
+SQL_DELETE = "DELETE FROM pipeline WHERE email_id = ?"
+SQL_DUE = """
+    SELECT * FROM pipeline
+    WHERE stage = ? AND next_attempt_at <= ? AND account IN ({accounts})
+      AND (owner = ? OR owner NOT IN (SELECT worker_id FROM workers WHERE status = 'running' AND heartbeat_at >= ?))
+    ORDER BY created_at LIMIT ?
+"""
+
+
+def backlog_by_account(conn):
+    """{account: unfinished emails} from the pipeline table."""
+    rows = conn.execute("SELECT account, COUNT(*) FROM pipeline WHERE stage != 'failed' GROUP BY account").fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+class Item:
+    __slots__ = ('email_id', 'account', 'data', 'attempts', 'trace_id', 'created_at')
+
+    def __init__(self, email_id, account, data, attempts=0, trace_id=None, created_at=None):
+        self.email_id = email_id
+        self.account = account
+        self.data = data
+        self.attempts = attempts
+        self.trace_id = trace_id or metrics.new_trace_id()
+        self.created_at = created_at or time.time()
+
+
+class Pipeline:
+    """Runs stage handlers on their own threads.
+
+    handlers maps each stage to fn(items) returning {email_id: result}, where
+    True moves the email to the next stage (ack: done), False drops it and
+    None retries the stage later. Handlers may update item.data in place.
+    The loader thread queues rows of the accounts given to set_accounts().
+    """
+
+    def __init__(self, handlers, owner, queue_size=QUEUE_SIZE, workers=None, batch_sizes=None,
+                 load_interval=LOAD_INTERVAL):
+        self.handlers = handlers
+        self.owner = owner
+        self.accounts = []
+        self.workers = {**STAGE_WORKERS, **(workers or {})}
+        self.batch_sizes = {**BATCH_SIZES, **(batch_sizes or {})}
+        self.load_interval = load_interval
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in STAGES}
+        self.completed = 0
+        self._inflight = set()
+        # Stage moves and load() hold the lock, so load() never sees a row whose move is not flushed yet
+        self._lock = threading.Lock()
+        self._busy = threading.Condition()
+        self._active = 0
+        self._paused = False
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for stage in STAGES:
+            for i in range(self.workers[stage]):
+                self._spawn(self._run, f"{stage}-{i}", stage)
+        self._spawn(self._load_loop, "pipeline-loader")
+        return self
+
+    def _spawn(self, target, name, *args):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        """Finish the batches in progress. Queued emails stay in the table for the next start."""
+        self._stopped.set()
+        self._wake.set()
+        with self._busy:
+            self._paused = False
+            self._busy.notify_all()
+        for thread in self._threads:
+            thread.join()
+        try:
+            storage.flush()
+        except Exception as e:
+            # The unsaved stage moves are redone from the table after a restart
+            logger.error(f"Pipeline final flush failed: {e}")
+
+    @contextmanager
+    def paused(self):
+        """Hold the stage workers between batches, e.g. while the KB index is rebuilt."""
+        with self._busy:
+            self._paused = True
+            while self._active:
+                self._busy.wait()
+        try:
+            yield
+        finally:
+            with self._busy:
+                self._paused = False
+                self._busy.notify_all()
+
+    def set_accounts(self, accounts):
+        """Accounts this worker owns now; their rows are queued right away."""
+        if accounts != self.accounts:
+            self.accounts = list(accounts)
+            self._wake.set()
+
+    def depths(self):
+        return {stage: q.qsize() for stage, q in self.queues.items()}
+
+    # Persistence
+    def backlog(self, conn):
+        return conn.execute("SELECT COUNT(*) FROM pipeline WHERE stage != 'failed'").fetchone()[0]
+
+    def filter_new(self, conn, email_ids):
+        """Drop the ids already in the pipeline table."""
+        known = set()
+        for start in range(0, len(email_ids), storage.IN_CHUNK):
+            chunk = email_ids[start:start + storage.IN_CHUNK]
+            rows = conn.execute(f"SELECT email_id FROM pipeline WHERE email_id IN ({','.join('?' * len(chunk))})", chunk)
+            known.update(row[0] for row in rows)
+        return [email_id for email_id in email_ids if email_id not in known]
+
+    def claim(self, conn, account, emails):
+        """Ingest [(email_id, data)] into the parse stage in one transaction. Returns the items this worker claimed."""
+        items = [Item(email_id, account, data) for email_id, data in emails]
+        claimed = []
+        with self._lock:
+            with metrics.timer('sqlite_write_seconds', kind='claim'), conn:
+                for item in items:
+                    if conn.execute(SQL_CLAIM, (item.email_id, account, json.dumps(item.data), self.owner, item.created_at,
+                                                item.created_at, item.trace_id, item.email_id)).rowcount:
+                        claimed.append(item)
+            for item in claimed:
+                self._offer('parse', item)
+        if len(claimed) < len(items):
+            logger.info(f"{len(items) - len(claimed)} emails of {account} already claimed or processed, skipped")
+        return claimed
+
+    def load(self, conn, accounts):
+        """Queue due rows of the given accounts that are not in memory yet, as far as the queues have room."""
+        if not accounts:
+            return 0
+        loaded = 0
+        sql = SQL_DUE.format(accounts=','.join('?' * len(accounts)))
+        with self._lock:
+            storage.flush()
+            now = time.time()
+            for stage in STAGES:
+                room = self.queues[stage].maxsize - self.queues[stage].qsize()
+                if room <= 0:
+                    continue
+                rows = conn.execute(sql, (stage, now, *accounts, self.owner, now - coordination.WORKER_TIMEOUT,
+                                          room + len(self._inflight))).fetchall()
+                queued = 0
+                for row in rows:
+                    if queued >= room:
+                        break
+                    if row['email_id'] in self._inflight:
+                        continue
+                    if row['owner'] != self.owner:
+                        with conn:
+                            claimed = conn.execute("UPDATE pipeline SET owner = ? WHERE email_id = ? AND owner = ?",
+                                                   (self.owner, row['email_id'], row['owner'])).rowcount
+                        if not claimed:
+                            continue
+                    item = Item(row['email_id'], row['account'], json.loads(row['data']), row['attempts'],
+                                row['trace_id'], row['created_at'])
+                    if self._offer(stage, item):
+                        queued += 1
+                loaded += queued
+        return loaded
+
+    def _load_loop(self):
+        conn = storage.get_connection()
+        while not self._stopped.is_set():
+            try:
+                loaded = self.load(conn, list(self.accounts))
+                if loaded:
+                    logger.info(f"Pipeline queued {loaded} emails from the DB")
+                self.report(conn)
+            except Exception as e:
+                logger.error(f"Pipeline load failed: {e}")
+            self._wake.wait(self.load_interval)
+            self._wake.clear()
+
+    def report(self, conn):
+        """Update the queue depth and per-account backlog gauges."""
+        for stage, depth in self.depths().items():
+            metrics.set_gauge('pipeline_queue_depth', depth, stage=stage)
+        metrics.clear_gauge('pipeline_backlog')
+        for account, count in backlog_by_account(conn).items():
+            metrics.set_gauge('pipeline_backlog', count, account=account)
+
+    def _offer(self, stage, item):
+        # Callers hold self._lock
+        if item.email_id in self._inflight:
+            return False
+        try:
+            self.queues[stage].put_nowait(item)
+        except queue.Full:
+            return False
+        self._inflight.add(item.email_id)
+        return True
+
+    # Stage workers
+    def _take(self, stage):
+        q = self.queues[stage]
+        try:
+            items = [q.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(items) < self.batch_sizes[stage]:
+            try:
+                items.append(q.get(timeout=0.05))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self, stage):
+        conn = storage.get_connection()
+        while not self._stopped.is_set():
+            with self._busy:
+                while self._paused and not self._stopped.is_set():
+                    self._busy.wait()
+                self._active += 1
+            try:
+                items = self._take(stage)
+                if not items:
+                    continue
+                with metrics.tracing(','.join(item.trace_id for item in items)), \
+                        metrics.timer('pipeline_stage_seconds', stage=stage):
+                    try:
+                        results = self.handlers[stage](items) or {}
+                    except Exception as e:
+                        logger.error(f"Pipeline stage {stage} failed for {len(items)} emails: {e}")
+                        results = {}
+                for item in items:
+                    with metrics.tracing(item.trace_id):
+                        self._advance(conn, stage, item, results.get(item.email_id))
+            finally:
+                with self._busy:
+                    self._active -= 1
+                    self._busy.notify_all()
+
+    def _advance(self, conn, stage, item, result):
+        now = time.time()
+        next_stage = NEXT_STAGE[stage]
+        metrics.inc('emails_total', stage=stage, result={True: 'ok', False: 'skipped', None: 'retry'}[result])
+        if result and next_stage is None:
+            metrics.observe('email_processing_seconds', now - item.created_at)
+            logger.info(f"Email {item.email_id} done {now - item.created_at:.1f}s after ingestion")
+        with self._lock:
+            self._inflight.discard(item.email_id)
+            if result is None:
+                item.attempts += 1
+                parked = item.attempts >= MAX_ATTEMPTS
+                if parked:
+                    logger.error(f"Email {item.email_id} failed {item.attempts} times in stage {stage}, parked")
+                storage.write(conn, SQL_RETRY, ('failed' if parked else stage, item.attempts,
+                                                now + RETRY_DELAY * (2 ** (item.attempts - 1)), now, item.email_id))
+            elif result is False or next_stage is None:
+                storage.write(conn, SQL_DELETE, (item.email_id,))
+                self.completed += bool(result)
+            else:
+                storage.write(conn, SQL_ADVANCE, (next_stage, json.dumps(item.data), now, item.email_id))
+                item.attempts = 0
+                # A full queue leaves the email in the table for load()
+                self._offer(next_stage, item)
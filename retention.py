@@ -0,0 +1,256 @@
+"""Retention and compaction of the email history tables.
+
+A pass goes through processed_emails_full, unhandled_emails and
+not_found_refunds in batches of BATCH_SIZE rows, one short transaction per
+batch, so it can run next to live workers:
+
+1. Rows written before the content store have their body moved to
+   email_contents (see content_store.py). The FTS index of processed emails
+   keeps covering their full text.
+2. With --days, rows older than that are deleted, after being copied with
+   their bodies to the --archive DB when one is given. A body is deleted with
+   the last row referencing it.
+3. PRAGMA incremental_vacuum hands up to VACUUM_PAGES free pages back to the
+   file system, so the DB file shrinks instead of only reusing its pages.
+
+Incremental vacuum needs auto_vacuum=INCREMENTAL, which new DBs get from
+storage.connect(). --convert switches an existing DB with one full VACUUM;
+stop the workers first. Workers started with --retention-days run a pass every
+PASS_INTERVAL seconds in a background thread; a lease keeps it to one worker.
+
+A pruned processed email is no longer known to the dedupe check, so keep
+--days longer than any mail the workers or a backfill may read again.
+
+Usage: python retention.py [--days 90] [--archive support_archive.db] [--convert]
+"""
+import argparse
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import content_store
+import coordination
+import metrics
+import storage
+
+logger = logging.getLogger("retention")
+
+TABLES = {table: time_col for table, time_col, _ in storage.HISTORY_TABLES.values()}
+BATCH_SIZE = 500  # rows compacted or pruned per transaction
+BATCH_PAUSE = 0.05  # seconds between batches, so live writers get the DB lock
+VACUUM_PAGES = 5000  # free pages returned per pass
+PASS_INTERVAL = 3600  # seconds between passes in a worker
+RETENTION_JOB = 'retention'  # job_leases row held by the worker running the passes
+ARCHIVE_FILE = "support_archive.db"
+
+
+def _placeholders(values):
+    return ",".join("?" * len(values))
+
+
+def attach_archive(conn, path):
+    """Attach the archive DB as 'archive' and create or extend its tables to match the live ones."""
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    with conn:
+        conn.execute(content_store.CONTENTS_DDL.format(schema='archive.'))
+        for table in TABLES:
+            columns = conn.execute(f"PRAGMA main.table_info({table})").fetchall()
+            definitions = ", ".join(f"{col['name']} {col['type']}{' PRIMARY KEY' if col['pk'] else ''}" for col in columns)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} ({definitions})")
+            archived = {col['name'] for col in conn.execute(f"PRAGMA archive.table_info({table})").fetchall()}
+            for col in columns:
+                if col['name'] not in archived:
+                    conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {col['name']} {col['type']}")
+
+
+def compact_batch(conn, table, batch=BATCH_SIZE):
+    """Move the bodies of up to batch uncompacted rows to the content store. Returns the rows done."""
+    rows = conn.execute(f"SELECT email_id, content FROM {table} WHERE {content_store.UNCOMPACTED} LIMIT ?",
+                        (batch,)).fetchall()
+    if not rows:
+        return 0
+    # The contentless FTS index of processed_emails_full would only see the preview
+    indexed = table == 'processed_emails_full' and storage.index_full_text(conn)
+    contents = [content_store.split_content(row['content']) for row in rows]
+    with metrics.timer('sqlite_write_seconds', kind='compact'), conn:
+        conn.executemany(content_store.SQL_INSERT_CONTENT, [content_row for _, _, content_row in contents])
+        for row, (text, digest, _) in zip(rows, contents):
+            # A row rewritten by a worker since the SELECT already has its hash and is left alone
+            updated = conn.execute(f"UPDATE {table} SET content = ?, content_hash = ? WHERE email_id = ? AND content_hash IS NULL",
+                                   (text, digest, row['email_id'])).rowcount
+            if updated and indexed:
+                conn.execute(storage.SQL_INDEX_PROCESSED, (row['content'], row['email_id']))
+    return len(rows)
+
+
+def delete_orphans(conn, hashes):
+    """Delete the bodies among hashes that no history row references any more."""
+    unreferenced = " AND ".join(f"NOT EXISTS (SELECT 1 FROM {table} WHERE content_hash = email_contents.hash)"
+                                for table in TABLES)
+    deleted = 0
+    for start in range(0, len(hashes), storage.IN_CHUNK):
+        chunk = hashes[start:start + storage.IN_CHUNK]
+        deleted += conn.execute(f"DELETE FROM email_contents WHERE hash IN ({_placeholders(chunk)}) AND {unreferenced}",
+                                chunk).rowcount
+    return deleted
+
+
+def prune_batch(conn, table, cutoff, batch=BATCH_SIZE, archive=False):
+    """Delete (archiving first if asked) up to batch rows older than cutoff. Returns (rows, bodies) deleted."""
+    time_col = TABLES[table]
+    rows = conn.execute(f"SELECT email_id, content_hash FROM {table} WHERE {time_col} < ? ORDER BY {time_col} LIMIT ?",
+                        (cutoff, batch)).fetchall()
+    if not rows:
+        return 0, 0
+    ids = [row['email_id'] for row in rows]
+    hashes = sorted({row['content_hash'] for row in rows if row['content_hash']})
+    with metrics.timer('sqlite_write_seconds', kind='prune'), conn:
+        if archive:
+            columns = ", ".join(col['name'] for col in conn.execute(f"PRAGMA main.table_info({table})").fetchall())
+            conn.execute(f"INSERT OR IGNORE INTO archive.{table} ({columns}) "
+                         f"SELECT {columns} FROM main.{table} WHERE email_id IN ({_placeholders(ids)})", ids)
+            if hashes:
+                conn.execute(f"INSERT OR IGNORE INTO archive.email_contents ({content_store.CONTENT_COLUMNS}) "
+                             f"SELECT {content_store.CONTENT_COLUMNS} FROM main.email_contents "
+                             f"WHERE hash IN ({_placeholders(hashes)})", hashes)
+        conn.execute(f"DELETE FROM main.{table} WHERE email_id IN ({_placeholders(ids)})", ids)
+        bodies = delete_orphans(conn, hashes)
+    return len(ids), bodies
+
+
+def incremental_vacuum(conn, pages=VACUUM_PAGES):
+    """Return up to pages free pages to the file system. Returns the pages freed (0 without auto_vacuum=INCREMENTAL)."""
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+        return 0
+    before = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    # The pragma frees one page per step and returns no rows, so execute() would stop after the first;
+    # executescript() steps it to the end
+    conn.executescript(f"PRAGMA main.incremental_vacuum({int(pages)});")
+    return before - conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+
+
+def convert_to_incremental(conn):
+    """Switch an existing DB to auto_vacuum=INCREMENTAL. Rewrites the whole file, so run it with the workers stopped."""
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    # VACUUM may renumber the rowids of processed_emails_full, which the FTS index refers to
+    storage.rebuild_fts(conn)
+    logger.info("DB converted to incremental vacuum")
+
+
+def run_pass(conn, days=None, archive=None, event=None, batch=BATCH_SIZE, vacuum_pages=VACUUM_PAGES):
+    """One compaction, retention and vacuum pass. Stops early once event is cleared. Returns the totals."""
+    totals = {'compacted': 0, 'pruned': 0, 'bodies': 0, 'pages': 0}
+
+    def running():
+        return event is None or event.is_set()
+
+    started = time.monotonic()
+    for table in TABLES:
+        while running():
+            done = compact_batch(conn, table, batch)
+            totals['compacted'] += done
+            if done < batch:
+                break
+            time.sleep(BATCH_PAUSE)
+    if days:
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        for table in TABLES:
+            while running():
+                rows, bodies = prune_batch(conn, table, cutoff, batch, archive=bool(archive))
+                totals['pruned'] += rows
+                totals['bodies'] += bodies
+                if rows < batch:
+                    break
+                time.sleep(BATCH_PAUSE)
+    if running():
+        totals['pages'] = incremental_vacuum(conn, vacuum_pages)
+    logger.info(f"Retention pass: {totals['compacted']} rows compacted, {totals['pruned']} pruned"
+                f"{' to ' + archive if archive else ''}, {totals['bodies']} bodies deleted, "
+                f"{totals['pages']} pages freed in {time.monotonic() - started:.1f}s")
+    return totals
+
+
+class RetentionJob:
+    """Background thread running a pass every interval seconds while the event is set and it holds the lease."""
+
+    def __init__(self, event, days=None, archive=None, interval=PASS_INTERVAL, worker_id=None):
+        self.event = event
+        self.days = days
+        self.archive = archive
+        self.interval = interval
+        self.worker_id = worker_id or coordination.worker_identity()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # Its own connection: the archive is attached to it
+        conn = storage.connect()
+        if not conn:
+            return
+        try:
+            if self.archive:
+                attach_archive(conn, self.archive)
+            while self.event.is_set():
+                try:
+                    # The lease outlives the pass, so another worker can't start one right after it
+                    if coordination.claim_job(conn, RETENTION_JOB, self.worker_id, ttl=self.interval * 2):
+                        run_pass(conn, self.days, self.archive, self.event)
+                except Exception as e:
+                    logger.error(f"Retention pass failed: {e}")
+                # The event is set while running, so sleep in short steps
+                deadline = time.monotonic() + self.interval
+                while self.event.is_set() and time.monotonic() < deadline:
+                    time.sleep(1.0)
+            coordination.release_job(conn, RETENTION_JOB, self.worker_id)
+        except Exception as e:
+            logger.error(f"Retention stopped: {e}")
+        finally:
+            conn.close()
+        logger.info("Retention stopped")
+
+
+def run_retention(options):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    conn = storage.connect()
+    if not conn:
+        return 1
+    try:
+        storage.init_db(conn)
+        if options['convert']:
+            convert_to_incremental(conn)
+        if options['archive']:
+            attach_archive(conn, options['archive'])
+        run_pass(conn, options['days'], options['archive'], batch=options['batch_size'],
+                 vacuum_pages=options['vacuum_pages'])
+    finally:
+        conn.close()
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compact email bodies, prune old history rows and vacuum the DB")
+    parser.add_argument("--days", type=int, help="delete history rows older than this many days")
+    parser.add_argument("--archive", nargs="?", const=ARCHIVE_FILE, help="copy pruned rows to this SQLite file first")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per transaction")
+    parser.add_argument("--vacuum-pages", type=int, default=VACUUM_PAGES, help="free pages returned to the file system")
+    parser.add_argument("--convert", action="store_true", help="switch the DB to incremental vacuum (full VACUUM, stop workers first)")
+    return vars(parser.parse_args(argv))
+
+
+def main(argv=None):
+    return run_retention(parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
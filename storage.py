@@ -0,0 +1,719 @@
+"""SQLite storage layer.
+
+Every thread keeps one long-lived connection in WAL mode. sqlite3 caches the
+compiled statements of each connection, so the fixed SQL strings below act as
+prepared statements. While batched_writes() is active, writes from all threads
+are buffered. flush() then commits the whole buffer in one transaction; if
+that fails, the writes stay buffered for the next flush. grouped_writes()
+holds one thread's writes back until the end of its block, so they reach the
+buffer, or commit, together. Processed email IDs are also kept in memory, so
+dedupe rarely touches the database. Email bodies go to the deduplicated,
+compressed content store (see content_store.py); the history tables keep a
+preview and the body's hash.
+The FTS5 index of processed_emails_full covers the full bodies without
+storing a copy of them, see _init_history().
+"""
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import groupby
+
+import content_store
+import coordination
+import gmail_sync
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = "support.db"
+BUSY_TIMEOUT = 30  # seconds
+CACHED_STATEMENTS = 256
+MAX_BUFFERED_WRITES = 1000  # flush early once this many writes are pending
+PROCESSED_CACHE_SIZE = 1000000
+IN_CHUNK = 500  # ids per IN (...) query
+TRANSIENT_ERRORS = ('locked', 'busy', 'disk i/o', 'disk is full')  # flush errors worth retrying the whole buffer
+
+# An upsert instead of INSERT OR REPLACE, so the history triggers see an UPDATE
+SQL_INSERT_PROCESSED = """
+    INSERT INTO processed_emails_full
+    (email_id, subject, content, content_hash, category, importance, processed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(email_id) DO UPDATE SET
+        subject = excluded.subject, content = excluded.content, content_hash = excluded.content_hash,
+        category = excluded.category, importance = excluded.importance, processed_at = excluded.processed_at
+"""
+SQL_INSERT_PENDING = """
+    INSERT OR REPLACE INTO pending_refunds
+    (email_id, system_reply_id, order_id, status, created_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_DELETE_PENDING = "DELETE FROM pending_refunds WHERE email_id = ?"
+SQL_INSERT_NOT_FOUND = """
+    INSERT OR IGNORE INTO not_found_refunds (email_id, subject, content, content_hash, invalid_order_id, received_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_INSERT_UNHANDLED = """
+    INSERT OR IGNORE INTO unhandled_emails (email_id, subject, content, content_hash, importance, received_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_INSERT_OUTBOX = """
+    INSERT OR IGNORE INTO outbox (message_id, account, email_id, to_email, subject, body, status, next_attempt_at, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, 'pending', 0, ?)
+"""
+SQL_SELECT_PENDING_BY_REPLY = """
+    SELECT * FROM pending_refunds
+    WHERE system_reply_id = ? AND status = 'asked'
+    ORDER BY created_at DESC LIMIT 1
+"""
+
+# History views: table, time column and the columns shown in the dashboard
+HISTORY_TABLES = {
+    'processed': ('processed_emails_full', 'processed_at', 'email_id, subject, category, importance, processed_at'),
+    'unhandled': ('unhandled_emails', 'received_at', 'email_id, subject, importance, received_at'),
+    'not_found': ('not_found_refunds', 'received_at', 'email_id, subject, invalid_order_id, received_at'),
+}
+CONTENT_PREVIEW = content_store.INLINE_CHARS
+# Full body of a history row t: from the content store, or inline for short and not yet compacted bodies.
+# Used by reads, FTS rebuilds and the FTS triggers before SQLite 3.43; email_text() exists on storage.connect() connections
+FULL_CONTENT = "coalesce((SELECT email_text(c.codec, c.data) FROM email_contents c WHERE c.hash = {row}.content_hash), {row}.content)"
+
+# No INSERT OR IGNORE in the triggers: under the upsert of SQL_INSERT_PROCESSED it would fail like a plain INSERT
+HISTORY_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trg_processed_stats_ai AFTER INSERT ON processed_emails_full BEGIN
+        INSERT INTO email_stats (category, importance, count) SELECT coalesce(new.category, 'N/A'), coalesce(new.importance, 'N/A'), 0
+        WHERE NOT EXISTS (SELECT 1 FROM email_stats WHERE category = coalesce(new.category, 'N/A') AND importance = coalesce(new.importance, 'N/A'));
+        UPDATE email_stats SET count = count + 1 WHERE category = coalesce(new.category, 'N/A') AND importance = coalesce(new.importance, 'N/A');
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_stats_ad AFTER DELETE ON processed_emails_full BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE category = coalesce(old.category, 'N/A') AND importance = coalesce(old.importance, 'N/A');
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_stats_au AFTER UPDATE OF category, importance ON processed_emails_full BEGIN
+        UPDATE email_stats SET count = count - 1 WHERE category = coalesce(old.category, 'N/A') AND importance = coalesce(old.importance, 'N/A');
+        INSERT INTO email_stats (category, importance, count) SELECT coalesce(new.category, 'N/A'), coalesce(new.importance, 'N/A'), 0
+        WHERE NOT EXISTS (SELECT 1 FROM email_stats WHERE category = coalesce(new.category, 'N/A') AND importance = coalesce(new.importance, 'N/A'));
+        UPDATE email_stats SET count = count + 1 WHERE category = coalesce(new.category, 'N/A') AND importance = coalesce(new.importance, 'N/A');
+    END;
+"""
+# SQLite 3.43+ has contentless FTS5 tables that support deletes: they hold only the index, not the text.
+# The triggers are plain SQL and index the preview; storage writes the full body over it (SQL_INDEX_PROCESSED).
+# Older SQLite gets an external content index whose triggers read the bodies back with email_text()
+FTS_CONTENTLESS = sqlite3.sqlite_version_info >= (3, 43, 0)
+FTS_CONTENTLESS_DDL = "CREATE VIRTUAL TABLE processed_emails_fts USING fts5(subject, content, content='', contentless_delete=1)"
+FTS_CONTENTLESS_TRIGGERS = """
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_ai AFTER INSERT ON processed_emails_full BEGIN
+        INSERT INTO processed_emails_fts (rowid, subject, content) VALUES (new.rowid, new.subject, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_ad AFTER DELETE ON processed_emails_full BEGIN
+        DELETE FROM processed_emails_fts WHERE rowid = old.rowid;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_au AFTER UPDATE OF subject, content ON processed_emails_full BEGIN
+        DELETE FROM processed_emails_fts WHERE rowid = old.rowid;
+        INSERT INTO processed_emails_fts (rowid, subject, content) VALUES (new.rowid, new.subject, new.content);
+    END;
+"""
+FTS_EXTERNAL_DDL = ("CREATE VIRTUAL TABLE processed_emails_fts "
+                    "USING fts5(subject, content, content='processed_emails_text', content_rowid='email_rowid')")
+FTS_EXTERNAL_TRIGGERS = f"""
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_ai AFTER INSERT ON processed_emails_full BEGIN
+        INSERT INTO processed_emails_fts (rowid, subject, content) VALUES (new.rowid, new.subject, {FULL_CONTENT.format(row='new')});
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_ad AFTER DELETE ON processed_emails_full BEGIN
+        INSERT INTO processed_emails_fts (processed_emails_fts, rowid, subject, content)
+        VALUES ('delete', old.rowid, old.subject, {FULL_CONTENT.format(row='old')});
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_processed_fts_au AFTER UPDATE OF subject, content, content_hash ON processed_emails_full BEGIN
+        INSERT INTO processed_emails_fts (processed_emails_fts, rowid, subject, content)
+        VALUES ('delete', old.rowid, old.subject, {FULL_CONTENT.format(row='old')});
+        INSERT INTO processed_emails_fts (rowid, subject, content) VALUES (new.rowid, new.subject, {FULL_CONTENT.format(row='new')});
+    END;
+"""
+# Full body over the preview indexed by the contentless triggers, in the transaction writing the row
+SQL_INDEX_PROCESSED = """
+    INSERT OR REPLACE INTO processed_emails_fts (rowid, subject, content)
+    SELECT rowid, subject, ? FROM processed_emails_full WHERE email_id = ?
+"""
+FTS_TRIGGER_NAMES = ('trg_processed_fts_ai', 'trg_processed_fts_ad', 'trg_processed_fts_au')
+STATS_TRIGGER_NAMES = ('trg_processed_stats_ai', 'trg_processed_stats_ad', 'trg_processed_stats_au')
+
+_local = threading.local()
+_conns = []
+_conns_lock = threading.Lock()
+_write_lock = threading.Lock()
+_pending_writes = []  # (sql, params, email_id marked processed once this commits, or None)
+_batch_depth = 0
+_processed = set()
+_processed_lock = threading.Lock()
+_fts_full_text = None  # see index_full_text()
+
+
+def connect(db_file=DB_FILE):
+    try:
+        conn = sqlite3.connect(db_file, check_same_thread=False, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        content_store.register(conn)
+        # Only takes effect on a new DB file, before WAL mode writes its header; see retention.py
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    except sqlite3.Error as e:
+        logger.error(f"DB connect failed: {e}")
+        return None
+
+
+def get_connection():
+    """Return the calling thread's long-lived connection."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = connect()
+        if conn:
+            _local.conn = conn
+            with _conns_lock:
+                _conns.append(conn)
+    return conn
+
+
+def close_connections():
+    try:
+        flush()
+    except sqlite3.Error:
+        pass  # logged by flush(); the rows they belong to are picked up again after a restart
+    with _conns_lock:
+        conns = list(_conns)
+        _conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _local.__dict__.clear()
+
+
+def init_db(conn):
+    with conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE IF NOT EXISTS orders (order_id TEXT PRIMARY KEY, status TEXT DEFAULT 'active')")
+        cur.execute("CREATE TABLE IF NOT EXISTS unhandled_emails (email_id TEXT PRIMARY KEY, subject TEXT, content TEXT, importance TEXT, received_at TEXT, content_hash TEXT)")
+        cur.execute("CREATE TABLE IF NOT EXISTS not_found_refunds (email_id TEXT PRIMARY KEY, subject TEXT, content TEXT, invalid_order_id TEXT, received_at TEXT, content_hash TEXT)")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS processed_emails_full (
+                email_id TEXT PRIMARY KEY,
+                subject TEXT,
+                content TEXT,
+                category TEXT,
+                importance TEXT,
+                processed_at TEXT,
+                content_hash TEXT
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS pending_refunds (
+                email_id TEXT PRIMARY KEY,
+                system_reply_id TEXT,
+                order_id TEXT,
+                status TEXT,
+                created_at TEXT
+            )
+        """)
+        cur.execute(gmail_sync.SYNC_STATE_DDL)
+        cur.execute(coordination.WORKERS_DDL)
+        cur.execute(coordination.LEASES_DDL)
+        cur.execute(coordination.JOB_LEASES_DDL)
+        # Email bodies by hash, see content_store.py
+        cur.execute(content_store.CONTENTS_DDL.format(schema=''))
+        # Replies waiting for the outbox sender; one per incoming email
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT UNIQUE,
+                account TEXT,
+                email_id TEXT UNIQUE,
+                to_email TEXT,
+                subject TEXT,
+                body TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                gmail_id TEXT,
+                last_error TEXT,
+                created_at TEXT,
+                sent_at TEXT
+            )
+        """)
+        # Emails in flight through the pipeline stages, see pipeline.py
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS pipeline (
+                email_id TEXT PRIMARY KEY,
+                account TEXT,
+                stage TEXT,
+                data TEXT,
+                owner TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                created_at REAL,
+                updated_at REAL,
+                trace_id TEXT
+            )
+        """)
+        # Resume positions of archive imports, see backfill.py
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_state (
+                source TEXT PRIMARY KEY,
+                position TEXT,
+                processed INTEGER DEFAULT 0,
+                updated_at TEXT
+            )
+        """)
+        for table, column in (('pending_refunds', 'system_reply_id TEXT'), ('pipeline', 'trace_id TEXT'),
+                              ('workers', 'metrics TEXT'), ('processed_emails_full', 'content_hash TEXT'),
+                              ('unhandled_emails', 'content_hash TEXT'), ('not_found_refunds', 'content_hash TEXT')):
+            try:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pending_reply ON pending_refunds (system_reply_id, status, created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_processed_at ON processed_emails_full (processed_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_unhandled_received ON unhandled_emails (received_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_not_found_received ON not_found_refunds (received_at)")
+        for table in ('processed_emails_full', 'unhandled_emails', 'not_found_refunds'):
+            # Reference lookups before a body is deleted, and the rows retention.py still has to compact
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_hash ON {table} (content_hash) WHERE content_hash IS NOT NULL")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_uncompacted ON {table} (email_id) WHERE {content_store.UNCOMPACTED}")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_pipeline_due ON pipeline (stage, account, next_attempt_at)")
+        _init_history(cur)
+        demo_orders = [
+            ('12345-ABC', 'active'),
+            ('67890-DEF', 'active'),
+            ('11111-XYZ', 'active'),
+            ('22222-PQR', 'active'),
+            ('33333-STU', 'active')
+        ]
+        cur.executemany("INSERT OR IGNORE INTO orders (order_id, status) VALUES (?, ?)", demo_orders)
+
+
+def _create_triggers(cur, script):
+    # cursor.execute takes one statement, so split the script on trigger ends
+    for trigger in script.split("END;"):
+        if trigger.strip():
+            cur.execute(trigger.strip() + "\nEND")
+
+
+def _init_history(cur):
+    """Counters, change version and full-text index behind the history dashboard."""
+    cur.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value INTEGER)")
+    cur.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('change_version', 0)")
+    for table in ('processed_emails_full', 'unhandled_emails', 'not_found_refunds'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                    UPDATE db_meta SET value = value + 1 WHERE key = 'change_version';
+                END
+            """)
+    stats_exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'email_stats'").fetchone()
+    cur.execute("CREATE TABLE IF NOT EXISTS email_stats (category TEXT, importance TEXT, count INTEGER, PRIMARY KEY (category, importance))")
+    if not stats_exists:
+        cur.execute("""
+            INSERT INTO email_stats (category, importance, count)
+            SELECT coalesce(category, 'N/A'), coalesce(importance, 'N/A'), COUNT(*) FROM processed_emails_full
+            GROUP BY 1, 2
+        """)
+    # Recreated every time, so triggers of earlier versions get replaced
+    for name in STATS_TRIGGER_NAMES:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    _create_triggers(cur, HISTORY_TRIGGERS)
+    # Recreated every time, so triggers of an earlier index layout get replaced
+    for name in FTS_TRIGGER_NAMES:
+        cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+    cur.execute("DROP VIEW IF EXISTS processed_emails_text")
+    if 'index_text' in {row[1] for row in cur.execute("PRAGMA table_info(processed_emails_full)")}:
+        # Plain-text copies of the bodies kept by an earlier version; the index is rebuilt without them
+        cur.execute("DROP TABLE IF EXISTS processed_emails_fts")
+        try:
+            cur.execute("ALTER TABLE processed_emails_full DROP COLUMN index_text")
+        except sqlite3.OperationalError:
+            cur.execute("UPDATE processed_emails_full SET index_text = NULL")
+    try:
+        ddl = FTS_CONTENTLESS_DDL if FTS_CONTENTLESS else FTS_EXTERNAL_DDL
+        if not FTS_CONTENTLESS:
+            # Content table of the external index, so 'rebuild' indexes the full bodies and not the previews
+            cur.execute(f"""
+                CREATE VIEW processed_emails_text AS
+                SELECT t.rowid AS email_rowid, t.subject, {FULL_CONTENT.format(row='t')} AS content FROM processed_emails_full t
+            """)
+        fts = cur.execute("SELECT sql FROM sqlite_master WHERE name = 'processed_emails_fts'").fetchone()
+        if fts and fts[0] != ddl:
+            # An index from before the content store or from another SQLite version; rebuilt below
+            cur.execute("DROP TABLE processed_emails_fts")
+            fts = None
+        if not fts:
+            cur.execute(ddl)
+        _create_triggers(cur, FTS_CONTENTLESS_TRIGGERS if FTS_CONTENTLESS else FTS_EXTERNAL_TRIGGERS)
+        if not fts:
+            _fill_fts(cur)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 unavailable, history search falls back to LIKE: {e}")
+    global _fts_full_text
+    _fts_full_text = None
+
+
+def _fill_fts(cur):
+    if FTS_CONTENTLESS:
+        cur.execute("INSERT INTO processed_emails_fts (processed_emails_fts) VALUES ('delete-all')")
+        cur.execute(f"INSERT INTO processed_emails_fts (rowid, subject, content) "
+                    f"SELECT t.rowid, t.subject, {FULL_CONTENT.format(row='t')} FROM processed_emails_full t")
+    else:
+        cur.execute("INSERT INTO processed_emails_fts (processed_emails_fts) VALUES ('rebuild')")
+
+
+def rebuild_fts(conn):
+    """Index every processed email again, e.g. after VACUUM renumbered the rowids the index refers to."""
+    if fts_available(conn):
+        with conn:
+            _fill_fts(conn.cursor())
+
+
+def index_full_text(conn):
+    """True when the full body of a processed email has to be written to its FTS index (contentless index)."""
+    global _fts_full_text
+    if _fts_full_text is None:
+        _fts_full_text = FTS_CONTENTLESS and fts_available(conn)
+    return _fts_full_text
+
+
+def fts_available(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'processed_emails_fts'").fetchone() is not None
+
+
+# History dashboard
+def get_change_version(conn):
+    """Counter bumped by triggers on every history write. Cheap to poll."""
+    try:
+        row = conn.execute("SELECT value FROM db_meta WHERE key = 'change_version'").fetchone()
+        return row[0] if row else 0
+    except Exception as e:
+        logger.error(f"Change version read failed: {e}")
+        return 0
+
+
+def get_email_stats(conn):
+    """Processed email counts per (category, importance), kept up to date by triggers."""
+    try:
+        rows = conn.execute("SELECT category, importance, count FROM email_stats WHERE count > 0 ORDER BY category, importance").fetchall()
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Email stats read failed: {e}")
+        return []
+
+
+def _fts_query(search):
+    # Quote every term so user input can't be parsed as FTS5 syntax; terms are ANDed
+    terms = [term.replace('"', '""') for term in search.split()]
+    return " ".join(f'"{term}"' for term in terms if term)
+
+
+def fetch_history_page(conn, table_key, limit=50, cursor=None, search=None):
+    """Return (rows, next_cursor) for one page of a history table, newest first.
+
+    Pages use keyset pagination on (time, email_id), so deep pages cost the same
+    as the first one. cursor is the next_cursor of the previous page. search
+    matches subject and content: through FTS5 for processed emails, LIKE for the
+    smaller tables.
+    """
+    table, time_col, columns = HISTORY_TABLES[table_key]
+    preview = f"substr(t.content, 1, {CONTENT_PREVIEW}) || CASE WHEN length(t.content) > {CONTENT_PREVIEW} THEN '...' ELSE '' END AS content"
+    select = ", ".join(f"t.{col.strip()}" for col in columns.split(","))
+    joins, where, params = "", [], []
+    search = (search or "").strip()
+    if search:
+        if table == 'processed_emails_full' and fts_available(conn):
+            joins = " JOIN processed_emails_fts f ON f.rowid = t.rowid"
+            where.append("processed_emails_fts MATCH ?")
+            params.append(_fts_query(search))
+        else:
+            where.append(f"(t.subject LIKE ? OR {FULL_CONTENT.format(row='t')} LIKE ?)")
+            params += [f"%{search}%"] * 2
+    if cursor:
+        where.append(f"(t.{time_col}, t.email_id) < (?, ?)")
+        params += list(cursor)
+    sql = f"SELECT {select}, {preview} FROM {table} t{joins}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY t.{time_col} DESC, t.email_id DESC LIMIT ?"
+    try:
+        rows = [dict(row) for row in conn.execute(sql, params + [limit + 1]).fetchall()]
+    except Exception as e:
+        logger.error(f"History page for {table_key} failed: {e}")
+        return [], None
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1][time_col], rows[-1]['email_id'])
+    return rows, next_cursor
+
+
+# Write batching
+@contextmanager
+def batched_writes():
+    """Buffer writes from every thread until flush() or the end of the block."""
+    global _batch_depth
+    with _write_lock:
+        _batch_depth += 1
+    try:
+        yield
+    finally:
+        with _write_lock:
+            _batch_depth -= 1
+        flush()
+
+
+def write(conn, sql, params):
+    """Execute a write now, or buffer it while batched_writes() is active."""
+    write_all(conn, [(sql, params)])
+
+
+@contextmanager
+def grouped_writes(conn):
+    """Collect the calling thread's writes and pass them to write_all() together, so they commit in one transaction.
+
+    An exception leaving the block discards them. Nested blocks join the outer group.
+    """
+    if getattr(_local, 'group', None) is not None:
+        yield
+        return
+    _local.group = group = []
+    try:
+        yield
+    finally:
+        _local.group = None
+    if group:
+        _write_entries(conn, group)
+
+
+def write_all(conn, writes, processed=None):
+    """write() for several (sql, params) that must commit in the same transaction.
+
+    processed is an email_id that counts as processed once the writes commit.
+    """
+    entries = [(sql, params, None) for sql, params in writes]
+    if processed:
+        entries[-1] = entries[-1][:2] + (processed,)
+    group = getattr(_local, 'group', None)
+    if group is not None:
+        group.extend(entries)
+        return
+    _write_entries(conn, entries)
+
+
+def _write_entries(conn, entries):
+    with _write_lock:
+        if _batch_depth:
+            _pending_writes.extend(entries)
+            if len(_pending_writes) < MAX_BUFFERED_WRITES:
+                return
+            buffered = True
+        else:
+            buffered = False
+    if buffered:
+        try:
+            flush()
+        except sqlite3.Error:
+            pass  # still buffered, logged by flush() and retried with the next one
+        return
+    with metrics.timer('sqlite_write_seconds', kind='direct'), conn:
+        for sql, params, _ in entries:
+            conn.execute(sql, params)
+    _remember_processed([email_id for _, _, email_id in entries if email_id])
+
+
+def flush():
+    """Commit every buffered write in a single transaction.
+
+    On a transient error (locked DB, I/O) the writes go back to the front of
+    the buffer and the error is raised, so callers like the ack stage don't
+    carry on as if they were saved. Any other error is retried one write per
+    transaction, so a single bad row is dropped (and logged) without the rest.
+    Emails count as processed only once their writes are committed.
+    """
+    global _pending_writes
+    with _write_lock:
+        if not _pending_writes:
+            return
+        writes, _pending_writes = _pending_writes, []
+        conn = get_connection()
+        try:
+            with metrics.timer('sqlite_write_seconds', kind='flush'), conn:
+                for sql, group in groupby(writes, key=lambda w: w[0]):
+                    conn.executemany(sql, [params for _, params, _ in group])
+        except Exception as e:
+            if _is_transient(e):
+                logger.error(f"DB flush of {len(writes)} writes failed, kept for the next flush: {e}")
+                _pending_writes = writes + _pending_writes
+                raise
+            logger.error(f"DB flush of {len(writes)} writes failed, retrying them one by one: {e}")
+            writes = _commit_each(conn, writes)
+        _remember_processed([email_id for _, _, email_id in writes if email_id])
+
+
+def _is_transient(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and any(word in message for word in TRANSIENT_ERRORS)
+
+
+def _commit_each(conn, writes):
+    """Commit the writes one transaction each. Returns the ones committed."""
+    committed = []
+    for sql, params, email_id in writes:
+        try:
+            with conn:
+                conn.execute(sql, params)
+            committed.append((sql, params, email_id))
+        except Exception as e:
+            logger.error(f"Dropped write {sql.split('(')[0].strip()} {params}: {e}")
+    return committed
+
+
+def _write_with_content(conn, sql, content, params, processed=None, indexed=False):
+    """Write a history row whose content goes to the content store; params are the columns after content_hash.
+
+    indexed writes the full body to the FTS index of processed_emails_full, whose triggers only see the preview.
+    """
+    text, digest, row = content_store.split_content(content)
+    writes = [(content_store.SQL_INSERT_CONTENT, row)] if row else []
+    params = params[:2] + (text, digest) + params[2:]
+    # The body commits with (and before) the row referencing it, so retention never sees the row without it
+    writes.append((sql, params))
+    if indexed and digest and index_full_text(conn):
+        writes.append((SQL_INDEX_PROCESSED, (content, params[0])))
+    write_all(conn, writes, processed)
+
+
+# Processed emails
+def _remember_processed(email_ids):
+    with _processed_lock:
+        if len(_processed) > PROCESSED_CACHE_SIZE:
+            _processed.clear()
+        _processed.update(email_ids)
+
+
+def is_email_processed(conn, email_id):
+    if email_id in _processed:
+        return True
+    if not conn:
+        return False
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT email_id FROM processed_emails_full WHERE email_id = ?", (email_id,))
+        if cur.fetchone() is None:
+            return False
+        _remember_processed([email_id])
+        return True
+    except:
+        return False
+
+
+def filter_unprocessed(conn, email_ids):
+    """Return the email_ids not processed yet, with one query per IN_CHUNK ids."""
+    unknown = [email_id for email_id in email_ids if email_id not in _processed]
+    if not conn or not unknown:
+        return unknown
+    try:
+        found = set()
+        for start in range(0, len(unknown), IN_CHUNK):
+            chunk = unknown[start:start + IN_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT email_id FROM processed_emails_full WHERE email_id IN ({placeholders})", chunk).fetchall()
+            found.update(row[0] for row in rows)
+        _remember_processed(found)
+        return [email_id for email_id in unknown if email_id not in found]
+    except Exception as e:
+        logger.error(f"Processed lookup failed: {e}")
+        return unknown
+
+
+def mark_email_processed_full(conn, email_id, subject, content, category, importance):
+    if not conn:
+        return
+    try:
+        _write_with_content(conn, SQL_INSERT_PROCESSED, content, (email_id, subject, category, importance, datetime.now().isoformat()),
+                            processed=email_id, indexed=True)
+    except Exception as e:
+        logger.error(f"Insert processed full failed for {email_id}: {e}")
+
+
+# Refunds and unhandled emails
+def insert_pending_refund(conn, email_id, system_reply_id, order_id, status):
+    if not conn or not system_reply_id:
+        logger.error(f"Cannot insert pending for {email_id}: missing system_reply_id ({system_reply_id})")
+        return None
+    try:
+        write(conn, SQL_INSERT_PENDING, (email_id, system_reply_id, order_id, status, datetime.now().isoformat()))
+        return system_reply_id
+    except Exception as e:
+        logger.error(f"Insert pending refund failed for {email_id}: {e}")
+        return None
+
+
+def get_pending_by_reply_to(conn, reply_to_id):
+    if not conn or not reply_to_id:
+        return None
+    try:
+        cur = conn.cursor()
+        normalized_reply_to = reply_to_id.strip()
+        cur.execute(SQL_SELECT_PENDING_BY_REPLY, (normalized_reply_to,))
+        return cur.fetchone()
+    except Exception as e:
+        logger.error(f"Get pending by reply_to failed: {e}")
+        return None
+
+
+def delete_pending_refund(conn, email_id):
+    if not conn:
+        return
+    try:
+        write(conn, SQL_DELETE_PENDING, (email_id,))
+    except Exception as e:
+        logger.error(f"Delete pending failed for {email_id}: {e}")
+
+
+def insert_not_found_refund(conn, email_id, subject, content, invalid_order_id):
+    if not conn:
+        return
+    try:
+        _write_with_content(conn, SQL_INSERT_NOT_FOUND, content, (email_id, subject, invalid_order_id, datetime.now().isoformat()))
+    except Exception as e:
+        logger.error(f"Insert not_found_refund failed for {email_id}: {e}")
+
+
+def insert_unhandled_email(conn, email_id, subject, content, importance):
+    if not conn:
+        return
+    try:
+        _write_with_content(conn, SQL_INSERT_UNHANDLED, content, (email_id, subject, importance, datetime.now().isoformat()))
+    except Exception as e:
+        logger.error(f"Insert unhandled failed for {email_id}: {e}")
+
+
+def get_outbox_message_id(conn, email_id):
+    """Message-ID of the reply already queued for email_id, or None."""
+    if not conn or not email_id:
+        return None
+    try:
+        row = conn.execute("SELECT message_id FROM outbox WHERE email_id = ?", (email_id,)).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Outbox lookup failed for {email_id}: {e}")
+        return None
+
+
+def insert_outbox_reply(conn, message_id, account, email_id, to_email, subject, body):
+    if not conn:
+        return False
+    try:
+        write(conn, SQL_INSERT_OUTBOX, (message_id, account, email_id, to_email, subject, body, datetime.now().isoformat()))
+        return True
+    except Exception as e:
+        logger.error(f"Insert outbox reply failed for {email_id}: {e}")
+        return False
@@ -0,0 +1,132 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+
+class HttpError(Exception):
+    """Stand-in for googleapiclient's HttpError: the status is on resp.status."""
+
+    def __init__(self, status, content=b''):
+        super().__init__(f"HTTP {status}")
+        self.resp = type('Resp', (), {'status': status})()
+        self.content = content
+
+
+class _Request:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self):
+        return self._fn()
+
+
+class _Messages:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, **kwargs):
+        self.gmail.calls.append(('messages.list', kwargs))
+        if 'rfc822msgid:' in kwargs.get('q', ''):
+            message_id = kwargs['q'].split(':', 1)[1]
+            return _Request(lambda: {'messages': [{'id': gmail_id} for gmail_id, sent in self.gmail.sent.items()
+                                                  if sent == message_id]})
+        return _Request(lambda: self.gmail.page(self.gmail.unread, kwargs, 'messages'))
+
+    def send(self, userId, body):
+        self.gmail.calls.append(('messages.send', body))
+
+        def send():
+            if self.gmail.send_errors:
+                raise self.gmail.send_errors.pop(0)
+            gmail_id = f"sent-{len(self.gmail.sent) + 1}"
+            self.gmail.sent[gmail_id] = self.gmail.message_id_of(body['raw'])
+            if self.gmail.fail_after_send:
+                raise self.gmail.fail_after_send.pop(0)
+            return {'id': gmail_id}
+        return _Request(send)
+
+
+class _History:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, **kwargs):
+        self.gmail.calls.append(('history.list', kwargs))
+
+        def history():
+            if self.gmail.history_error:
+                raise self.gmail.history_error
+            result = self.gmail.page(self.gmail.history, kwargs, 'history')
+            result['historyId'] = self.gmail.history_id
+            return result
+        return _Request(history)
+
+
+class _Users:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def messages(self):
+        return _Messages(self.gmail)
+
+    def history(self):
+        return _History(self.gmail)
+
+    def getProfile(self, userId):
+        return _Request(lambda: {'historyId': self.gmail.history_id})
+
+
+class FakeGmail:
+    """In-memory Gmail service with the users().messages()/history() call chain, paging page_size items per call."""
+
+    def __init__(self, unread=(), history=(), history_id='100', page_size=2):
+        self.unread = [{'id': email_id} for email_id in unread]
+        self.history = list(history)
+        self.history_id = history_id
+        self.page_size = page_size
+        self.history_error = None
+        self.send_errors = []
+        self.fail_after_send = []
+        self.sent = {}  # gmail id -> Message-ID
+        self.calls = []
+
+    def users(self):
+        return _Users(self)
+
+    def page(self, items, kwargs, key):
+        start = int(kwargs.get('pageToken') or 0)
+        end = start + self.page_size
+        result = {key: items[start:end]}
+        if end < len(items):
+            result['nextPageToken'] = str(end)
+        return result
+
+    @staticmethod
+    def message_id_of(raw):
+        import base64
+        import email
+        return email.message_from_bytes(base64.urlsafe_b64decode(raw))['Message-ID'].strip('<>')
+
+
+@pytest.fixture
+def gmail():
+    return FakeGmail()
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    """A fresh support.db in a temporary directory, with the storage module state reset."""
+    monkeypatch.chdir(tmp_path)
+    storage.close_connections()
+    monkeypatch.setattr(storage, '_pending_writes', [])
+    monkeypatch.setattr(storage, '_batch_depth', 0)
+    monkeypatch.setattr(storage, '_processed', set())
+    conn = storage.get_connection()
+    storage.init_db(conn)
+    yield conn
+    storage.close_connections()
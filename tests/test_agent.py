@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import agent
+import content_reducer
+import content_store
+
+QUOTED = "\n\nOn Mon, 3 Jun 2024 at 10:00, Support <support@example.com> wrote:\n> " + "old history " * 200
+
+
+class FakeQA:
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+
+    def invoke(self, inputs):
+        self.queries.append(inputs['query'])
+        return {'result': self.answer}
+
+
+@pytest.fixture(autouse=True)
+def heuristic_tokens(tmp_path, monkeypatch):
+    monkeypatch.setenv('TIKTOKEN_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(content_reducer, '_encoding', None)
+
+
+def prepared(content, fast=None):
+    return {'subject': 'Hi', 'sender_email': 'client@example.com', 'reply_to': '', 'content': content, 'fast': fast}
+
+
+def full_text(conn, table, email_id):
+    row = conn.execute(f"SELECT content, content_hash FROM {table} WHERE email_id = ?", (email_id,)).fetchone()
+    if not row['content_hash']:
+        return row['content']
+    data = conn.execute("SELECT codec, data FROM email_contents WHERE hash = ?", (row['content_hash'],)).fetchone()
+    return content_store.decompress(data['codec'], data['data'])
+
+
+def test_questions_are_stored_with_the_original_text(conn):
+    content = "What are your opening hours?" + QUOTED
+    qa = FakeQA("I don’t have enough information")
+    agent.dispatch_prepared(conn, qa, None, 'q1', prepared(content), 'Question', 'low')
+    # The QA chain gets the reduced text, the unhandled and processed rows the whole email
+    assert qa.queries == [content_reducer.reduce_content(content)]
+    assert full_text(conn, 'unhandled_emails', 'q1') == content
+    assert full_text(conn, 'processed_emails_full', 'q1') == content
+
+
+def test_questions_without_qa_chain_keep_the_original_text(conn):
+    content = "Do you ship abroad?" + QUOTED
+    agent.dispatch_prepared(conn, None, None, 'q2', prepared(content), 'Question', 'low')
+    assert full_text(conn, 'unhandled_emails', 'q2') == content
+
+
+def test_fast_path_emails_are_not_reduced(monkeypatch):
+    calls = []
+    monkeypatch.setattr(content_reducer, 'reduce_content', lambda content: calls.append(content) or content)
+    item = prepared("Out of office until Monday", fast=('Other', 1.0, 'low'))
+    assert agent.classify_prepared(None, item) == ('Other', 'low', None)
+    assert calls == []
+    agent.reduced_content(item)
+    agent.reduced_content(item)
+    assert len(calls) == 1
+
+
+def test_import_leaves_langchain_openai_and_numpy_unloaded():
+    # A fresh interpreter: this process has them loaded by other tests
+    code = "import sys, agent; print(sorted({'langchain_openai', 'langchain.chains', 'numpy'} & set(sys.modules)))"
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(agent.__file__)),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
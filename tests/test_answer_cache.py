@@ -0,0 +1,113 @@
+import pytest
+
+import answer_cache
+import metrics
+
+
+class FakeEmbeddings:
+    """Same text, same vector; different texts are orthogonal unless given a vector."""
+
+    def __init__(self, vectors=None, size=256):
+        self.vectors = vectors or {}
+        self.size = size
+        self.texts = []
+
+    def embed_query(self, text):
+        if text in self.vectors:
+            return self.vectors[text]
+        if text not in self.texts:
+            self.texts.append(text)
+        vector = [0.0] * self.size
+        vector[self.texts.index(text) % self.size] = 1.0
+        return vector
+
+
+class FakeQA:
+    def __init__(self):
+        self.queries = []
+
+    def invoke(self, inputs):
+        self.queries.append(inputs["query"])
+        return {"query": inputs["query"], "result": f"answer {len(self.queries)}"}
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, '_histograms', {})
+    monkeypatch.setattr(metrics, '_counters', {})
+
+
+def make_cache(tmp_path, embeddings=None, kb_version='v1', **kwargs):
+    return answer_cache.SemanticAnswerCache(embeddings or FakeEmbeddings(), kb_version,
+                                            cache_file=str(tmp_path / 'answers.db'), **kwargs)
+
+
+def test_similar_question_reuses_the_answer(tmp_path):
+    embeddings = FakeEmbeddings({'Where is my order?': [1.0, 0.0, 0.0], 'Where is my parcel?': [0.99, 0.1, 0.0],
+                                 'How much is Pro?': [0.0, 1.0, 0.0]})
+    cache = make_cache(tmp_path, embeddings)
+    cache.store('Where is my order?', 'It ships tomorrow.')
+    assert cache.lookup('Where is my parcel?') == 'It ships tomorrow.'
+    assert cache.lookup('How much is Pro?') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_no_information_answers_are_not_stored(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store('Anything?', 'I don’t have enough information')
+    cache.store('Empty?', '')
+    assert cache.lookup('Anything?') is None and cache._size == 0
+
+
+def test_entries_survive_a_restart_of_the_same_kb_version(tmp_path):
+    embeddings = FakeEmbeddings()
+    make_cache(tmp_path, embeddings).store('Do you have a demo?', 'Yes.')
+    assert make_cache(tmp_path, embeddings).lookup('Do you have a demo?') == 'Yes.'
+    assert make_cache(tmp_path, embeddings, kb_version='v2').lookup('Do you have a demo?') is None
+
+
+def test_kb_change_drops_old_answers(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store('Do you have a demo?', 'Yes.')
+    cache.set_kb_version('v2')
+    assert cache.lookup('Do you have a demo?') is None
+    cache.store('Do you have a demo?', 'Yes, book it online.')
+    assert cache.lookup('Do you have a demo?') == 'Yes, book it online.'
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = make_cache(tmp_path, ttl=60)
+    cache.store('Do you have a demo?', 'Yes.')
+    cache._created[0] -= 120
+    assert cache.lookup('Do you have a demo?') is None
+
+
+def test_least_recently_used_entry_makes_room(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.store('q1', 'a1')
+    cache.store('q2', 'a2')
+    cache._last_used[1] -= 10
+    cache.store('q3', 'a3')
+    assert [cache.lookup(q) for q in ('q1', 'q2', 'q3')] == ['a1', None, 'a3']
+    assert cache._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] == 2
+
+
+def test_matrix_grows_past_its_initial_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(answer_cache, 'INITIAL_ROWS', 2)
+    cache = make_cache(tmp_path)
+    for i in range(5):
+        cache.store(f"q{i}", f"a{i}")
+    assert len(cache._matrix) == 8
+    assert [cache.lookup(f"q{i}") for i in range(5)] == [f"a{i}" for i in range(5)]
+
+
+def test_only_cache_misses_are_timed_as_llm_calls(tmp_path, registry):
+    qa = FakeQA()
+    cached = answer_cache.CachedQA(qa, make_cache(tmp_path))
+    results = [cached.invoke({"query": "Where is my order?"}) for _ in range(3)]
+    assert qa.queries == ["Where is my order?"]
+    assert [result.get("cached", False) for result in results] == [False, True, True]
+    timed = metrics._histograms[metrics._key('llm_request_seconds', {'call': 'qa'})]
+    assert sum(timed[:-1]) == 1
+    assert metrics._counters[metrics._key('answer_cache_total', {'result': 'hit'})] == 2
+    assert metrics._counters[metrics._key('answer_cache_total', {'result': 'miss'})] == 1
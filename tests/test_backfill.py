@@ -0,0 +1,89 @@
+import threading
+
+import backfill
+import storage
+
+MESSAGES = [
+    ('q1', 'Services', 'Could you tell me which regions your dispatch service covers'),
+    ('r1', 'Broken', 'The parcel arrived broken, I want my money refunded'),
+    ('o1', 'Hello', 'Just saying thanks to the team for the quick delivery'),
+    ('q2', 'Hours', 'Could you tell me when your support team is available'),
+]
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def invoke(self, prompt):
+        self.prompts.append(prompt)
+        body = prompt.split('Email content:')[1]
+        category = 'Question' if 'Could you' in body else 'Refund' if 'refunded' in body else 'Other'
+        return Response(f"Category: {category}\nExplanation: test\nImportance: low")
+
+
+class FakeQA:
+    def __init__(self):
+        self.queries = []
+
+    def invoke(self, inputs):
+        self.queries.append(inputs['query'])
+        return {'result': 'An answer'}
+
+
+def write_mbox(path, messages=MESSAGES):
+    with open(path, 'w') as f:
+        for message_id, subject, body in messages:
+            f.write(f"From client@example.com Mon Jun  3 10:00:00 2024\nMessage-Id: <{message_id}@example.com>\n"
+                    f"From: Client <client@example.com>\nSubject: {subject}\n\n{body}\n\n")
+    return str(path)
+
+
+def run(llm, qa, path, **kwargs):
+    event = threading.Event()
+    event.set()
+    return backfill.backfill(llm, qa, path, event, chunk_size=2, email_workers=2, categorize_mode=None, **kwargs)
+
+
+def filed(conn, table):
+    return {row[0]: row[1] for row in conn.execute(f"SELECT email_id, category FROM {table}")}
+
+
+def test_dry_run_files_questions_without_qa_calls(conn, tmp_path):
+    llm, qa = FakeLLM(), FakeQA()
+    totals = run(llm, qa, write_mbox(tmp_path / 'archive.mbox'))
+    assert totals == {'processed': 4, 'skipped': 0, 'failed': 0}
+    assert qa.queries == []
+    assert filed(conn, 'processed_emails_full') == {'q1@example.com': 'Question', 'r1@example.com': 'Refund',
+                                                    'o1@example.com': 'Other', 'q2@example.com': 'Question'}
+    unhandled = {row[0] for row in conn.execute("SELECT email_id FROM unhandled_emails")}
+    assert unhandled == {'q1@example.com', 'r1@example.com', 'o1@example.com', 'q2@example.com'}
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM pending_refunds").fetchone()[0] == 0
+
+
+def test_resumes_after_the_last_committed_chunk(conn, tmp_path):
+    path = write_mbox(tmp_path / 'archive.mbox')
+    llm = FakeLLM()
+    assert run(llm, FakeQA(), path, limit=2)['processed'] == 2
+    position, processed = backfill.get_position(conn, str(tmp_path / 'archive.mbox'))
+    assert processed == 2 and 0 < int(position) < (tmp_path / 'archive.mbox').stat().st_size
+    assert run(llm, FakeQA(), path)['processed'] == 2
+    # Each message reached the LLM once
+    assert len(llm.prompts) == 4
+    assert len(filed(conn, 'processed_emails_full')) == 4
+    assert run(llm, FakeQA(), path) == {'processed': 0, 'skipped': 0, 'failed': 0}
+
+
+def test_restart_skips_emails_already_filed(conn, tmp_path):
+    path = write_mbox(tmp_path / 'archive.mbox')
+    run(FakeLLM(), FakeQA(), path)
+    llm = FakeLLM()
+    assert run(llm, FakeQA(), path, restart=True) == {'processed': 0, 'skipped': 4, 'failed': 0}
+    assert llm.prompts == []
+    assert storage.is_email_processed(conn, 'q1@example.com')
@@ -0,0 +1,89 @@
+import pytest
+
+import content_reducer
+
+THREAD = """Hi team,
+
+My order 12345-ABC has not arrived yet. Could you check where it is?
+
+Best regards,
+Anna Petrova
+Head of Purchasing, Example Ltd
++1 555 0100
+
+This email and any attachments are confidential and intended solely for the named recipient.
+
+On Mon, 3 Jun 2024 at 10:00, Support <support@example.com> wrote:
+> Thanks for your order, it ships in 2 days.
+>
+> On Sun, 2 Jun 2024 at 09:00, Anna Petrova <anna@example.com> wrote:
+>> I placed an order yesterday.
+"""
+
+
+@pytest.fixture(autouse=True)
+def heuristic_tokens(tmp_path, monkeypatch):
+    """Count tokens without tiktoken's encoding file, as on a machine that never downloaded it."""
+    monkeypatch.setenv('TIKTOKEN_CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(content_reducer, '_encoding', None)
+
+
+def test_keeps_the_new_text_and_the_latest_quote():
+    reduced = content_reducer.reduce_content(THREAD)
+    assert reduced.startswith("Hi team,\n\nMy order 12345-ABC has not arrived yet.")
+    assert "Anna Petrova" not in reduced.split("[Quoted]")[0]
+    assert "confidential" not in reduced
+    quoted = reduced.split("[Quoted]\n")[1]
+    assert quoted == "Thanks for your order, it ships in 2 days."
+
+
+def test_quotes_can_be_dropped():
+    assert "[Quoted]" not in content_reducer.reduce_content(THREAD, quote_budget=0)
+
+
+def test_long_bodies_are_cut_to_the_budget():
+    reduced = content_reducer.reduce_content("word " * 5000, budget=100, quote_budget=0)
+    assert reduced.endswith(content_reducer.TRUNCATION_MARK)
+    assert content_reducer.count_tokens(reduced) <= 110
+
+
+def test_fully_quoted_mail_falls_back_to_the_plain_text():
+    assert content_reducer.reduce_content("> only a quote here") == "> only a quote here"
+    assert content_reducer.reduce_content("") == ''
+
+
+def test_signature_delimiter_and_sign_off():
+    assert content_reducer.strip_signature("Hello\n-- \nJohn\nACME") == "Hello"
+    assert content_reducer.strip_signature("Hello\nThanks,\nJohn") == "Hello"
+    # A sign-off far above the end is part of the text
+    body = "Thanks,\n" + "\n".join(f"line {i}" for i in range(20))
+    assert content_reducer.strip_signature(body) == body
+
+
+def test_no_encoding_file_means_no_download(monkeypatch):
+    tiktoken = pytest.importorskip('tiktoken')
+
+    def download(name):
+        raise AssertionError("tiktoken must not fetch the encoding")
+
+    monkeypatch.setattr(tiktoken, 'get_encoding', download)
+    assert content_reducer.count_tokens("x" * 40) == 11
+    assert content_reducer._encoding is False
+
+
+def test_cached_encoding_is_used(tmp_path, monkeypatch):
+    tiktoken = pytest.importorskip('tiktoken')
+    loaded = []
+
+    class Encoding:
+        def encode(self, text, disallowed_special=()):
+            return text.split()
+
+    def get_encoding(name):
+        loaded.append(name)
+        return Encoding()
+
+    monkeypatch.setattr(tiktoken, 'get_encoding', get_encoding)
+    open(content_reducer.encoding_file(), 'w').close()
+    assert content_reducer.count_tokens("three short words") == 3
+    assert loaded == [content_reducer.ENCODING]
@@ -0,0 +1,72 @@
+import sqlite3
+
+import content_store
+import storage
+
+BODY = "Please refund order 12345-ABC, the parcel arrived broken and soaked. " * 20
+
+
+def search(conn, text):
+    rows, _ = storage.fetch_history_page(conn, 'processed', search=text)
+    return [row['email_id'] for row in rows]
+
+
+def test_round_trip_with_both_codecs():
+    for codec in ('zlib', 'zstd') if content_store.zstandard else ('zlib',):
+        assert content_store.decompress(codec, content_store.compress(BODY, codec)) == BODY
+
+
+def test_short_bodies_stay_inline():
+    assert content_store.split_content("short") == ("short", None, None)
+    text, digest, row = content_store.split_content(BODY)
+    assert text == content_store.preview(BODY) and digest == content_store.content_hash(BODY)
+    assert row[0] == digest and row[3] == len(BODY)
+
+
+def test_long_bodies_are_stored_once_and_compressed(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Refund', BODY, 'Refund', 'high')
+    storage.insert_unhandled_email(conn, 'e1', 'Refund', BODY, 'high')
+    assert conn.execute("SELECT COUNT(*) FROM email_contents").fetchone()[0] == 1
+    size = conn.execute("SELECT length(data) FROM email_contents").fetchone()[0]
+    assert size < len(BODY) / 4
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(processed_emails_full)")}
+    assert 'index_text' not in columns
+    assert len(conn.execute("SELECT content FROM processed_emails_full").fetchone()[0]) < len(BODY)
+
+
+def test_search_covers_the_whole_body(conn):
+    storage.mark_email_processed_full(conn, 'long', 'Refund', BODY + " zeppelin", 'Refund', 'high')
+    storage.mark_email_processed_full(conn, 'short', 'Hello', "A short zeppelin note", 'Other', 'low')
+    assert sorted(search(conn, 'zeppelin')) == ['long', 'short']
+    # Updates and deletes keep the index in step
+    storage.mark_email_processed_full(conn, 'long', 'Refund', BODY, 'Other', 'high')
+    assert search(conn, 'zeppelin') == ['short']
+    with conn:
+        conn.execute("DELETE FROM processed_emails_full WHERE email_id = 'short'")
+    assert search(conn, 'zeppelin') == []
+    assert search(conn, 'soaked') == ['long']
+    with conn:
+        conn.execute("INSERT INTO processed_emails_fts (processed_emails_fts) VALUES ('integrity-check')")
+
+
+def test_index_text_of_an_earlier_version_is_dropped(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Refund', BODY, 'Refund', 'high')
+    with conn:
+        conn.execute("ALTER TABLE processed_emails_full ADD COLUMN index_text TEXT")
+        conn.execute("UPDATE processed_emails_full SET index_text = ?", (BODY,))
+    storage.init_db(conn)
+    assert 'index_text' not in {row[1] for row in conn.execute("PRAGMA table_info(processed_emails_full)")}
+    assert search(conn, 'soaked') == ['e1']
+
+
+def test_plain_sqlite_clients_can_change_history_rows(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Refund', BODY, 'Refund', 'high')
+    if not storage.FTS_CONTENTLESS:
+        # Before SQLite 3.43 the FTS triggers read the bodies back through email_text()
+        return
+    plain = sqlite3.connect(storage.DB_FILE)
+    with plain:
+        plain.execute("UPDATE processed_emails_full SET category = 'Other' WHERE email_id = 'e1'")
+        plain.execute("DELETE FROM processed_emails_full WHERE email_id = 'e1'")
+    plain.close()
+    assert search(conn, 'soaked') == []
@@ -0,0 +1,49 @@
+import time
+
+import coordination
+
+
+def test_account_lease_has_one_owner(conn):
+    assert coordination.claim_account(conn, 'acct', 'host:1')
+    assert not coordination.claim_account(conn, 'acct', 'host:2')
+    # Renewal by the owner
+    assert coordination.claim_account(conn, 'acct', 'host:1')
+    coordination.release_account(conn, 'acct', 'host:1')
+    assert coordination.claim_account(conn, 'acct', 'host:2')
+
+
+def test_expired_lease_is_taken_over(conn):
+    assert coordination.claim_account(conn, 'acct', 'host:1', ttl=-1)
+    assert coordination.claim_account(conn, 'acct', 'host:2')
+
+
+def test_workers_split_the_accounts(conn):
+    accounts = [f"a{i}" for i in range(5)]
+    coordination.register_worker(conn, 'host:1')
+    assert coordination.balance_accounts(conn, 'host:1', accounts) == accounts
+    coordination.register_worker(conn, 'host:2')
+    # The first worker gives up accounts above its share, the second picks them up
+    first = coordination.balance_accounts(conn, 'host:1', accounts)
+    second = coordination.balance_accounts(conn, 'host:2', accounts)
+    assert len(first) == 3 and len(second) == 2
+    assert set(first) | set(second) == set(accounts)
+
+
+def test_stopped_worker_hands_its_accounts_back(conn):
+    accounts = ['a1', 'a2']
+    for worker_id in ('host:1', 'host:2'):
+        coordination.register_worker(conn, worker_id)
+    assert len(coordination.balance_accounts(conn, 'host:1', accounts)) == 1
+    coordination.unregister_worker(conn, 'host:1')
+    assert coordination.live_workers(conn) == 1
+    assert coordination.balance_accounts(conn, 'host:2', accounts) == accounts
+
+
+def test_stale_heartbeat_does_not_count_as_live(conn):
+    coordination.register_worker(conn, 'host:1')
+    with conn:
+        conn.execute("UPDATE workers SET heartbeat_at = ?", (time.time() - coordination.WORKER_TIMEOUT - 1,))
+    assert coordination.live_workers(conn) == 0
+    coordination.heartbeat(conn, 'host:1', processed=3)
+    assert coordination.live_workers(conn) == 1
+    assert coordination.list_workers(conn)[0]['processed'] == 3
@@ -0,0 +1,71 @@
+import embedding_cache
+
+
+class FakeEmbeddings:
+    model = 'fake-small'
+
+    def __init__(self):
+        self.calls = []
+
+    def _vector(self, text):
+        return [float(len(text)), 0.5, -1.0]
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        self.calls.append(text)
+        return self._vector(text)
+
+
+def make_cache(tmp_path, base=None, **kwargs):
+    return embedding_cache.CachedEmbeddings(base or FakeEmbeddings(), cache_file=str(tmp_path / 'embeddings.db'), **kwargs)
+
+
+def test_documents_are_embedded_once(tmp_path):
+    base = FakeEmbeddings()
+    cache = make_cache(tmp_path, base)
+    assert cache.embed_documents(['alpha', 'beta', 'alpha']) == [[5.0, 0.5, -1.0], [4.0, 0.5, -1.0], [5.0, 0.5, -1.0]]
+    assert cache.embed_documents(['beta', 'gamma']) == [[4.0, 0.5, -1.0], [5.0, 0.5, -1.0]]
+    assert base.calls == [['alpha', 'beta'], ['gamma']]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_whitespace_variants_share_an_entry(tmp_path):
+    base = FakeEmbeddings()
+    cache = make_cache(tmp_path, base)
+    cache.embed_query("Where is  my order?")
+    cache.embed_query(" Where is my\norder? ")
+    assert base.calls == ["Where is  my order?"]
+
+
+def test_vectors_persist_across_instances(tmp_path):
+    make_cache(tmp_path).embed_query('pricing')
+    base = FakeEmbeddings()
+    # A fresh process: nothing in memory, the vector comes from SQLite
+    assert make_cache(tmp_path, base).embed_query('pricing') == [7.0, 0.5, -1.0]
+    assert base.calls == []
+
+
+def test_models_do_not_share_vectors(tmp_path):
+    make_cache(tmp_path).embed_query('pricing')
+    other = FakeEmbeddings()
+    other.model = 'fake-large'
+    make_cache(tmp_path, other).embed_query('pricing')
+    assert other.calls == ['pricing']
+
+
+def test_eviction_keeps_the_recently_used_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(embedding_cache, 'EVICT_EVERY', 1)
+    cache = make_cache(tmp_path, max_entries=2, memory_entries=1)
+    cache.embed_query('a')
+    cache.embed_query('bb')
+    with cache._conn:
+        cache._conn.execute("UPDATE embeddings SET last_used = 0 WHERE key = ?", (cache._key('a'),))
+    cache.embed_query('ccc')
+    stored = cache._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    assert stored == 2
+    base = cache.embeddings
+    cache.embed_query('a')
+    assert base.calls[-1] == 'a'
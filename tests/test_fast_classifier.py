@@ -0,0 +1,42 @@
+import pytest
+
+import fast_classifier
+
+PRICING = "Hi! What is the pricing of your Pro plan? How does the TMS integration work? Can we book a demo?"
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(fast_classifier, '_stats', {'hits': 0, 'misses': 0, 'rules': fast_classifier.Counter()})
+
+
+def test_reply_to_a_pending_refund_question():
+    assert fast_classifier.precategorize("Here it is", has_pending=True) == \
+        ('Refund', 'Rule: pending_reply (1.00)', 'medium')
+
+
+def test_refund_with_an_order_id():
+    category, _, _ = fast_classifier.precategorize("I want a refund please. Order ID: 12345-ABC")
+    assert category == 'Refund'
+
+
+def test_auto_reply_headers_and_subject():
+    assert fast_classifier.precategorize("I am away", {'Auto-Submitted': 'auto-replied'})[0] == 'Other'
+    assert fast_classifier.precategorize("I am away", {'Subject': 'Out of office: back Monday'})[0] == 'Other'
+    assert fast_classifier.precategorize("Hello", {'Auto-Submitted': 'no'}) is None
+
+
+def test_strong_keyword_match_skips_the_llm():
+    category, confidence = fast_classifier.score_keywords(PRICING)
+    assert category == 'Question' and confidence >= fast_classifier.FAST_PATH_THRESHOLD
+    assert fast_classifier.precategorize(PRICING) == ('Question', f"Rule: keywords ({confidence:.2f})", 'medium')
+    assert fast_classifier.get_stats() == {'hits': 1, 'misses': 0, 'rules': {'keywords': 1}}
+
+
+def test_weak_or_mixed_keywords_go_to_the_llm():
+    # A single word, and words of both categories
+    assert fast_classifier.score_keywords("Can I get a refund")[1] < fast_classifier.FAST_PATH_THRESHOLD
+    assert fast_classifier.score_keywords("How do I return it? What about a refund?")[1] < fast_classifier.FAST_PATH_THRESHOLD
+    assert fast_classifier.score_keywords("Thanks, all good") == (None, 0.0)
+    assert fast_classifier.precategorize("Can I get a refund") is None
+    assert fast_classifier.get_stats()['misses'] == 1
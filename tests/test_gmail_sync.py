@@ -0,0 +1,75 @@
+import pytest
+
+import gmail_sync
+from conftest import FakeGmail, HttpError
+
+
+def added(email_id, labels=('INBOX', 'UNREAD')):
+    return {'messagesAdded': [{'message': {'id': email_id, 'labelIds': list(labels)}}]}
+
+
+def test_list_unread_ids_follows_every_page():
+    gmail = FakeGmail(unread=[f"m{i}" for i in range(5)], page_size=2)
+    assert gmail_sync.list_unread_ids(gmail, 'is:unread') == ['m0', 'm1', 'm2', 'm3', 'm4']
+    assert [kwargs.get('pageToken') for _, kwargs in gmail.calls] == [None, '2', '4']
+
+
+def test_list_unread_ids_stops_at_max_messages():
+    gmail = FakeGmail(unread=[f"m{i}" for i in range(10)], page_size=2)
+    assert gmail_sync.list_unread_ids(gmail, 'is:unread', max_messages=3) == ['m0', 'm1', 'm2']
+    assert len(gmail.calls) == 2
+
+
+def test_list_history_ids_pages_dedupes_and_skips_read_mail():
+    history = [added('a'), added('b'), added('a'), added('read', labels=('INBOX',)), added('c')]
+    gmail = FakeGmail(history=history, history_id='250', page_size=2)
+    ids, history_id = gmail_sync.list_history_ids(gmail, '200')
+    assert ids == ['a', 'b', 'c']
+    assert history_id == '250'
+    assert all(kwargs['startHistoryId'] == '200' for _, kwargs in gmail.calls)
+    assert len(gmail.calls) == 3
+
+
+def test_fetch_uses_history_since_checkpoint(conn):
+    gmail_sync.save_history_checkpoint(conn, 'acct', '200')
+    gmail = FakeGmail(unread=['old'], history=[added('new')], history_id='210')
+    assert gmail_sync.fetch_new_message_ids(gmail, conn, 'acct', 'is:unread') == (['new'], '210')
+    assert [name for name, _ in gmail.calls] == ['history.list']
+
+
+def test_fetch_without_checkpoint_lists_the_backlog(conn):
+    gmail = FakeGmail(unread=['m1', 'm2', 'm3'], history_id='300')
+    assert gmail_sync.fetch_new_message_ids(gmail, conn, 'acct', 'is:unread') == (['m1', 'm2', 'm3'], '300')
+    # The checkpoint is saved by the caller once the emails are handled
+    assert gmail_sync.get_history_checkpoint(conn, 'acct') is None
+
+
+def test_expired_checkpoint_falls_back_to_full_resync(conn):
+    gmail_sync.save_history_checkpoint(conn, 'acct', '5')
+    gmail = FakeGmail(unread=['m1', 'm2', 'm3'], history_id='900')
+    gmail.history_error = HttpError(404)
+    assert gmail_sync.fetch_new_message_ids(gmail, conn, 'acct', 'is:unread') == (['m1', 'm2', 'm3'], '900')
+    assert [name for name, _ in gmail.calls] == ['history.list', 'messages.list', 'messages.list']
+
+
+def test_other_history_errors_are_raised(conn):
+    gmail_sync.save_history_checkpoint(conn, 'acct', '5')
+    gmail = FakeGmail(unread=['m1'])
+    gmail.history_error = HttpError(500)
+    with pytest.raises(HttpError):
+        gmail_sync.fetch_new_message_ids(gmail, conn, 'acct', 'is:unread')
+
+
+def test_checkpoint_round_trip(conn):
+    gmail_sync.save_history_checkpoint(conn, 'acct', 42)
+    assert gmail_sync.get_history_checkpoint(conn, 'acct') == '42'
+    gmail_sync.clear_history_checkpoint(conn, 'acct')
+    assert gmail_sync.get_history_checkpoint(conn, 'acct') is None
+
+
+def test_history_delta_is_filtered_by_the_query(conn):
+    gmail_sync.save_history_checkpoint(conn, 'acct', '200')
+    # Only 'new' matches newer_than:1d; 'stale' was an old message marked unread again
+    gmail = FakeGmail(unread=['new'], history=[added('stale'), added('new')], history_id='210')
+    assert gmail_sync.fetch_new_message_ids(gmail, conn, 'acct', 'is:unread newer_than:1d') == (['new'], '210')
+    assert [kwargs.get('q') for name, kwargs in gmail.calls if name == 'messages.list'] == ['is:unread newer_than:1d']
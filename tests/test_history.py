@@ -0,0 +1,58 @@
+import storage
+
+
+def stats(conn):
+    return {(row['category'], row['importance']): row['count'] for row in storage.get_email_stats(conn)}
+
+
+def test_stats_follow_inserts_updates_and_deletes(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Hi', 'body', 'Question', 'low')
+    storage.mark_email_processed_full(conn, 'e2', 'Hi', 'body', 'Question', 'low')
+    storage.mark_email_processed_full(conn, 'e3', 'Hi', 'body', 'Refund', 'high')
+    # Processing an email again replaces its row, also within or into an existing (category, importance)
+    storage.mark_email_processed_full(conn, 'e1', 'Hi again', 'body', 'Question', 'low')
+    storage.mark_email_processed_full(conn, 'e2', 'Hi again', 'body', 'Refund', 'high')
+    subjects = {row[0]: row[1] for row in conn.execute("SELECT email_id, subject FROM processed_emails_full")}
+    assert subjects == {'e1': 'Hi again', 'e2': 'Hi again', 'e3': 'Hi'}
+    assert stats(conn) == {('Question', 'low'): 1, ('Refund', 'high'): 2}
+    with conn:
+        conn.execute("DELETE FROM processed_emails_full WHERE email_id = 'e1'")
+    assert stats(conn) == {('Refund', 'high'): 2}
+
+
+def test_change_version_moves_on_every_write(conn):
+    before = storage.get_change_version(conn)
+    storage.insert_unhandled_email(conn, 'e1', 'Hi', 'body', 'low')
+    storage.mark_email_processed_full(conn, 'e1', 'Hi', 'body', 'Other', 'low')
+    assert storage.get_change_version(conn) == before + 2
+
+
+def test_pages_walk_the_history_newest_first(conn):
+    with conn:
+        conn.executemany("INSERT INTO processed_emails_full (email_id, subject, content, category, importance, processed_at) "
+                         "VALUES (?, 'Hi', 'body', 'Other', 'low', ?)",
+                         [(f"e{i}", f"2024-01-01T00:00:{i % 3:02d}") for i in range(7)])
+    seen, cursor = [], None
+    while True:
+        rows, cursor = storage.fetch_history_page(conn, 'processed', limit=3, cursor=cursor)
+        seen.extend(row['email_id'] for row in rows)
+        if not cursor:
+            break
+    assert seen == ['e5', 'e2', 'e4', 'e1', 'e6', 'e3', 'e0']
+
+
+def test_search_matches_terms_and_ignores_fts_syntax(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Refund please', 'order 12345-ABC is broken', 'Refund', 'high')
+    storage.mark_email_processed_full(conn, 'e2', 'Question', 'what are your opening hours', 'Question', 'low')
+    for text, expected in (('refund', ['e1']), ('12345-ABC broken', ['e1']), ('hours', ['e2']),
+                           ('"unbalanced OR', []), ('NEAR(', [])):
+        rows, _ = storage.fetch_history_page(conn, 'processed', search=text)
+        assert [row['email_id'] for row in rows] == expected, text
+
+
+def test_like_search_on_the_smaller_tables(conn):
+    storage.insert_unhandled_email(conn, 'u1', 'Help', 'x' * 300 + ' needle', 'high')
+    storage.insert_unhandled_email(conn, 'u2', 'Other', 'nothing here', 'low')
+    rows, _ = storage.fetch_history_page(conn, 'unhandled', search='needle')
+    assert [row['email_id'] for row in rows] == ['u1']
+    assert rows[0]['content'].endswith('...')
@@ -0,0 +1,85 @@
+import pytest
+from langchain_core.documents import Document
+
+import kb_search
+
+QUESTIONS = """Q: What pricing plans do you offer?
+A: Free, Starter, Growth, Scale and Pro.
+Q: Do you integrate with my TMS?
+A: Yes, with the common TMS platforms.
+Q: Can I book a demo?
+A: Yes, schedule a meeting on our site."""
+REFUNDS = """Q: How do refunds work?
+A: Send the Order ID and we refund within 3 days."""
+DOCUMENTS = [Document(page_content=QUESTIONS, metadata={'category': 'Question Category'}),
+             Document(page_content=REFUNDS, metadata={'category': 'Refund Category'})]
+
+
+class FakeVectorStore:
+    """Returns fixed results and records the queries."""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def similarity_search(self, query, k):
+        self.queries.append(query)
+        return self.results[:k]
+
+
+def test_passages_are_split_per_question():
+    passages = kb_search.split_passages(DOCUMENTS)
+    assert len(passages) == 4
+    assert passages[1].page_content.startswith('Q: Do you integrate')
+    assert passages[3].metadata == {'category': 'Refund Category'}
+
+
+def test_tokenize_drops_stopwords_and_folds_plurals():
+    assert kb_search.tokenize("What are the pricing plans and policies?") == ['pricing', 'plan', 'policy']
+
+
+def test_bm25_ranks_the_matching_passage_first():
+    kb = kb_search.KnowledgeBaseSearch(DOCUMENTS, mode='bm25')
+    assert kb.search("Which plans can I pick?", k=1)[0].page_content.startswith('Q: What pricing plans')
+    assert kb.search("integration with TMS", k=1)[0].page_content.startswith('Q: Do you integrate')
+
+
+def test_category_restricts_the_search():
+    kb = kb_search.KnowledgeBaseSearch(DOCUMENTS, mode='bm25')
+    assert [doc.metadata['category'] for doc in kb.search("refund", category='Refund')] == ['Refund Category']
+    assert all(doc.metadata['category'] == 'Question Category' for doc in kb.search("refund demo", category='Question'))
+
+
+def test_hybrid_skips_the_vector_search_when_bm25_is_confident():
+    store = FakeVectorStore([kb_search.split_passages(DOCUMENTS)[2]])
+    kb = kb_search.KnowledgeBaseSearch(DOCUMENTS, store, mode='hybrid')
+    assert kb.search("pricing plans", k=1)[0].page_content.startswith('Q: What pricing plans')
+    assert store.queries == []
+
+
+def test_hybrid_fuses_vector_results_for_a_weak_match():
+    demo = kb_search.split_passages(DOCUMENTS)[2]
+    store = FakeVectorStore([demo])
+    kb = kb_search.KnowledgeBaseSearch(DOCUMENTS, store, mode='hybrid')
+    results = kb.search("Could someone walk me through the product?", k=2)
+    assert store.queries == ["Could someone walk me through the product?"]
+    assert results[0].page_content == demo.page_content
+
+
+def test_without_a_vector_store_hybrid_falls_back_to_bm25():
+    assert kb_search.KnowledgeBaseSearch(DOCUMENTS, None, mode='hybrid').mode == 'bm25'
+    with pytest.raises(ValueError):
+        kb_search.KnowledgeBaseSearch(DOCUMENTS, mode='fuzzy')
+
+
+def test_update_rebuilds_the_index_but_ignores_an_empty_kb():
+    kb = kb_search.KnowledgeBaseSearch(DOCUMENTS, mode='bm25')
+    kb.update([])
+    assert len(kb.passages) == 4
+    kb.update([Document(page_content="Q: Do you ship to Canada?\nA: Yes.", metadata={'category': 'Question Category'})])
+    assert [doc.page_content for doc in kb.search("Canada")] == ["Q: Do you ship to Canada?\nA: Yes."]
+
+
+def test_retriever_returns_the_category_passages():
+    retriever = kb_search.KnowledgeBaseSearch(DOCUMENTS, mode='bm25').as_retriever(k=1, category='Refund')
+    assert [doc.page_content for doc in retriever.invoke("refund")] == [REFUNDS]
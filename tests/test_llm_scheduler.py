@@ -0,0 +1,77 @@
+import threading
+import time
+
+import llm_scheduler
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+def test_concurrent_calls_map_back_by_key():
+    scheduler = llm_scheduler.LLMScheduler(max_concurrency=4)
+    threads = set()
+
+    def single(text):
+        threads.add(threading.current_thread().name)
+        if text == 'bad':
+            raise ValueError("parse error")
+        return text.upper()
+
+    items = {f"e{i}": f"text {i}" for i in range(8)}
+    items['e9'] = 'bad'
+    results = scheduler.map(single, None, items, 'default')
+    assert results == {**{f"e{i}": f"TEXT {i}" for i in range(8)}, 'e9': 'default'}
+    assert all(name.startswith('llm') for name in threads)
+
+
+def test_batch_mode_groups_items_into_prompts():
+    scheduler = llm_scheduler.LLMScheduler(mode='batch', batch_size=3)
+    batches = []
+
+    def batch(texts):
+        batches.append(list(texts))
+        # Unparsed and missing entries fall back to the default
+        outputs = [None if text == 'c' else text * 2 for text in texts]
+        return outputs[:-1] if 'e' in texts else outputs
+
+    results = scheduler.map(None, batch, {k: k for k in 'abcde'}, '?')
+    assert sorted(map(len, batches)) == [2, 3]
+    assert results == {'a': 'aa', 'b': 'bb', 'c': '?', 'd': 'dd', 'e': '?'}
+
+
+def test_rate_limit_pauses_retries_and_slows_down():
+    scheduler = llm_scheduler.LLMScheduler(backoff=0.05)
+    calls = []
+
+    def flaky(text):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RateLimitError()
+        return text
+
+    assert scheduler.call(flaky, 'ok') == 'ok'
+    assert scheduler.rate_limited == 1
+    assert calls[1] - calls[0] >= 0.05
+    # Halved on the 429, then 10% back on the success
+    assert abs(scheduler.requests.factor - 0.55) < 1e-9 and abs(scheduler.tokens.factor - 0.55) < 1e-9
+
+
+def test_other_errors_are_not_retried():
+    scheduler = llm_scheduler.LLMScheduler()
+    calls = []
+
+    def broken(text):
+        calls.append(text)
+        raise ValueError("bad request")
+
+    assert scheduler.map(broken, None, {'e1': 'x'}, 'default') == {'e1': 'default'}
+    assert calls == ['x'] and scheduler.rate_limited == 0
+
+
+def test_token_bucket_waits_for_a_refill():
+    bucket = llm_scheduler.TokenBucket(6000)  # 100 per second
+    bucket.acquire(6000)
+    started = time.monotonic()
+    bucket.acquire(10)
+    assert time.monotonic() - started >= 0.08
@@ -0,0 +1,64 @@
+import base64
+
+import mime_body
+
+
+def data(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode().rstrip('=')
+
+
+def part(mime, text=None, filename='', headers=(), **body):
+    if text is not None:
+        body['data'] = data(text)
+    return {'mimeType': mime, 'filename': filename, 'headers': list(headers), 'body': body}
+
+
+def multipart(*parts, mime='multipart/mixed'):
+    return {'mimeType': mime, 'parts': list(parts), 'body': {}}
+
+
+def test_plain_text_wins_over_html_in_nested_parts():
+    payload = multipart(multipart(part('text/html', '<p>Hi</p>'), part('text/plain', 'Hi plain'), mime='multipart/alternative'),
+                        part('image/png', filename='logo.png', attachmentId='a1'))
+    assert mime_body.extract_text(payload) == 'Hi plain'
+
+
+def test_attachments_are_not_bodies():
+    payload = multipart(part('text/plain', 'invoice text', filename='invoice.txt'),
+                        part('text/html', '<div>Hello <b>there</b></div>'))
+    assert mime_body.extract_text(payload) == 'Hello there'
+    only_attachment = multipart(part('text/plain', 'x', headers=[{'name': 'Content-Disposition', 'value': 'attachment'}]))
+    assert mime_body.extract_text(only_attachment) == ''
+
+
+def test_charset_from_the_part_headers():
+    payload = part('text/plain', headers=[{'name': 'Content-Type', 'value': 'text/plain; charset="koi8-r"'}])
+    payload['body']['data'] = data('Привет', 'koi8-r')
+    assert mime_body.extract_text(payload) == 'Привет'
+
+
+def test_html_to_text_skips_scripts_and_keeps_blocks():
+    html = "<html><head><title>T</title><style>p {}</style></head><body><p>One</p><script>x()</script>" \
+           "<p>Two &amp; three</p><br><br><br>Four</body></html>"
+    assert mime_body.html_to_text(html) == "One\n\nTwo & three\n\nFour"
+
+
+def test_decoding_stops_at_the_caps():
+    assert len(mime_body.decode_data(data('x' * 1000), max_bytes=100)) == 100
+    assert len(mime_body.html_to_text('<p>' + 'word ' * 1000 + '</p>', max_chars=50, chunk_size=64)) == 50
+
+
+def test_fetch_skips_bodies_that_are_not_needed(monkeypatch):
+    calls = []
+
+    def batch_get_messages(service, message_ids, **kwargs):
+        calls.append((list(message_ids), kwargs))
+        if kwargs['format'] == 'metadata':
+            return {message_id: {'id': message_id, 'snippet': f"snippet {message_id}"} for message_id in message_ids}, {}
+        return {message_id: {'payload': part('text/plain', f"body {message_id}")} for message_id in message_ids}, {}
+
+    monkeypatch.setattr(mime_body.gmail_batch, 'batch_get_messages', batch_get_messages)
+    msgs, errors = mime_body.fetch_messages(None, ['m1', 'm2'], needs_body=lambda msg: msg['id'] == 'm1')
+    assert errors == {}
+    assert {message_id: msg['body_text'] for message_id, msg in msgs.items()} == {'m1': 'body m1', 'm2': 'snippet m2'}
+    assert calls[1][0] == ['m1'] and calls[1][1]['fields'] == mime_body.BODY_FIELDS
@@ -0,0 +1,89 @@
+import json
+import threading
+from collections import OrderedDict
+
+import pytest
+
+import order_store
+import storage
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(order_store, '_missing', OrderedDict())
+
+
+def status(conn, order_id):
+    row = conn.execute("SELECT status FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    return row[0] if row else None
+
+
+def add_order(conn, order_id, status='active'):
+    with conn:
+        conn.execute("INSERT INTO orders (order_id, status) VALUES (?, ?)", (order_id, status))
+
+
+def test_import_csv_in_batches(conn, tmp_path):
+    path = tmp_path / 'orders.csv'
+    path.write_text("order_id,status\n" + "".join(f"A-{i}, shipped\n" for i in range(5)) + " ,active\n")
+    assert order_store.import_orders(conn, str(path), batch_size=2) == 5
+    assert status(conn, 'A-3') == 'shipped'
+
+
+def test_import_jsonl_keeps_or_updates_known_orders(conn, tmp_path):
+    add_order(conn, '1', 'refund_requested')
+    path = tmp_path / 'orders.jsonl'
+    path.write_text("\n".join(json.dumps(record) for record in [{'order_id': 1, 'status': 'active'}, {'order_id': 2}]))
+    order_store.import_orders(conn, str(path))
+    assert (status(conn, '1'), status(conn, '2')) == ('refund_requested', 'active')
+    order_store.import_orders(conn, str(path), update_existing=True)
+    assert status(conn, '1') == 'active'
+
+
+def test_request_refund_flags_the_order(conn):
+    add_order(conn, 'A-1')
+    assert order_store.request_refund(conn, 'A-1')
+    assert status(conn, 'A-1') == 'refund_requested'
+
+
+def test_concurrent_requests_flag_every_order(conn):
+    for i in range(20):
+        add_order(conn, f"C-{i}")
+    results = []
+
+    def request(ids):
+        thread_conn = storage.get_connection()
+        results.extend(order_store.request_refund(thread_conn, order_id) for order_id in ids)
+
+    threads = [threading.Thread(target=request, args=([f"C-{i}" for i in range(20)],)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 80
+    assert conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'refund_requested'").fetchone()[0] == 20
+
+
+def test_unknown_order_is_remembered_until_it_expires(conn, monkeypatch):
+    assert not order_store.request_refund(conn, 'NOPE')
+    # Added behind the cache's back, e.g. by another process
+    add_order(conn, 'NOPE')
+    assert not order_store.request_refund(conn, 'NOPE')
+    assert status(conn, 'NOPE') == 'active'
+    order_store._missing['NOPE'] -= order_store.MISSING_CACHE_TTL + 1
+    assert order_store.request_refund(conn, 'NOPE')
+
+
+def test_import_clears_the_missing_cache(conn, tmp_path):
+    assert not order_store.request_refund(conn, 'B-7')
+    path = tmp_path / 'orders.csv'
+    path.write_text("order_id,status\nB-7,active\n")
+    order_store.import_orders(conn, str(path))
+    assert order_store.request_refund(conn, 'B-7')
+
+
+def test_missing_cache_is_bounded(conn, monkeypatch):
+    monkeypatch.setattr(order_store, 'MISSING_CACHE_SIZE', 2)
+    for order_id in ('X1', 'X2', 'X3'):
+        order_store.request_refund(conn, order_id)
+    assert list(order_store._missing) == ['X2', 'X3']
@@ -0,0 +1,134 @@
+import time
+
+import pytest
+
+import outbox
+import storage
+from conftest import HttpError
+
+
+def queue_reply(conn, email_id='<in-1@example.com>'):
+    return outbox.enqueue(conn, 'acct', 'support@example.com', email_id, 'client@example.com', 'Re: Hi', 'Hello')
+
+
+def row(conn, message_id):
+    return conn.execute("SELECT * FROM outbox WHERE message_id = ?", (message_id,)).fetchone()
+
+
+def make_due(conn):
+    with conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = 0")
+
+
+def test_enqueue_once_per_email(conn):
+    message_id = queue_reply(conn)
+    assert message_id.endswith('@example.com>')
+    queue_reply(conn)
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 1
+
+
+def test_send_due_delivers_and_marks_sent(conn, gmail):
+    message_id = queue_reply(conn)
+    assert outbox.send_due(conn, lambda account: gmail) == 1
+    sent = row(conn, message_id)
+    assert sent['status'] == 'sent' and sent['gmail_id'] == 'sent-1' and sent['attempts'] == 1
+    assert list(gmail.sent.values()) == [message_id.strip('<>')]
+    assert outbox.send_due(conn, lambda account: gmail) == 0
+
+
+def test_transient_failure_is_retried_with_backoff(conn, gmail):
+    message_id = queue_reply(conn)
+    gmail.send_errors.append(HttpError(503))
+    before = time.time()
+    assert outbox.send_due(conn, lambda account: gmail) == 0
+    failed = row(conn, message_id)
+    assert failed['status'] == 'pending' and failed['attempts'] == 1
+    assert failed['next_attempt_at'] >= before + outbox.BACKOFF
+    assert 'HTTP 503' in failed['last_error']
+    # Not due yet
+    assert outbox.send_due(conn, lambda account: gmail) == 0
+    make_due(conn)
+    assert outbox.send_due(conn, lambda account: gmail) == 1
+    assert row(conn, message_id)['status'] == 'sent'
+    assert len(gmail.sent) == 1
+
+
+def test_retry_finds_a_send_that_went_through(conn, gmail):
+    message_id = queue_reply(conn)
+    # Gmail accepted the message but the response was lost
+    gmail.fail_after_send.append(HttpError(500))
+    assert outbox.send_due(conn, lambda account: gmail) == 0
+    make_due(conn)
+    assert outbox.send_due(conn, lambda account: gmail) == 1
+    assert len(gmail.sent) == 1
+    assert row(conn, message_id)['gmail_id'] == 'sent-1'
+    sends = [call for call in gmail.calls if call[0] == 'messages.send']
+    assert len(sends) == 1
+
+
+def test_permanent_failure_is_not_retried(conn, gmail):
+    message_id = queue_reply(conn)
+    gmail.send_errors.append(HttpError(400))
+    outbox.send_due(conn, lambda account: gmail)
+    assert row(conn, message_id)['status'] == 'failed'
+    make_due(conn)
+    assert outbox.send_due(conn, lambda account: gmail) == 0
+    assert gmail.sent == {}
+
+
+def test_gives_up_after_max_attempts(conn, gmail, monkeypatch):
+    monkeypatch.setattr(outbox, 'MAX_ATTEMPTS', 2)
+    message_id = queue_reply(conn)
+    gmail.send_errors.extend([HttpError(503), HttpError(503)])
+    outbox.send_due(conn, lambda account: gmail)
+    make_due(conn)
+    outbox.send_due(conn, lambda account: gmail)
+    failed = row(conn, message_id)
+    assert failed['status'] == 'failed' and failed['attempts'] == 2
+
+
+def test_stale_sending_row_is_picked_up_again(conn, gmail):
+    message_id = queue_reply(conn)
+    # A sender that crashed between its claim and the send
+    with conn:
+        conn.execute("UPDATE outbox SET status = 'sending', attempts = 1, next_attempt_at = ?", (time.time() - 1,))
+    assert outbox.send_due(conn, lambda account: gmail) == 1
+    assert row(conn, message_id)['attempts'] == 2
+    assert [name for name, _ in gmail.calls] == ['messages.list', 'messages.send']
+
+
+def test_account_without_service_is_deferred(conn, gmail):
+    message_id = queue_reply(conn)
+    assert outbox.send_due(conn, lambda account: None) == 0
+    deferred = row(conn, message_id)
+    assert deferred['status'] == 'pending' and deferred['attempts'] == 0
+    assert deferred['next_attempt_at'] > time.time() + outbox.NO_SERVICE_DELAY / 2
+
+
+def test_email_handled_again_gets_its_stored_reply(conn):
+    first = queue_reply(conn)
+    assert queue_reply(conn) == first
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 1
+
+
+def test_reply_commits_with_the_email_state(conn):
+    with storage.batched_writes():
+        with storage.grouped_writes(conn):
+            message_id = queue_reply(conn)
+            storage.insert_pending_refund(conn, '<in-1@example.com>', message_id, None, 'asked')
+            storage.mark_email_processed_full(conn, '<in-1@example.com>', 'Refund', 'body', 'Refund', 'low')
+            # A flush from another stage thread must not commit half of the email
+            storage.flush()
+            assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
+        storage.flush()
+    assert row(conn, message_id)['status'] == 'pending'
+    assert conn.execute("SELECT system_reply_id FROM pending_refunds").fetchone()[0] == message_id
+    assert storage.is_email_processed(conn, '<in-1@example.com>')
+
+
+def test_failed_handler_writes_nothing(conn):
+    with pytest.raises(RuntimeError):
+        with storage.grouped_writes(conn):
+            queue_reply(conn)
+            raise RuntimeError("handler crashed")
+    assert conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0
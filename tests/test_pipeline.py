@@ -0,0 +1,161 @@
+import threading
+import time
+
+import coordination
+import pipeline
+import storage
+
+
+def make_pipeline(owner, conn, queue_size=10, handlers=None, **kwargs):
+    coordination.register_worker(conn, owner)
+    return pipeline.Pipeline(handlers or {}, owner, queue_size=queue_size, **kwargs)
+
+
+def owners(conn):
+    return {row[0]: row[1] for row in conn.execute("SELECT email_id, owner FROM pipeline")}
+
+
+def run_until(worker, done, timeout=5):
+    worker.start()
+    try:
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        worker.stop()
+
+
+def test_stages_move_emails_through_to_done(conn):
+    seen = []
+
+    def handler(stage):
+        def handle(items):
+            seen.append((stage, [item.email_id for item in items]))
+            for item in items:
+                item.data[stage] = True
+            return {item.email_id: True for item in items}
+        return handle
+
+    worker = make_pipeline('host:1', conn, handlers={stage: handler(stage) for stage in pipeline.STAGES},
+                           workers={stage: 1 for stage in pipeline.STAGES}, load_interval=0.05)
+    worker.claim(conn, 'acct', [('e1', {})])
+    run_until(worker, lambda: worker.completed >= 1)
+    assert [stage for stage, _ in seen] == list(pipeline.STAGES)
+    assert owners(conn) == {}
+
+
+def test_failed_stage_is_retried_then_parked(conn, monkeypatch):
+    monkeypatch.setattr(pipeline, 'MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(pipeline, 'RETRY_DELAY', 0.0)
+    calls = []
+
+    def parse(items):
+        calls.append(items[0].email_id)
+        return {item.email_id: None for item in items}
+
+    worker = make_pipeline('host:1', conn, handlers={'parse': parse}, workers={stage: 1 for stage in pipeline.STAGES},
+                           load_interval=0.05)
+    worker.claim(conn, 'acct', [('e1', {})])
+    worker.set_accounts(['acct'])
+    run_until(worker, lambda: len(calls) >= 2)
+    row = conn.execute("SELECT stage, attempts FROM pipeline WHERE email_id = 'e1'").fetchone()
+    assert (row['stage'], row['attempts']) == ('failed', 2)
+    assert worker.backlog(conn) == 0
+
+
+def test_stage_results_survive_a_restart(conn):
+    def parse(items):
+        for item in items:
+            item.data['parsed'] = 'yes'
+        return {item.email_id: True for item in items}
+
+    # No classify threads, so the email waits there when the worker stops
+    worker = make_pipeline('host:1', conn, handlers={'parse': parse}, workers={'parse': 1, 'classify': 0, 'act': 0, 'ack': 0})
+    worker.claim(conn, 'acct', [('e1', {'raw': 1})])
+    run_until(worker, lambda: conn.execute("SELECT stage FROM pipeline").fetchone()['stage'] == 'classify')
+    restarted = make_pipeline('host:1', conn)
+    assert restarted.load(conn, ['acct']) == 1
+    item = restarted.queues['classify'].get_nowait()
+    assert item.data == {'raw': 1, 'parsed': 'yes'}
+
+
+def test_load_skips_other_accounts_and_inflight_rows(conn):
+    worker = make_pipeline('host:1', conn)
+    worker.claim(conn, 'acct', [('e1', {})])
+    worker.claim(conn, 'other', [('e2', {})])
+    # Both are queued in memory already
+    assert worker.load(conn, ['acct', 'other']) == 0
+    restarted = make_pipeline('host:1', conn)
+    assert restarted.load(conn, ['acct']) == 1
+    assert restarted.queues['parse'].get_nowait().email_id == 'e1'
+
+
+def test_full_queue_leaves_emails_in_the_table(conn):
+    worker = make_pipeline('host:1', conn, queue_size=2)
+    claimed = worker.claim(conn, 'acct', [(f"e{i}", {}) for i in range(5)])
+    assert len(claimed) == 5 and worker.depths()['parse'] == 2
+    assert worker.backlog(conn) == 5
+    worker.queues['parse'].get_nowait()
+    worker._inflight.clear()
+    worker.queues['parse'].get_nowait()
+    assert worker.load(conn, ['acct']) == 2
+
+
+def test_claim_queues_each_email_once_across_workers(conn):
+    first, second = make_pipeline('host:1', conn), make_pipeline('host:2', conn)
+    claimed = first.claim(conn, 'acct', [('e1', {'n': 1}), ('e2', {'n': 2})])
+    assert [item.email_id for item in claimed] == ['e1', 'e2']
+    claimed = second.claim(conn, 'acct', [('e2', {'n': 2}), ('e3', {'n': 3})])
+    assert [item.email_id for item in claimed] == ['e3']
+    assert owners(conn) == {'e1': 'host:1', 'e2': 'host:1', 'e3': 'host:2'}
+    assert first.depths()['parse'] == 2 and second.depths()['parse'] == 1
+
+
+def test_claim_skips_processed_emails(conn):
+    storage.mark_email_processed_full(conn, 'done', 'Hi', 'body', 'Other', 'low')
+    claimed = make_pipeline('host:1', conn).claim(conn, 'acct', [('done', {}), ('new', {})])
+    assert [item.email_id for item in claimed] == ['new']
+
+
+def test_concurrent_claims_never_share_an_email(conn):
+    workers = [make_pipeline(f"host:{i}", conn, queue_size=100) for i in range(4)]
+    emails = [(f"e{i}", {}) for i in range(50)]
+    results = {}
+
+    def claim(worker):
+        results[worker.owner] = worker.claim(storage.get_connection(), 'acct', emails)
+
+    threads = [threading.Thread(target=claim, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    claimed = [item.email_id for items in results.values() for item in items]
+    assert sorted(claimed) == sorted(email_id for email_id, _ in emails)
+
+
+def test_load_takes_over_rows_of_a_gone_worker(conn):
+    gone = make_pipeline('host:1', conn)
+    gone.claim(conn, 'acct', [('e1', {'n': 1}), ('e2', {'n': 2})])
+    coordination.unregister_worker(conn, 'host:1')
+    successor = make_pipeline('host:2', conn)
+    assert successor.load(conn, ['acct']) == 2
+    assert owners(conn) == {'e1': 'host:2', 'e2': 'host:2'}
+    item = successor.queues['parse'].get_nowait()
+    assert item.email_id == 'e1' and item.data == {'n': 1}
+
+
+def test_load_leaves_rows_of_a_live_worker(conn):
+    make_pipeline('host:1', conn).claim(conn, 'acct', [('e1', {})])
+    other = make_pipeline('host:2', conn)
+    assert other.load(conn, ['acct']) == 0
+    assert owners(conn) == {'e1': 'host:1'}
+
+
+def test_load_takes_over_after_the_heartbeat_times_out(conn):
+    make_pipeline('host:1', conn).claim(conn, 'acct', [('e1', {})])
+    with conn:
+        conn.execute("UPDATE workers SET heartbeat_at = ? WHERE worker_id = 'host:1'",
+                     (time.time() - coordination.WORKER_TIMEOUT - 1,))
+    assert make_pipeline('host:2', conn).load(conn, ['acct']) == 1
+    assert owners(conn) == {'e1': 'host:2'}
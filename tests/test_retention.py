@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import content_store
+import coordination
+import retention
+import storage
+
+OLD = (datetime.now() - timedelta(days=100)).isoformat()
+BODY = "Please refund order 12345-ABC, it arrived broken. " * 10
+OTHER_BODY = "Where is my parcel? It has been two weeks already. " * 10
+
+
+def age(conn, table, email_id, when=OLD):
+    with conn:
+        conn.execute(f"UPDATE {table} SET {retention.TABLES[table]} = ? WHERE email_id = ?", (when, email_id))
+
+
+def count(conn, table, db='main'):
+    return conn.execute(f"SELECT COUNT(*) FROM {db}.{table}").fetchone()[0]
+
+
+def test_prune_deletes_old_rows_and_orphaned_bodies(conn):
+    storage.mark_email_processed_full(conn, 'old', 'Refund', BODY, 'Refund', 'high')
+    storage.mark_email_processed_full(conn, 'old2', 'Parcel', OTHER_BODY, 'Other', 'low')
+    # Same body as 'old', still referenced after the prune
+    storage.insert_unhandled_email(conn, 'new', 'Refund', BODY, 'high')
+    age(conn, 'processed_emails_full', 'old')
+    age(conn, 'processed_emails_full', 'old2')
+    assert count(conn, 'email_contents') == 2
+
+    totals = retention.run_pass(conn, days=90)
+    assert totals['pruned'] == 2 and totals['bodies'] == 1
+    assert count(conn, 'processed_emails_full') == 0
+    assert [row[0] for row in conn.execute("SELECT hash FROM email_contents")] == [content_store.content_hash(BODY)]
+    assert count(conn, 'unhandled_emails') == 1
+
+
+def test_prune_in_batches(conn):
+    for i in range(5):
+        storage.mark_email_processed_full(conn, f"e{i}", 'Hi', f"{i} {OTHER_BODY}", 'Other', 'low')
+        age(conn, 'processed_emails_full', f"e{i}")
+    totals = retention.run_pass(conn, days=90, batch=2)
+    assert totals['pruned'] == 5 and totals['bodies'] == 5
+    assert count(conn, 'processed_emails_full') == 0 and count(conn, 'email_contents') == 0
+
+
+def test_prune_copies_rows_and_bodies_to_the_archive(conn):
+    storage.insert_unhandled_email(conn, 'old', 'Refund', BODY, 'high')
+    age(conn, 'unhandled_emails', 'old')
+    retention.attach_archive(conn, 'archive.db')
+    retention.run_pass(conn, days=90, archive='archive.db')
+    assert count(conn, 'unhandled_emails') == 0 and count(conn, 'email_contents') == 0
+    archived = conn.execute("SELECT a.content_hash, c.codec, c.data FROM archive.unhandled_emails a "
+                            "JOIN archive.email_contents c ON c.hash = a.content_hash").fetchone()
+    assert content_store.decompress(archived['codec'], archived['data']) == BODY
+
+
+def test_compact_moves_legacy_bodies_to_the_content_store(conn):
+    with conn:
+        conn.execute("INSERT INTO processed_emails_full (email_id, subject, content, category, importance, processed_at) "
+                     "VALUES ('legacy', 'Refund', ?, 'Refund', 'high', ?)", (BODY, datetime.now().isoformat()))
+    totals = retention.run_pass(conn)
+    assert totals['compacted'] == 1 and totals['pruned'] == 0
+    row = conn.execute("SELECT content, content_hash FROM processed_emails_full").fetchone()
+    assert row['content'] == content_store.preview(BODY)
+    assert row['content_hash'] == content_store.content_hash(BODY)
+    assert retention.run_pass(conn)['compacted'] == 0
+    # The index still covers the part of the body that is no longer in the preview
+    rows, _ = storage.fetch_history_page(conn, 'processed', search='broken')
+    assert [row['email_id'] for row in rows] == ['legacy']
+
+
+def test_convert_keeps_the_search_index(conn):
+    for i in range(3):
+        storage.mark_email_processed_full(conn, f"e{i}", 'Hi', f"{i} {OTHER_BODY}", 'Other', 'low')
+    storage.mark_email_processed_full(conn, 'refund', 'Refund', BODY, 'Refund', 'high')
+    with conn:
+        conn.execute("DELETE FROM processed_emails_full WHERE email_id = 'e0'")
+    retention.convert_to_incremental(conn)
+    rows, _ = storage.fetch_history_page(conn, 'processed', search='broken')
+    assert [row['email_id'] for row in rows] == ['refund']
+
+
+def test_one_worker_holds_the_retention_lease(conn):
+    assert coordination.claim_job(conn, retention.RETENTION_JOB, 'host:1', ttl=60)
+    assert not coordination.claim_job(conn, retention.RETENTION_JOB, 'host:2', ttl=60)
+    assert coordination.claim_job(conn, retention.RETENTION_JOB, 'host:1', ttl=60)
+    coordination.unregister_worker(conn, 'host:1')
+    assert coordination.claim_job(conn, retention.RETENTION_JOB, 'host:2', ttl=60)
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pytest
+
+import storage
+
+
+def count(conn, table):
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_batched_writes_commit_at_the_end_of_the_block(conn):
+    with storage.batched_writes():
+        storage.mark_email_processed_full(conn, 'e1', 'Hi', 'short body', 'Other', 'low')
+        storage.insert_unhandled_email(conn, 'e2', 'Help', 'x' * 500, 'high')
+        assert count(conn, 'processed_emails_full') == 0
+        # Not processed until the write commits
+        assert storage.filter_unprocessed(conn, ['e1']) == ['e1']
+    assert count(conn, 'processed_emails_full') == 1
+    assert count(conn, 'unhandled_emails') == 1
+    assert count(conn, 'email_contents') == 1
+    assert storage.is_email_processed(conn, 'e1')
+
+
+def test_buffer_flushes_early_when_full(conn, monkeypatch):
+    monkeypatch.setattr(storage, 'MAX_BUFFERED_WRITES', 3)
+    with storage.batched_writes():
+        for i in range(3):
+            storage.mark_email_processed_full(conn, f"e{i}", 'Hi', 'body', 'Other', 'low')
+        assert count(conn, 'processed_emails_full') == 3
+        assert storage._pending_writes == []
+
+
+def test_flush_keeps_writes_on_a_locked_db(conn):
+    with storage.batched_writes():
+        storage.mark_email_processed_full(conn, 'e1', 'Hi', 'body', 'Other', 'low')
+        blocker = sqlite3.connect(storage.DB_FILE, timeout=0)
+        blocker.execute("BEGIN IMMEDIATE")
+        conn.execute("PRAGMA busy_timeout = 0")
+        with pytest.raises(sqlite3.OperationalError):
+            storage.flush()
+        # Still buffered and not counted as processed
+        assert len(storage._pending_writes) == 1
+        assert 'e1' not in storage._processed
+        blocker.rollback()
+        blocker.close()
+        storage.flush()
+    assert count(conn, 'processed_emails_full') == 1
+    assert 'e1' in storage._processed
+
+
+def test_flush_drops_only_the_failing_write(conn):
+    with storage.batched_writes():
+        storage.mark_email_processed_full(conn, 'e1', 'Hi', 'body', 'Other', 'low')
+        storage.write(conn, "INSERT INTO missing_table (x) VALUES (?)", (1,))
+        storage.mark_email_processed_full(conn, 'e2', 'Hi', 'body', 'Other', 'low')
+    assert count(conn, 'processed_emails_full') == 2
+    assert storage._pending_writes == []
+    assert {'e1', 'e2'} <= storage._processed
+
+
+def test_direct_write_without_batch(conn):
+    storage.mark_email_processed_full(conn, 'e1', 'Hi', 'body', 'Other', 'low')
+    assert count(conn, 'processed_emails_full') == 1
+    assert 'e1' in storage._processed
@@ -0,0 +1,140 @@
+"""Headless email worker.
+
+Runs the ingest and processing loop without Streamlit. Several workers,
+started with --processes or as separate commands, share the accounts through
+leases in the SQLite DB (see coordination.py). SIGINT/SIGTERM stop a worker
+gracefully: the pipeline batches in progress finish, buffered writes are
+flushed and its leases are released for the others. Queued emails stay in the
+pipeline table and are picked up again on the next start.
+
+Each worker process serves Prometheus metrics on 127.0.0.1:--metrics-port
+(the Nth process of --processes on port + N). Log lines carry the trace ID of
+the email being handled. With --retention-days, old history rows are pruned
+in the background (see retention.py).
+
+Usage: python worker.py [--processes 2] [--latest-only] [--full-sync] [--single-call]
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+import agent
+import coordination
+import kb_search
+import metrics
+import retention
+import storage
+
+logger = logging.getLogger("worker")
+
+
+def configure_logging(log_file):
+    handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+    for handler in handlers:
+        handler.addFilter(metrics.TraceFilter())
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)d - %(levelname)s - [%(trace_id)s] %(message)s',
+                        handlers=handlers)
+    logging.getLogger('google.auth').setLevel(logging.ERROR)
+
+
+def install_signal_handlers(event):
+    def stop(signum, frame):
+        if event.is_set():
+            logger.info(f"Received {signal.Signals(signum).name}, finishing in-flight emails")
+            event.clear()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+
+def run_worker(options):
+    configure_logging(options['log_file'])
+    if not os.environ.get("OPENAI_API_KEY", "").strip():
+        logger.error("OPENAI_API_KEY is not set")
+        return 1
+    event = threading.Event()
+    event.set()
+    install_signal_handlers(event)
+    conn = storage.connect()
+    if not conn:
+        return 1
+    storage.init_db(conn)
+    conn.close()
+    if options['metrics_port']:
+        metrics.serve(options['metrics_port'])
+    llm, _, knowledge_base, qa_chain = agent.init_rag_components(retrieval=options['retrieval'])
+    job = None
+    if options['retention_days']:
+        job = retention.RetentionJob(event, options['retention_days'], options['retention_archive']).start()
+    agent.monitor_emails(llm, qa_chain, options['latest_only'], event,
+                         account_workers=options['account_workers'], email_workers=options['email_workers'],
+                         per_account_limit=options['per_account'], interval=options['interval'],
+                         incremental=not options['full_sync'], knowledge_base=knowledge_base,
+                         single_call=options['single_call'] and knowledge_base is not None,
+                         categorize_mode=options['categorize_mode'], worker_id=coordination.worker_identity())
+    if job:
+        job.join()
+    return 0
+
+
+def _worker_process(options, index):
+    if options['metrics_port']:
+        options = dict(options, metrics_port=options['metrics_port'] + index)
+    sys.exit(run_worker(options))
+
+
+def run_processes(options, count):
+    """Start count worker processes and forward SIGTERM to them. SIGINT from a terminal reaches them directly."""
+    processes = [multiprocessing.Process(target=_worker_process, args=(options, i), name=f"worker-{i}") for i in range(count)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+    return max((process.exitcode or 0 for process in processes), default=0)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the support email worker without the UI")
+    parser.add_argument("--processes", type=int, default=1, help="worker processes to start on this host")
+    parser.add_argument("--latest-only", action="store_true", help="only check mail newer than one day")
+    parser.add_argument("--full-sync", action="store_true", help="list unread mail instead of history deltas")
+    parser.add_argument("--single-call", action="store_true", help="classify and answer questions with one LLM call")
+    parser.add_argument("--retrieval", choices=kb_search.MODES, default=kb_search.DEFAULT_MODE, help="knowledge base search")
+    parser.add_argument("--categorize-mode", choices=["concurrent", "batch", "inline"], default=agent.CATEGORIZE_MODE or "inline")
+    parser.add_argument("--interval", type=int, default=agent.MONITOR_INTERVAL, help="seconds between polling cycles")
+    parser.add_argument("--account-workers", type=int, default=agent.MAX_ACCOUNT_WORKERS)
+    parser.add_argument("--email-workers", type=int, default=agent.MAX_EMAIL_WORKERS)
+    parser.add_argument("--per-account", type=int, default=agent.MAX_EMAILS_PER_ACCOUNT, help="emails handled at once per account")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT, help="Prometheus endpoint port, 0 to disable")
+    parser.add_argument("--retention-days", type=int, help="prune history rows older than this many days in the background")
+    parser.add_argument("--retention-archive", help="SQLite file the pruned rows are copied to first")
+    parser.add_argument("--log-file", default="worker.log")
+    args = parser.parse_args(argv)
+    options = vars(args)
+    if options['categorize_mode'] == 'inline':
+        options['categorize_mode'] = None
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    processes = options.pop('processes')
+    if processes > 1:
+        configure_logging(options['log_file'])
+        logger.info(f"Starting {processes} worker processes")
+        return run_processes(options, processes)
+    return run_worker(options)
+
+
+if __name__ == "__main__":
+    sys.exit(main())